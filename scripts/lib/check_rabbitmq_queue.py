@@ -19,6 +19,7 @@ normal_queues = [
     "missedmessage_emails",
     "missedmessage_mobile_notifications",
     "outgoing_webhooks",
+    "search_index",
     "user_activity",
     "user_activity_interval",
     "user_presence",
@@ -23,8 +23,9 @@ def nginx_quote(s: str) -> str:
 # Basic system to do Tornado sharding.  Writes two output .tmp files that need
 # to be renamed to the following files to finalize the changes:
 # * /etc/zulip/nginx_sharding_map.conf; nginx needs to be reloaded after changing.
-# * /etc/zulip/sharding.json; supervisor Django process needs to be reloaded
-# after changing.  TODO: We can probably make this live-reload by statting the file.
+# * /etc/zulip/sharding.json; Django and Tornado processes notice changes to
+# this file within a few seconds, and Tornado processes hand off the event
+# queues of any users who moved to a different port.
 #
 # TODO: Restructure this to automatically generate a sharding layout.
 def write_updated_configs() -> None:
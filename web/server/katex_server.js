@@ -0,0 +1,28 @@
+"use strict";
+
+// A long-running KaTeX renderer, used by zerver/lib/tex.py so that
+// rendering a formula does not require starting a new node process.
+//
+// Each line of input is a JSON request {"tex": ..., "display_mode": ...}.
+// For each request, in order, we write a line of JSON {"html": ...},
+// where html is null if the TeX could not be rendered.
+
+const readline = require("readline");
+
+const katex = require("katex");
+
+const input = readline.createInterface({
+    input: process.stdin,
+    crlfDelay: Number.POSITIVE_INFINITY,
+});
+
+input.on("line", (line) => {
+    const request = JSON.parse(line);
+    let html = null;
+    try {
+        html = katex.renderToString(request.tex, {displayMode: request.display_mode});
+    } catch {
+        // Invalid TeX; the caller displays the source instead.
+    }
+    process.stdout.write(JSON.stringify({html}) + "\n");
+});
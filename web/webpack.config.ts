@@ -255,7 +255,7 @@ export default (
         name: "server",
         target: "node",
         entry: {
-            "katex-cli": "shebang-loader!katex/cli",
+            "katex-server": "./server/katex_server.js",
         },
         output: {
             path: path.resolve(__dirname, "../static/webpack-bundles"),
@@ -2,6 +2,7 @@ from typing import Iterable, List, TypedDict
 
 from zerver.lib import retention
 from zerver.lib.retention import move_messages_to_archive
+from zerver.lib.search_index import queue_search_index_update
 from zerver.lib.stream_subscription import get_active_subscriptions_for_stream_id
 from zerver.models import Message, Realm, UserMessage, UserProfile
 from zerver.tornado.django_api import send_event_on_commit
@@ -52,6 +53,7 @@ def do_delete_messages(realm: Realm, messages: Iterable[Message]) -> None:
         archiving_chunk_size = retention.STREAM_MESSAGE_BATCH_SIZE
 
     move_messages_to_archive(message_ids, realm=realm, chunk_size=archiving_chunk_size)
+    queue_search_index_update(message_ids)
 
     event["message_type"] = message_type
     send_event_on_commit(realm, event, users_to_notify)
@@ -36,6 +36,7 @@ from zerver.lib.message import (
     wildcard_mention_allowed,
 )
 from zerver.lib.queue import queue_json_publish
+from zerver.lib.search_index import queue_search_index_update
 from zerver.lib.stream_subscription import get_active_subscriptions_for_stream_id
 from zerver.lib.stream_topic import StreamTopicTarget
 from zerver.lib.streams import (
@@ -56,6 +57,7 @@ from zerver.lib.topic import (
     update_messages_for_topic_edit,
 )
 from zerver.lib.types import EditHistoryEvent
+from zerver.lib.unread_index import discard_unread_indexes_for_messages
 from zerver.lib.url_encoding import near_stream_message_url
 from zerver.lib.user_message import UserMessageLite, bulk_insert_ums
 from zerver.lib.user_topics import get_users_with_user_topic_visibility_policy
@@ -326,6 +328,7 @@ def do_update_embedded_data(
     message.save(update_fields=["content", "rendered_content"])
 
     event["message_ids"] = update_to_dict_cache(changed_messages)
+    queue_search_index_update(event["message_ids"])
 
     def user_info(um: UserMessage) -> Dict[str, Any]:
         return {
@@ -714,6 +717,12 @@ def do_update_message(
         realm_id = stream_being_edited.realm_id
 
     event["message_ids"] = update_to_dict_cache(changed_messages, realm_id)
+    queue_search_index_update(event["message_ids"])
+
+    if topic_name is not None or new_stream is not None:
+        # Users' indexes of unread messages have these messages under
+        # their old conversation.
+        discard_unread_indexes_for_messages(event["message_ids"])
 
     def user_info(um: UserMessage) -> Dict[str, Any]:
         return {
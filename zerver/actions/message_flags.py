@@ -18,6 +18,7 @@ from zerver.lib.message import (
 from zerver.lib.queue import queue_json_publish
 from zerver.lib.stream_subscription import get_subscribed_stream_recipient_ids_for_user
 from zerver.lib.topic import filter_by_topic_name_via_message
+from zerver.lib.unread_index import discard_unread_indexes, remove_from_unread_index
 from zerver.models import Message, Recipient, UserMessage, UserProfile
 from zerver.tornado.django_api import send_event
 
@@ -84,6 +85,8 @@ def do_mark_all_as_read(user_profile: UserProfile) -> int:
             if updated_count < batch_size:
                 break
 
+    discard_unread_indexes([user_profile.id])
+
     event = asdict(
         ReadMessagesEvent(
             messages=[],  # we don't send messages, since the client reloads anyway
@@ -124,6 +127,7 @@ def do_mark_stream_messages_as_read(
         count = query.update(
             flags=F("flags").bitor(UserMessage.flags.read),
         )
+        remove_from_unread_index(user_profile.id, message_ids)
 
     event = asdict(
         ReadMessagesEvent(
@@ -167,6 +171,7 @@ def do_mark_muted_user_messages_as_read(
         count = query.update(
             flags=F("flags").bitor(UserMessage.flags.read),
         )
+        remove_from_unread_index(user_profile.id, message_ids)
 
     event = asdict(
         ReadMessagesEvent(
@@ -350,6 +355,12 @@ def do_update_message_flags(
         else:
             to_update.update(flags=F("flags").bitand(~flagattr))
 
+        if flag == "read":
+            if is_adding:
+                remove_from_unread_index(user_profile.id, messages)
+            else:
+                discard_unread_indexes([user_profile.id])
+
     event = {
         "type": "update_message_flags",
         "op": operation,
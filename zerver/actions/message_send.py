@@ -1,5 +1,6 @@
 import datetime
 import logging
+import time
 from collections import defaultdict
 from dataclasses import dataclass
 from email.headerregistry import Address
@@ -22,7 +23,6 @@ import orjson
 from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.db import IntegrityError, transaction
-from django.db.models import F
 from django.utils.html import escape
 from django.utils.timezone import now as timezone_now
 from django.utils.translation import gettext as _
@@ -64,6 +64,7 @@ from zerver.lib.notification_data import (
 )
 from zerver.lib.queue import queue_json_publish
 from zerver.lib.recipient_users import recipient_for_user_profiles
+from zerver.lib.search_index import queue_search_index_update
 from zerver.lib.stream_subscription import (
     get_subscriptions_for_send_message,
     num_subscribers_for_stream_id,
@@ -74,7 +75,7 @@ from zerver.lib.string_validation import check_stream_name
 from zerver.lib.timestamp import timestamp_to_datetime
 from zerver.lib.topic import participants_for_topic
 from zerver.lib.url_preview.types import UrlEmbedData
-from zerver.lib.user_message import UserMessageLite, bulk_insert_ums
+from zerver.lib.user_message import UserMessageLiteBatch, bulk_insert_ums
 from zerver.lib.users import (
     check_can_access_user,
     check_user_can_access_all_users,
@@ -258,68 +259,36 @@ def get_recipient_info(
             # misses this sender. This is useful when the sender is sending their first message
             # in the topic.
             topic_participant_user_ids.add(sender_id)
-        subscription_rows = (
-            get_subscriptions_for_send_message(
-                realm_id=realm_id,
-                stream_id=stream_topic.stream_id,
-                topic_name=stream_topic.topic_name,
-                possible_stream_wildcard_mention=possible_stream_wildcard_mention,
-                topic_participant_user_ids=topic_participant_user_ids,
-                possibly_mentioned_user_ids=possibly_mentioned_user_ids,
-            )
-            .annotate(
-                user_profile_email_notifications=F(
-                    "user_profile__enable_stream_email_notifications"
-                ),
-                user_profile_push_notifications=F("user_profile__enable_stream_push_notifications"),
-                user_profile_wildcard_mentions_notify=F("user_profile__wildcard_mentions_notify"),
-                followed_topic_email_notifications=F(
-                    "user_profile__enable_followed_topic_email_notifications"
-                ),
-                followed_topic_push_notifications=F(
-                    "user_profile__enable_followed_topic_push_notifications"
-                ),
-                followed_topic_wildcard_mentions_notify=F(
-                    "user_profile__enable_followed_topic_wildcard_mentions_notify"
-                ),
-            )
-            .values(
-                "user_profile_id",
-                "push_notifications",
-                "email_notifications",
-                "wildcard_mentions_notify",
-                "followed_topic_push_notifications",
-                "followed_topic_email_notifications",
-                "followed_topic_wildcard_mentions_notify",
-                "user_profile_email_notifications",
-                "user_profile_push_notifications",
-                "user_profile_wildcard_mentions_notify",
-                "is_muted",
-            )
-            .order_by("user_profile_id")
+        user_id_to_visibility_policy = stream_topic.user_id_to_visibility_policy_dict()
+
+        subscription_rows = get_subscriptions_for_send_message(
+            realm_id=realm_id,
+            recipient_id=recipient.id,
+            possible_stream_wildcard_mention=possible_stream_wildcard_mention,
+            topic_participant_user_ids=topic_participant_user_ids,
+            possibly_mentioned_user_ids=possibly_mentioned_user_ids,
+            user_id_to_visibility_policy=user_id_to_visibility_policy,
         )
 
         message_to_user_ids = list()
         for row in subscription_rows:
-            message_to_user_ids.append(row["user_profile_id"])
+            message_to_user_ids.append(row.user_profile_id)
             # We store the 'sender_muted_stream' information here to avoid db query at
             # a later stage when we perform automatically unmute topic in muted stream operation.
-            if row["user_profile_id"] == sender_id:
-                sender_muted_stream = row["is_muted"]
-
-        user_id_to_visibility_policy = stream_topic.user_id_to_visibility_policy_dict()
+            if row.user_profile_id == sender_id:
+                sender_muted_stream = row.is_muted
 
         def notification_recipients(setting: str) -> Set[int]:
             return {
-                row["user_profile_id"]
+                row.user_profile_id
                 for row in subscription_rows
                 if user_allows_notifications_in_StreamTopic(
-                    row["is_muted"],
+                    row.is_muted,
                     user_id_to_visibility_policy.get(
-                        row["user_profile_id"], UserTopic.VisibilityPolicy.INHERIT
+                        row.user_profile_id, UserTopic.VisibilityPolicy.INHERIT
                     ),
-                    row[setting],
-                    row["user_profile_" + setting],
+                    getattr(row, setting),
+                    getattr(row, "user_profile_" + setting),
                 )
             }
 
@@ -328,13 +297,13 @@ def get_recipient_info(
 
         def followed_topic_notification_recipients(setting: str) -> Set[int]:
             return {
-                row["user_profile_id"]
+                row.user_profile_id
                 for row in subscription_rows
                 if user_id_to_visibility_policy.get(
-                    row["user_profile_id"], UserTopic.VisibilityPolicy.INHERIT
+                    row.user_profile_id, UserTopic.VisibilityPolicy.INHERIT
                 )
                 == UserTopic.VisibilityPolicy.FOLLOWED
-                and row["followed_topic_" + setting]
+                and getattr(row, "followed_topic_" + setting)
             }
 
         followed_topic_email_user_ids = followed_topic_notification_recipients(
@@ -726,7 +695,7 @@ def create_user_messages(
     limit_unread_user_ids: Optional[Set[int]],
     scheduled_message_to_self: bool,
     topic_participant_user_ids: Set[int],
-) -> List[UserMessageLite]:
+) -> UserMessageLiteBatch:
     # These properties on the Message are set via
     # render_markdown by code in the Markdown inline patterns
     ids_with_alert_words = rendering_result.user_ids_with_alert_words
@@ -758,7 +727,7 @@ def create_user_messages(
     #
     # See https://zulip.readthedocs.io/en/latest/subsystems/sending-messages.html#soft-deactivation
     # for details on this system.
-    user_messages = []
+    user_messages = UserMessageLiteBatch()
     for user_profile_id in um_eligible_user_ids:
         flags = base_flags
         if (
@@ -795,12 +764,7 @@ def create_user_messages(
         ):
             continue
 
-        um = UserMessageLite(
-            user_profile_id=user_profile_id,
-            message_id=message.id,
-            flags=flags,
-        )
-        user_messages.append(um)
+        user_messages.append(user_profile_id, message.id, int(flags))
 
     return user_messages
 
@@ -853,6 +817,36 @@ def get_active_presence_idle_user_ids(
     return filter_presence_idle_user_ids(user_ids)
 
 
+send_message_logger = logging.getLogger("zulip.send_message")
+
+
+class SendMessagesTimer:
+    """Records how long each stage of do_send_messages took, so that
+    slow sends can be attributed to the database writes, the
+    real-time events, or the work handed off to other processes."""
+
+    def __init__(self) -> None:
+        self.stage_start = time.perf_counter()
+        self.stage_times: Dict[str, float] = {}
+
+    def finish_stage(self, stage: str) -> None:
+        now = time.perf_counter()
+        self.stage_times[stage] = now - self.stage_start
+        self.stage_start = now
+
+    def log(self, num_messages: int) -> None:
+        if not send_message_logger.isEnabledFor(logging.DEBUG):
+            return
+        send_message_logger.debug(
+            "Sent %d messages (%s)",
+            num_messages,
+            ", ".join(
+                f"{stage}: {stage_time * 1000:.1f}ms"
+                for stage, stage_time in self.stage_times.items()
+            ),
+        )
+
+
 def do_send_messages(
     send_message_requests_maybe_none: Sequence[Optional[SendMessageRequest]],
     *,
@@ -863,7 +857,21 @@ def do_send_messages(
     """See
     https://zulip.readthedocs.io/en/latest/subsystems/sending-messages.html
     for high-level documentation on this subsystem.
+
+    Sending is done in three stages, each of which is timed:
+    * "write": A single transaction writes the Message and UserMessage
+      rows and claims attachments.
+    * "notify": For each message, updates the sender's topic
+      visibility policy and sends the message event to Tornado, which
+      delivers it to clients and enqueues push/email notifications.
+    * "enqueue": Work handled by other processes, which isn't
+      required for the message to be delivered, is enqueued for all
+      of the messages as a batch: embedded link previews, service bot
+      events, and Welcome Bot replies.  Apart from search index
+      updates, this is published immediately rather than on commit,
+      so callers inside their own transaction see its effects at once.
     """
+    timer = SendMessagesTimer()
 
     # Filter out messages which didn't pass internal_prep_message properly
     send_message_requests = [
@@ -874,6 +882,9 @@ def do_send_messages(
 
     # Save the message receipts in the database
     user_message_flags: Dict[int, Dict[int, List[str]]] = defaultdict(dict)
+    # Most recipients of a message share one of a handful of flag
+    # combinations, so we only build each flags list once.
+    flags_lists: Dict[int, List[str]] = {}
     with transaction.atomic():
         Message.objects.bulk_create(send_request.message for send_request in send_message_requests)
 
@@ -885,7 +896,7 @@ def do_send_messages(
                 send_request.message.has_attachment = True
                 send_request.message.save(update_fields=["has_attachment"])
 
-        ums: List[UserMessageLite] = []
+        ums = UserMessageLiteBatch()
         for send_request in send_message_requests:
             # Service bots (outgoing webhook bots and embedded bots) don't store UserMessage rows;
             # they will be processed later.
@@ -911,8 +922,11 @@ def do_send_messages(
                 topic_participant_user_ids=send_request.topic_participant_user_ids,
             )
 
-            for um in user_messages:
-                user_message_flags[send_request.message.id][um.user_profile_id] = um.flags_list()
+            message_user_flags = user_message_flags[send_request.message.id]
+            for user_profile_id, flags in zip(user_messages.user_profile_ids, user_messages.flags):
+                if flags not in flags_lists:
+                    flags_lists[flags] = UserMessage.flags_list_for_flags(flags)
+                message_user_flags[user_profile_id] = flags_lists[flags]
 
             ums.extend(user_messages)
 
@@ -929,15 +943,20 @@ def do_send_messages(
         for send_request in send_message_requests:
             do_widget_post_save_actions(send_request)
 
+    timer.finish_stage("write")
+
+    # Work for the enqueue stage, collected across all of the messages.
+    embed_links_events: List[Dict[str, Any]] = []
+    welcome_bot_send_requests: List[SendMessageRequest] = []
+    service_queue_events: List[Tuple[str, Dict[str, Any]]] = []
+
     # This next loop is responsible for notifying other parts of the
     # Zulip system about the messages we just committed to the database:
     # * Sender automatically follows or unmutes the topic depending on 'automatically_follow_topics_policy'
     #   and 'automatically_unmute_topics_in_muted_streams_policy' user settings.
     # * Notifying clients via send_event
-    # * Triggering outgoing webhooks via the service event queue.
     # * Updating the `first_message_id` field for streams without any message history.
-    # * Implementing the Welcome Bot reply hack
-    # * Adding links to the embed_links queue for open graph processing.
+    # * Collecting the work for the enqueue stage below.
     for send_request in send_message_requests:
         realm_id: Optional[int] = None
         if send_request.message.is_stream_message():
@@ -1025,7 +1044,9 @@ def do_send_messages(
             # clients.  Remove this when we no longer support legacy clients that have not
             # been updated to access `stream_wildcard_mentioned`.
             if "stream_wildcard_mentioned" in flags or "topic_wildcard_mentioned" in flags:
-                flags.append("wildcard_mentioned")
+                # The flags list is shared by every recipient with the
+                # same flags, so we must not modify it in place.
+                flags = [*flags, "wildcard_mentioned"]
             user_data: UserData = dict(id=user_id, flags=flags, mentioned_user_group_id=None)
 
             if user_id in send_request.mentioned_user_groups_map:
@@ -1126,13 +1147,14 @@ def do_send_messages(
         send_event(send_request.realm, event, users)
 
         if send_request.links_for_embed:
-            event_data = {
-                "message_id": send_request.message.id,
-                "message_content": send_request.message.content,
-                "message_realm_id": send_request.realm.id,
-                "urls": list(send_request.links_for_embed),
-            }
-            queue_json_publish("embed_links", event_data)
+            embed_links_events.append(
+                {
+                    "message_id": send_request.message.id,
+                    "message_content": send_request.message.content,
+                    "message_realm_id": send_request.realm.id,
+                    "urls": list(send_request.links_for_embed),
+                }
+            )
 
         if send_request.message.recipient.type == Recipient.PERSONAL:
             welcome_bot_id = get_system_bot(settings.WELCOME_BOT, send_request.realm.id).id
@@ -1140,22 +1162,44 @@ def do_send_messages(
                 welcome_bot_id in send_request.active_user_ids
                 and welcome_bot_id != send_request.message.sender_id
             ):
-                from zerver.lib.onboarding import send_welcome_bot_response
-
-                send_welcome_bot_response(send_request)
+                welcome_bot_send_requests.append(send_request)
 
         assert send_request.service_queue_events is not None
         for queue_name, events in send_request.service_queue_events.items():
             for event in events:
-                queue_json_publish(
-                    queue_name,
-                    {
-                        "message": wide_message_dict,
-                        "trigger": event["trigger"],
-                        "user_profile_id": event["user_profile_id"],
-                    },
+                service_queue_events.append(
+                    (
+                        queue_name,
+                        {
+                            "message": wide_message_dict,
+                            "trigger": event["trigger"],
+                            "user_profile_id": event["user_profile_id"],
+                        },
+                    )
                 )
 
+    timer.finish_stage("notify")
+
+    # Everything below is handled by queue workers or sends further
+    # messages, so it happens only once every message in the batch
+    # has been delivered to clients.
+    for event_data in embed_links_events:
+        queue_json_publish("embed_links", event_data)
+
+    queue_search_index_update([send_request.message.id for send_request in send_message_requests])
+
+    if welcome_bot_send_requests:
+        from zerver.lib.onboarding import send_welcome_bot_response
+
+        for send_request in welcome_bot_send_requests:
+            send_welcome_bot_response(send_request)
+
+    for queue_name, service_event in service_queue_events:
+        queue_json_publish(queue_name, service_event)
+
+    timer.finish_stage("enqueue")
+    timer.log(len(send_message_requests))
+
     sent_message_results = [
         SentMessageResult(
             message_id=send_request.message.id,
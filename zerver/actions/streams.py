@@ -19,6 +19,7 @@ from zerver.actions.message_send import internal_send_stream_message
 from zerver.lib.cache import (
     cache_delete_many,
     cache_set,
+    delete_stream_subscriber_settings_caches,
     display_recipient_cache_key,
     to_dict_cache_key_id,
 )
@@ -49,6 +50,7 @@ from zerver.lib.streams import (
 )
 from zerver.lib.subscription_info import get_subscribers_query
 from zerver.lib.types import APISubscriptionDict
+from zerver.lib.unread_index import discard_unread_indexes_for_messages
 from zerver.lib.users import (
     get_subscribers_of_target_user_subscriptions,
     get_users_involved_in_dms_with_target_users,
@@ -137,6 +139,8 @@ def do_deactivate_stream(stream: Stream, *, acting_user: Optional[UserProfile])
     ).select_related("user_profile")
     subscribed_users = [sub.user_profile for sub in stream_subscribers]
     stream_subscribers.update(active=False)
+    assert stream.recipient_id is not None
+    delete_stream_subscriber_settings_caches([stream.recipient_id])
 
     was_invite_only = stream.invite_only
     was_public = stream.is_public()
@@ -380,6 +384,7 @@ def merge_streams(
         recipient=recipient_to_destroy,
     ).update(recipient=recipient_to_keep)
     bulk_delete_cache_keys(message_ids_to_clear)
+    discard_unread_indexes_for_messages(message_ids_to_clear)
 
     # Remove subscriptions to the old stream.
     if len(subs_to_deactivate) > 0:
@@ -488,6 +493,9 @@ def bulk_add_subs_to_db_with_logging(
     Subscription.objects.bulk_create(info.sub for info in subs_to_add)
     sub_ids = [info.sub.id for info in subs_to_activate]
     Subscription.objects.filter(id__in=sub_ids).update(active=True)
+    delete_stream_subscriber_settings_caches(
+        {info.sub.recipient_id for info in subs_to_add + subs_to_activate}
+    )
 
     # Log subscription activities in RealmAuditLog
     event_time = timezone_now()
@@ -1059,6 +1067,9 @@ def bulk_remove_subscriptions(
         Subscription.objects.filter(
             id__in=sub_ids_to_deactivate,
         ).update(active=False)
+        delete_stream_subscriber_settings_caches(
+            {sub_info.sub.recipient_id for sub_info in subs_to_deactivate}
+        )
         occupied_streams_after = list(get_occupied_streams(realm))
 
         # Log subscription activities in RealmAuditLog
@@ -20,6 +20,7 @@ from zerver.models import (
     UserGroupMembership,
     UserProfile,
     active_user_ids,
+    flush_realm_mention_data,
 )
 from zerver.tornado.django_api import send_event, send_event_on_commit
 
@@ -302,6 +303,7 @@ def bulk_add_members_to_user_groups(
     )
 
     for user_group in user_groups:
+        flush_realm_mention_data(user_group.realm_id)
         do_send_user_group_members_update_event("add_members", user_group, user_profile_ids)
 
 
@@ -335,6 +337,7 @@ def bulk_remove_members_from_user_groups(
     )
 
     for user_group in user_groups:
+        flush_realm_mention_data(user_group.realm_id)
         do_send_user_group_members_update_event("remove_members", user_group, user_profile_ids)
 
 
@@ -11,11 +11,15 @@ from zerver.lib.cache import (
 from zerver.models import AlertWord, Realm, UserProfile, flush_realm_alert_words
 
 
-@cache_with_key(lambda realm: realm_alert_words_cache_key(realm.id), timeout=3600 * 24)
 def alert_words_in_realm(realm: Realm) -> Dict[int, List[str]]:
-    user_ids_and_words = AlertWord.objects.filter(realm=realm, user_profile__is_active=True).values(
-        "user_profile_id", "word"
-    )
+    return alert_words_in_realm_by_id(realm.id)
+
+
+@cache_with_key(realm_alert_words_cache_key, timeout=3600 * 24)
+def alert_words_in_realm_by_id(realm_id: int) -> Dict[int, List[str]]:
+    user_ids_and_words = AlertWord.objects.filter(
+        realm_id=realm_id, user_profile__is_active=True
+    ).values("user_profile_id", "word")
     user_ids_with_words: Dict[int, List[str]] = {}
     for id_and_word in user_ids_and_words:
         user_ids_with_words.setdefault(id_and_word["user_profile_id"], [])
@@ -25,6 +25,7 @@ from typing import (
 from django.conf import settings
 from django.core.cache import caches
 from django.core.cache.backends.base import BaseCache
+from django.db import transaction
 from django.db.models import Q
 from django.http import HttpRequest
 from django_stubs_ext import QuerySetAny
@@ -33,7 +34,16 @@ from typing_extensions import ParamSpec
 if TYPE_CHECKING:
     # These modules have to be imported for type annotations but
     # they cannot be imported at runtime due to cyclic dependency.
-    from zerver.models import Attachment, Message, MutedUser, Realm, Stream, SubMessage, UserProfile
+    from zerver.models import (
+        Attachment,
+        Message,
+        MutedUser,
+        Realm,
+        Stream,
+        SubMessage,
+        Subscription,
+        UserProfile,
+    )
 
 MEMCACHED_MAX_KEY_LENGTH = 250
 
@@ -415,6 +425,14 @@ def preview_url_cache_key(url: str) -> str:
     return f"preview_url:{hashlib.sha1(url.encode()).hexdigest()}"
 
 
+def preview_url_fresh_cache_key(url: str) -> str:
+    return f"preview_url_fresh:{hashlib.sha1(url.encode()).hexdigest()}"
+
+
+def preview_host_failure_cache_key(host: str) -> str:
+    return f"preview_host_failure:{hashlib.sha1(host.encode()).hexdigest()}"
+
+
 def display_recipient_cache_key(recipient_id: int) -> str:
     return f"display_recipient_dict:{recipient_id}"
 
@@ -515,6 +533,51 @@ def bot_dicts_in_realm_cache_key(realm_id: int) -> str:
     return f"bot_dicts_in_realm:{realm_id}"
 
 
+def unread_index_cache_key(user_profile_id: int) -> str:
+    return f"unread_index:{user_profile_id}"
+
+
+def unread_index_version_cache_key(user_profile_id: int) -> str:
+    return f"unread_index_version:{user_profile_id}"
+
+
+def stream_subscriber_settings_cache_key(recipient_id: int) -> str:
+    return f"stream_subscriber_settings:{recipient_id}"
+
+
+def realm_subscriber_settings_version_cache_key(realm_id: int) -> str:
+    return f"realm_subscriber_settings_version:{realm_id}"
+
+
+# The UserProfile fields included in the cached notification settings
+# of a stream's subscribers; see get_stream_subscriber_settings.
+subscriber_settings_user_fields: List[str] = [
+    "enable_followed_topic_email_notifications",
+    "enable_followed_topic_push_notifications",
+    "enable_followed_topic_wildcard_mentions_notify",
+    "enable_stream_email_notifications",
+    "enable_stream_push_notifications",
+    "is_active",
+    "long_term_idle",
+    "wildcard_mentions_notify",
+]
+
+
+# Subscriber settings are changed inside transactions; a message sent
+# to the stream before the change commits may cache the old settings
+# again, so we also delete the entries once the change commits.
+def delete_stream_subscriber_settings_caches(recipient_ids: Iterable[int]) -> None:
+    keys = [stream_subscriber_settings_cache_key(rid) for rid in recipient_ids]
+    cache_delete_many(keys)
+    transaction.on_commit(lambda: cache_delete_many(keys))
+
+
+def delete_realm_subscriber_settings_version(realm_id: int) -> None:
+    key = realm_subscriber_settings_version_cache_key(realm_id)
+    cache_delete(key)
+    transaction.on_commit(lambda: cache_delete(key))
+
+
 def delete_user_profile_caches(user_profiles: Iterable["UserProfile"], realm: "Realm") -> None:
     # Imported here to avoid cyclic dependency.
     from zerver.lib.users import get_all_api_keys
@@ -585,6 +648,16 @@ def flush_user_profile(
     if user_profile.is_bot and changed(update_fields, bot_dict_fields):
         cache_delete(bot_dicts_in_realm_cache_key(user_profile.realm_id))
 
+    # Rather than finding every stream this user is subscribed to, we
+    # invalidate the cached subscriber settings of all of the realm's
+    # streams by deleting the realm's version key.
+    if changed(update_fields, subscriber_settings_user_fields):
+        delete_realm_subscriber_settings_version(user_profile.realm_id)
+
+    # Mentions are resolved by full name, and only to active users.
+    if changed(update_fields, ["full_name", "is_active"]):
+        cache_delete(realm_mention_data_version_cache_key(user_profile.realm_id))
+
 
 def flush_muting_users_cache(*, instance: "MutedUser", **kwargs: object) -> None:
     mute_object = instance
@@ -615,7 +688,10 @@ def flush_realm(
         cache_delete(bot_dicts_in_realm_cache_key(realm.id))
         cache_delete(realm_alert_words_cache_key(realm.id))
         cache_delete(realm_alert_words_automaton_cache_key(realm.id))
+        cache_delete(realm_alert_words_version_cache_key(realm.id))
+        cache_delete(realm_mention_data_version_cache_key(realm.id))
         cache_delete(active_non_guest_user_ids_cache_key(realm.id))
+        delete_realm_subscriber_settings_version(realm.id)
         cache_delete(realm_rendered_description_cache_key(realm))
         cache_delete(realm_text_description_cache_key(realm))
     elif changed(update_fields, ["description"]):
@@ -631,6 +707,18 @@ def realm_alert_words_automaton_cache_key(realm_id: int) -> str:
     return f"realm_alert_words_automaton:{realm_id}"
 
 
+def realm_alert_words_version_cache_key(realm_id: int) -> str:
+    return f"realm_alert_words_version:{realm_id}"
+
+
+def realm_mention_data_version_cache_key(realm_id: int) -> str:
+    return f"realm_mention_data_version:{realm_id}"
+
+
+def rendered_markdown_cache_key(digest: str) -> str:
+    return f"rendered_markdown:{digest}"
+
+
 def realm_rendered_description_cache_key(realm: "Realm") -> str:
     return f"realm_rendered_description:{realm.string_id}"
 
@@ -661,6 +749,14 @@ def flush_stream(
         cache_delete(bot_dicts_in_realm_cache_key(stream.realm_id))
 
 
+# Called by models.py to flush the cached subscriber settings of a
+# stream whenever we save a subscription object.  Bulk updates to
+# Subscription rows need to call delete_stream_subscriber_settings_caches
+# directly.
+def flush_subscription(*, instance: "Subscription", **kwargs: object) -> None:
+    delete_stream_subscriber_settings_caches([instance.recipient_id])
+
+
 def flush_used_upload_space_cache(
     *,
     instance: "Attachment",
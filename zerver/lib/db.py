@@ -41,6 +41,10 @@ class TimeTrackingCursor(cursor):
     def executemany(self, query: Query, vars_list: Iterable[Params]) -> None:  # nocoverage
         wrapper_execute(self, super().executemany, query, vars_list)
 
+    @override
+    def copy_expert(self, sql: Query, file: Any, size: int = 8192) -> None:
+        wrapper_execute(self, lambda sql, file: super().copy_expert(sql, file, size), sql, file)
+
 
 CursorT = TypeVar("CursorT", bound=cursor)
 
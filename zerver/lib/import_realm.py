@@ -26,7 +26,8 @@ from zerver.lib.bulk_create import bulk_set_users_or_streams_recipient_fields
 from zerver.lib.export import DATE_FIELDS, Field, Path, Record, TableData, TableName
 from zerver.lib.markdown import markdown_convert
 from zerver.lib.markdown import version as markdown_version
-from zerver.lib.message import get_last_message_id
+from zerver.lib.mention import MentionData
+from zerver.lib.message import get_last_message_id, prefetch_rendering_batch_data
 from zerver.lib.server_initialization import create_internal_realm, server_initialized
 from zerver.lib.streams import render_stream_description
 from zerver.lib.timestamp import datetime_to_timestamp
@@ -34,7 +35,7 @@ from zerver.lib.upload import upload_backend
 from zerver.lib.upload.base import BadImageError, sanitize_name
 from zerver.lib.upload.s3 import get_bucket
 from zerver.lib.user_groups import create_system_user_groups_for_realm
-from zerver.lib.user_message import UserMessageLite, bulk_insert_ums
+from zerver.lib.user_message import UserMessageLiteBatch, bulk_insert_ums
 from zerver.lib.utils import generate_api_key, process_list_in_batches
 from zerver.models import (
     AlertWord,
@@ -306,6 +307,10 @@ def fix_message_rendered_content(
     This function sets the rendered_content of all the messages
     after the messages have been imported from a non-Zulip platform.
     """
+    batch_data = prefetch_rendering_batch_data(
+        realm,
+        [message["content"] for message in messages if message["rendered_content"] is None],
+    )
     for message in messages:
         if message["rendered_content"] is not None:
             # For Zulip->Zulip imports, we use the original rendered
@@ -373,6 +378,8 @@ def fix_message_rendered_content(
                 message_realm=realm,
                 sent_by_bot=sent_by_bot,
                 translate_emoticons=translate_emoticons,
+                mention_data=MentionData(batch_data.mention_backend, content),
+                active_realm_emoji=batch_data.active_realm_emoji,
             ).rendered_content
 
             message["rendered_content"] = rendered_content
@@ -656,14 +663,9 @@ def bulk_import_user_message_data(data: TableData, dump_file_id: int) -> None:
     # so we can safely avoid all re-mapping complexity.
 
     def process_batch(items: List[Dict[str, Any]]) -> None:
-        ums = [
-            UserMessageLite(
-                user_profile_id=item["user_profile_id"],
-                message_id=item["message_id"],
-                flags=item["flags"],
-            )
-            for item in items
-        ]
+        ums = UserMessageLiteBatch()
+        for item in items:
+            ums.append(item["user_profile_id"], item["message_id"], item["flags"])
         bulk_insert_ums(ums)
 
     chunk_size = 10000
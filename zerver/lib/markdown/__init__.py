@@ -2,14 +2,17 @@
 # detailed documentation on our Markdown syntax.
 import cgi
 import datetime
+import hashlib
 import html
 import logging
 import mimetypes
+import os
 import re
+import secrets
 import time
 import urllib
 import urllib.parse
-from collections import deque
+from collections import OrderedDict, deque
 from dataclasses import dataclass
 from functools import lru_cache
 from typing import (
@@ -17,6 +20,7 @@ from typing import (
     Callable,
     Dict,
     Generic,
+    Iterator,
     List,
     Match,
     Optional,
@@ -42,6 +46,7 @@ import markdown.postprocessors
 import markdown.preprocessors
 import markdown.treeprocessors
 import markdown.util
+import orjson
 import re2
 import regex
 import requests
@@ -54,13 +59,21 @@ from tlds import tld_set
 from typing_extensions import Self, TypeAlias, override
 
 from zerver.lib import mention
-from zerver.lib.cache import cache_with_key
+from zerver.lib.cache import (
+    cache_get,
+    cache_get_many,
+    cache_set,
+    cache_with_key,
+    realm_alert_words_version_cache_key,
+    rendered_markdown_cache_key,
+)
 from zerver.lib.camo import get_camo_url
 from zerver.lib.emoji import EMOTICON_RE, codepoint_to_name, name_to_codepoint, translate_emoticons
 from zerver.lib.emoji_utils import emoji_to_hex_codepoint, unqualify_emoji
 from zerver.lib.exceptions import MarkdownRenderingError
 from zerver.lib.markdown import fenced_code
 from zerver.lib.markdown.fenced_code import FENCE_RE
+from zerver.lib.markdown.render_pool import RenderPool, RenderPoolStats
 from zerver.lib.mention import (
     BEFORE_MENTION_ALLOWED_REGEX,
     FullNameInfo,
@@ -156,7 +169,7 @@ version = 1
 _T = TypeVar("_T")
 ElementStringNone: TypeAlias = Union[Element, Optional[str]]
 
-EMOJI_REGEX = r"(?P<syntax>:[\w\-\+]+:)"
+EMOJI_NAME_REGEX = r":[\w\-\+]+:"
 
 
 def verbose_compile(pattern: str) -> Pattern[str]:
@@ -1477,62 +1490,47 @@ def make_realm_emoji(src: str, display_string: str) -> Element:
     return elt
 
 
-class EmoticonTranslation(markdown.inlinepatterns.Pattern):
-    """Translates emoticons like `:)` into emoji like `:smile:`."""
-
-    def __init__(self, pattern: str, zmd: "ZulipMarkdown") -> None:
-        super().__init__(pattern, zmd)
-        self.zmd = zmd
-
-    @override
-    def handleMatch(self, match: Match[str]) -> Optional[Element]:
-        db_data: Optional[DbData] = self.zmd.zulip_db_data
-        if db_data is None or not db_data.translate_emoticons:
-            return None
+TEXT_PRESENTATION_RE = regex.compile(r"\P{Emoji_Presentation}\u20E3?")
 
-        emoticon = match.group("emoticon")
-        translated = translate_emoticons(emoticon)
-        name = translated[1:-1]
-        return make_emoji(name_to_codepoint[name], translated)
+# All three ways of writing an emoji -- `:name:` syntax, emoticons,
+# and Unicode emoji -- in a single regex, so that rendering scans each
+# piece of text for emoji once, rather than once for each of them.
+# Where more than one alternative matches at the same place, the
+# earliest one wins.
+EMOJI_RE = regex.compile(
+    rf"(?P<emoji_name>{EMOJI_NAME_REGEX})|{EMOTICON_RE}|{POSSIBLE_EMOJI_RE.pattern}",
+    regex.VERBOSE,
+)
 
 
-TEXT_PRESENTATION_RE = regex.compile(r"\P{Emoji_Presentation}\u20E3?")
+class Emoji(CompiledInlineProcessor):
+    """Renders emoji written in any of the ways that EMOJI_RE matches.
 
+    The table of Unicode emoji is shared by every realm; each realm's
+    custom emoji are a small overlay on top of it, from DbData.
+    """
 
-class UnicodeEmoji(CompiledInlineProcessor):
     @override
     def handleMatch(  # type: ignore[override] # https://github.com/python/mypy/issues/10197
         self, match: Match[str], data: str
-    ) -> Union[Tuple[None, None, None], Tuple[Element, int, int]]:
-        orig_syntax = match.group("syntax")
-
-        # We want to avoid turning things like arrows (↔) and keycaps (numbers
-        # in boxes) into qualified emoji.
-        # More specifically, we skip anything with text in the second column of
-        # this table https://unicode.org/Public/emoji/1.0/emoji-data.txt
-        if TEXT_PRESENTATION_RE.fullmatch(orig_syntax):
-            return None, None, None
-
-        codepoint = emoji_to_hex_codepoint(unqualify_emoji(orig_syntax))
-        if codepoint in codepoint_to_name:
-            display_string = ":" + codepoint_to_name[codepoint] + ":"
-            return make_emoji(codepoint, display_string), match.start(), match.end()
+    ) -> Union[Tuple[None, None, None], Tuple[Union[str, Element], int, int]]:
+        db_data: Optional[DbData] = self.zmd.zulip_db_data
+        element: Union[str, Element, None]
+        if match.group("emoji_name") is not None:
+            element = self.handle_emoji_name(match.group("emoji_name"), db_data)
+        elif match.group("emoticon") is not None:
+            element = self.handle_emoticon(match.group("emoticon"), db_data)
         else:
-            return None, None, None
-
+            element = self.handle_unicode_emoji(match.group("syntax"))
 
-class Emoji(markdown.inlinepatterns.Pattern):
-    def __init__(self, pattern: str, zmd: "ZulipMarkdown") -> None:
-        super().__init__(pattern, zmd)
-        self.zmd = zmd
+        if element is None:
+            return None, None, None
+        return element, match.start(), match.end()
 
-    @override
-    def handleMatch(self, match: Match[str]) -> Optional[Union[str, Element]]:
-        orig_syntax = match.group("syntax")
+    def handle_emoji_name(self, orig_syntax: str, db_data: Optional[DbData]) -> Union[str, Element]:
         name = orig_syntax[1:-1]
 
         active_realm_emoji: Dict[str, EmojiInfo] = {}
-        db_data: Optional[DbData] = self.zmd.zulip_db_data
         if db_data is not None:
             active_realm_emoji = db_data.active_realm_emoji
 
@@ -1549,9 +1547,33 @@ class Emoji(markdown.inlinepatterns.Pattern):
         else:
             return orig_syntax
 
+    def handle_emoticon(self, emoticon: str, db_data: Optional[DbData]) -> Optional[Element]:
+        """Translates emoticons like `:)` into emoji like `:smile:`."""
+        if db_data is None or not db_data.translate_emoticons:
+            return None
+
+        translated = translate_emoticons(emoticon)
+        name = translated[1:-1]
+        return make_emoji(name_to_codepoint[name], translated)
+
+    def handle_unicode_emoji(self, orig_syntax: str) -> Optional[Element]:
+        # We want to avoid turning things like arrows (↔) and keycaps (numbers
+        # in boxes) into qualified emoji.
+        # More specifically, we skip anything with text in the second column of
+        # this table https://unicode.org/Public/emoji/1.0/emoji-data.txt
+        if TEXT_PRESENTATION_RE.fullmatch(orig_syntax):
+            return None
+
+        codepoint = emoji_to_hex_codepoint(unqualify_emoji(orig_syntax))
+        if codepoint in codepoint_to_name:
+            display_string = ":" + codepoint_to_name[codepoint] + ":"
+            return make_emoji(codepoint, display_string)
+        else:
+            return None
+
 
 def content_has_emoji_syntax(content: str) -> bool:
-    return re.search(EMOJI_REGEX, content) is not None
+    return re.search(EMOJI_NAME_REGEX, content) is not None
 
 
 class Tex(markdown.inlinepatterns.Pattern):
@@ -1845,6 +1867,67 @@ def prepare_linkifier_pattern(source: str) -> str:
     return regex.replace(" ", "").replace("\n", "")
 
 
+class LinkifierPrefilter:
+    """All of a realm's linkifier patterns, compiled into a single RE2
+    set, which finds which of the patterns match anywhere in a string
+    in one pass over it.
+
+    Each linkifier is still applied by its own LinkifierPattern, in
+    order, so that overlapping linkifiers take precedence exactly as
+    before; but a LinkifierPattern only searches the text if the set
+    says it can match, so rendering a message costs one scan of each
+    text fragment plus one per linkifier that actually matches,
+    rather than one scan per linkifier.
+    """
+
+    def __init__(self, source_patterns: List[str]) -> None:
+        options = re2.Options()
+        options.log_errors = False
+        self.pattern_set: Optional[re2.Set] = re2.Set.SearchSet(options)
+        try:
+            for source_pattern in source_patterns:
+                self.pattern_set.Add(prepare_linkifier_pattern(source_pattern))
+            self.pattern_set.Compile()
+        except re2.error:
+            # Every linkifier is then searched for, as if each might match.
+            self.pattern_set = None
+
+        # Python-Markdown applies each inline pattern in turn to the
+        # same fragment of text, so we remember the last result.
+        self.last_text: Optional[str] = None
+        self.last_matching_indexes: Set[int] = set()
+
+    def may_match(self, index: int, text: str) -> bool:
+        if self.pattern_set is None:
+            return True
+        if text != self.last_text:
+            self.last_text = text
+            # Match returns None, rather than an empty list, if no
+            # pattern matches.
+            self.last_matching_indexes = set(self.pattern_set.Match(text) or [])
+        return index in self.last_matching_indexes
+
+
+class PrefilteredRegex:
+    """Wraps a linkifier's compiled regex, so that Python-Markdown's
+    finditer calls skip the search if the linkifier's prefilter says
+    it cannot match.  Since RE2's ^ never matches at a starting
+    position other than 0, any match from a later position is also a
+    match in the whole text, so checking the whole text suffices."""
+
+    def __init__(
+        self, compiled_re: Pattern[str], prefilter: LinkifierPrefilter, index: int
+    ) -> None:
+        self.compiled_re = compiled_re
+        self.prefilter = prefilter
+        self.index = index
+
+    def finditer(self, data: str, pos: int = 0) -> Iterator[Match[str]]:
+        if not self.prefilter.may_match(self.index, data):
+            return iter(())
+        return self.compiled_re.finditer(data, pos)
+
+
 # Given a regular expression pattern, linkifies groups that match it
 # using the provided format string to construct the URL.
 class LinkifierPattern(CompiledInlineProcessor):
@@ -1855,6 +1938,8 @@ class LinkifierPattern(CompiledInlineProcessor):
         source_pattern: str,
         url_template: str,
         zmd: "ZulipMarkdown",
+        prefilter: LinkifierPrefilter,
+        index: int,
     ) -> None:
         # Do not write errors to stderr (this still raises exceptions)
         options = re2.Options()
@@ -1864,7 +1949,7 @@ class LinkifierPattern(CompiledInlineProcessor):
 
         self.prepared_url_template = uri_template.URITemplate(url_template)
 
-        super().__init__(compiled_re2, zmd)
+        super().__init__(cast(Pattern[str], PrefilteredRegex(compiled_re2, prefilter, index)), zmd)
 
     @override
     def handleMatch(  # type: ignore[override] # https://github.com/python/mypy/issues/10197
@@ -2337,24 +2422,38 @@ class ZulipMarkdown(markdown.Markdown):
             "not_strong",
             20,
         )
-        reg.register(Emoji(EMOJI_REGEX, self), "emoji", 15)
-        reg.register(EmoticonTranslation(EMOTICON_RE, self), "translate_emoticons", 10)
+        reg.register(Emoji(cast(Pattern[str], EMOJI_RE), self), "emoji", 15)
         # We get priority 5 from 'nl2br' extension
-        reg.register(UnicodeEmoji(cast(Pattern[str], POSSIBLE_EMOJI_RE), self), "unicodeemoji", 0)
         return reg
 
     def register_linkifiers(
         self, registry: markdown.util.Registry[markdown.inlinepatterns.Pattern]
     ) -> markdown.util.Registry[markdown.inlinepatterns.Pattern]:
-        for linkifier in self.linkifiers:
+        prefilter = LinkifierPrefilter([linkifier["pattern"] for linkifier in self.linkifiers])
+        for index, linkifier in enumerate(self.linkifiers):
             pattern = linkifier["pattern"]
             registry.register(
-                LinkifierPattern(pattern, linkifier["url_template"], self),
+                LinkifierPattern(pattern, linkifier["url_template"], self, prefilter, index),
                 f"linkifiers/{pattern}",
                 45,
             )
         return registry
 
+    def update_linkifiers(self, linkifiers: List[LinkifierDict]) -> None:
+        """Replaces the linkifier inline patterns with ones for the given
+        linkifiers, leaving the rest of the engine as it is.  The inline
+        treeprocessor shares self.inlinePatterns, so it picks up the
+        change; and the registry keeps patterns of equal priority in
+        insertion order, so the result is the same as building a new
+        engine with these linkifiers."""
+        if self.linkifiers_key != ZEPHYR_MIRROR_MARKDOWN_KEY:
+            # The zephyr mirror engine has no linkifier patterns.
+            for linkifier in self.linkifiers:
+                self.inlinePatterns.deregister(f"linkifiers/{linkifier['pattern']}", strict=False)
+        self.linkifiers = linkifiers
+        if self.linkifiers_key != ZEPHYR_MIRROR_MARKDOWN_KEY:
+            self.register_linkifiers(self.inlinePatterns)
+
     def build_treeprocessors(self) -> markdown.util.Registry[markdown.treeprocessors.Treeprocessor]:
         # Here we build all the processors from upstream, plus a few of our own.
         treeprocessors = markdown.util.Registry[markdown.treeprocessors.Treeprocessor]()
@@ -2400,8 +2499,15 @@ class ZulipMarkdown(markdown.Markdown):
             )
 
 
+# Engines are kept for at most this many linkifiers_keys (realms);
+# when there are more, the least recently used realm's engines are
+# dropped, so the memory used by idle realms' engines is reclaimed.
+MAX_MD_ENGINE_REALMS = 100
+
 md_engines: Dict[Tuple[int, bool], ZulipMarkdown] = {}
-linkifier_data: Dict[int, List[LinkifierDict]] = {}
+# The linkifiers each realm's engines were built with, ordered from
+# least to most recently used.
+linkifier_data: "OrderedDict[int, List[LinkifierDict]]" = OrderedDict()
 
 
 def make_md_engine(linkifiers_key: int, email_gateway: bool) -> None:
@@ -2417,6 +2523,12 @@ def make_md_engine(linkifiers_key: int, email_gateway: bool) -> None:
     )
 
 
+def drop_md_engines(linkifiers_key: int) -> None:
+    linkifier_data.pop(linkifiers_key, None)
+    for email_gateway in [True, False]:
+        md_engines.pop((linkifiers_key, email_gateway), None)
+
+
 # Split the topic name into multiple sections so that we can easily use
 # our common single link matching regex on it.
 basic_link_splitter = re.compile(r"[ !;\),\'\"]")
@@ -2556,21 +2668,149 @@ def topic_links(linkifiers_key: int, topic_name: str) -> List[Dict[str, str]]:
 
 
 def maybe_update_markdown_engines(linkifiers_key: int, email_gateway: bool) -> None:
-    linkifiers = linkifiers_for_realm(linkifiers_key)
-    if linkifiers_key not in linkifier_data or linkifier_data[linkifiers_key] != linkifiers:
-        # Linkifier data has changed, update `linkifier_data` and any
-        # of the existing Markdown engines using this set of linkifiers.
+    update_markdown_engines(linkifiers_key, email_gateway, linkifiers_for_realm(linkifiers_key))
+
+
+def update_markdown_engines(
+    linkifiers_key: int, email_gateway: bool, linkifiers: List[LinkifierDict]
+) -> None:
+    if linkifiers_key not in linkifier_data:
         linkifier_data[linkifiers_key] = linkifiers
-        for email_gateway_flag in [True, False]:
-            if (linkifiers_key, email_gateway_flag) in md_engines:
-                # Update only existing engines(if any), don't create new one.
-                make_md_engine(linkifiers_key, email_gateway_flag)
+        while len(linkifier_data) > MAX_MD_ENGINE_REALMS:
+            evicted_linkifiers_key, _ = linkifier_data.popitem(last=False)
+            drop_md_engines(evicted_linkifiers_key)
+    else:
+        linkifier_data.move_to_end(linkifiers_key)
+        if linkifier_data[linkifiers_key] != linkifiers:
+            # Linkifier data has changed, update `linkifier_data` and
+            # patch the linkifier patterns of any existing Markdown
+            # engines using this set of linkifiers.
+            linkifier_data[linkifiers_key] = linkifiers
+            for email_gateway_flag in [True, False]:
+                if (linkifiers_key, email_gateway_flag) in md_engines:
+                    md_engines[(linkifiers_key, email_gateway_flag)].update_linkifiers(linkifiers)
 
     if (linkifiers_key, email_gateway) not in md_engines:
         # Markdown engine corresponding to this key doesn't exists so create one.
         make_md_engine(linkifiers_key, email_gateway)
 
 
+@dataclass
+class CachedRendering:
+    rendering_result: MessageRenderingResult
+    has_link: bool
+    has_image: bool
+    # The realm's alert words version the render used, if any.
+    alert_words_version: Optional[str]
+
+
+# Renders larger than this are not worth a cache round-trip.
+RENDERING_CACHE_MAX_LENGTH = 100 * 1024
+
+
+def get_rendering_cache_key(
+    content: str,
+    linkifiers_key: int,
+    email_gateway: bool,
+    linkifiers: List[LinkifierDict],
+    has_message: bool,
+    message_realm: Optional[Realm],
+    db_data: Optional[DbData],
+    image_preview: bool,
+    url_embed_preview: bool,
+) -> str:
+    """Returns a cache key which is a hash of the content and all the
+    inputs that may affect how it renders.  Hashing the data fetched
+    for this render, rather than tracking a realm-wide version, means
+    that e.g. renaming a user only affects cached renders of messages
+    that might mention them."""
+    realm_data = None
+    if message_realm is not None:
+        realm_data = [
+            message_realm.id,
+            message_realm.host,
+            message_realm.default_code_block_language,
+        ]
+
+    db_data_fields = None
+    if db_data is not None:
+        user_data = db_data.mention_data
+        db_data_fields = [
+            sorted(
+                [name, row.id, row.full_name, row.is_active]
+                for name, row in user_data.full_name_info.items()
+            ),
+            sorted(
+                [name, group.id, group.name, user_data.user_group_members.get(group.id, [])]
+                for name, group in user_data.user_group_name_info.items()
+            ),
+            db_data.realm_uri,
+            db_data.active_realm_emoji,
+            db_data.sent_by_bot,
+            db_data.stream_names,
+            db_data.translate_emoticons,
+        ]
+
+    data = orjson.dumps(
+        [
+            version,
+            content,
+            linkifiers_key,
+            email_gateway,
+            linkifiers,
+            has_message,
+            realm_data,
+            db_data_fields,
+            image_preview,
+            url_embed_preview,
+        ],
+        option=orjson.OPT_SORT_KEYS,
+    )
+    return rendered_markdown_cache_key(hashlib.sha256(data).hexdigest())
+
+
+def get_cached_rendering(
+    cache_key: str, alert_words_realm_id: Optional[int]
+) -> Tuple[Optional[CachedRendering], Optional[str]]:
+    """Returns the cached render for cache_key, if any, and the alert
+    words version that a new render should be cached under.
+
+    Alert words only affect user_ids_with_alert_words, but an
+    automaton cannot be cheaply hashed, so renders done with the
+    realm's automaton are instead tagged with the realm's alert
+    words version, which is reset whenever its alert words change.
+    """
+    global markdown_cache_hits, markdown_cache_misses
+
+    # cache_set stores values wrapped in a 1-tuple.
+    if alert_words_realm_id is None:
+        alert_words_version = None
+        cached = {cache_key: cache_get(cache_key)}
+    else:
+        version_key = realm_alert_words_version_cache_key(alert_words_realm_id)
+        cached = cache_get_many([version_key, cache_key])
+        if version_key in cached:
+            (alert_words_version,) = cached[version_key]
+        else:
+            alert_words_version = secrets.token_hex(8)
+            cache_set(version_key, alert_words_version, timeout=3600 * 24 * 7)
+
+    if cached.get(cache_key) is not None:
+        (cached_rendering,) = cached[cache_key]
+        if cached_rendering.alert_words_version == alert_words_version:
+            markdown_cache_hits += 1
+            return cached_rendering, alert_words_version
+
+    markdown_cache_misses += 1
+    return None, alert_words_version
+
+
+def cache_rendering(cache_key: str, cached_rendering: CachedRendering) -> None:
+    if len(cached_rendering.rendering_result.rendered_content) > RENDERING_CACHE_MAX_LENGTH:
+        return
+    cache_set(cache_key, cached_rendering, timeout=3600 * 24)
+
+
 # We want to log Markdown parser failures, but shouldn't log the actual input
 # message for privacy reasons.  The compromise is to replace all alphanumeric
 # characters with 'x'.
@@ -2595,6 +2835,7 @@ def do_convert(
     mention_data: Optional[MentionData] = None,
     email_gateway: bool = False,
     no_previews: bool = False,
+    active_realm_emoji: Optional[Dict[str, EmojiInfo]] = None,
 ) -> MessageRenderingResult:
     """Convert Markdown to HTML, with Zulip-specific settings and hacks."""
     # This logic is a bit convoluted, but the overall goal is to support a range of use cases:
@@ -2623,35 +2864,15 @@ def do_convert(
         # delivered via zephyr_mirror
         linkifiers_key = ZEPHYR_MIRROR_MARKDOWN_KEY
 
-    maybe_update_markdown_engines(linkifiers_key, email_gateway)
-    md_engine_key = (linkifiers_key, email_gateway)
-    _md_engine = md_engines[md_engine_key]
-    # Reset the parser; otherwise it will get slower over time.
-    _md_engine.reset()
-
-    # Filters such as UserMentionPattern need a message.
-    rendering_result: MessageRenderingResult = MessageRenderingResult(
-        rendered_content="",
-        mentions_topic_wildcard=False,
-        mentions_stream_wildcard=False,
-        mentions_user_ids=set(),
-        mentions_user_group_ids=set(),
-        alert_words=set(),
-        links_for_preview=set(),
-        user_ids_with_alert_words=set(),
-        potential_attachment_path_ids=[],
-    )
-
-    _md_engine.zulip_message = message
-    _md_engine.zulip_rendering_result = rendering_result
-    _md_engine.zulip_realm = message_realm
-    _md_engine.zulip_db_data = None  # for now
-    _md_engine.image_preview_enabled = image_preview_enabled(message, message_realm, no_previews)
-    _md_engine.url_embed_preview_enabled = url_embed_preview_enabled(
-        message, message_realm, no_previews
-    )
-    _md_engine.url_embed_data = url_embed_data
+    render_pool = get_markdown_render_pool()
+    linkifiers = linkifiers_for_realm(linkifiers_key)
+    if render_pool is None:
+        update_markdown_engines(linkifiers_key, email_gateway, linkifiers)
+    # Otherwise, the engines are updated in the worker process; the
+    # linkifiers are still fetched here, so that the worker only needs
+    # the database for the same things an in-process render does.
 
+    db_data: Optional[DbData] = None
     # Pre-fetch data from the DB that is used in the Markdown thread
     if message_realm is not None:
         # Here we fetch the data structures needed to render
@@ -2667,12 +2888,12 @@ def do_convert(
         stream_names = possible_linked_stream_names(content)
         stream_name_info = mention_data.get_stream_name_map(stream_names)
 
-        if content_has_emoji_syntax(content):
-            active_realm_emoji = get_name_keyed_dict_for_active_realm_emoji(message_realm.id)
-        else:
+        if not content_has_emoji_syntax(content):
             active_realm_emoji = {}
+        elif active_realm_emoji is None:
+            active_realm_emoji = get_name_keyed_dict_for_active_realm_emoji(message_realm.id)
 
-        _md_engine.zulip_db_data = DbData(
+        db_data = DbData(
             realm_alert_words_automaton=realm_alert_words_automaton,
             mention_data=mention_data,
             active_realm_emoji=active_realm_emoji,
@@ -2682,13 +2903,69 @@ def do_convert(
             translate_emoticons=translate_emoticons,
         )
 
+    image_preview = image_preview_enabled(message, message_realm, no_previews)
+    url_embed_preview = url_embed_preview_enabled(message, message_realm, no_previews)
+
+    # Renders are cached by everything that can affect their output,
+    # except for url_embed_data, which is only passed when re-rendering
+    # a message after fetching its previews.  We can only tell whether
+    # a render set message.has_image if it was not already set.
+    rendering_cache_key: Optional[str] = None
+    alert_words_version: Optional[str] = None
+    if (
+        settings.MARKDOWN_RENDER_CACHE
+        and url_embed_data is None
+        and (message is None or not message.has_image)
+    ):
+        rendering_cache_key = get_rendering_cache_key(
+            content,
+            linkifiers_key,
+            email_gateway,
+            linkifiers,
+            message is not None,
+            message_realm,
+            db_data,
+            image_preview,
+            url_embed_preview,
+        )
+        alert_words_realm_id = None
+        if realm_alert_words_automaton is not None and message_realm is not None:
+            alert_words_realm_id = message_realm.id
+        cached_rendering, alert_words_version = get_cached_rendering(
+            rendering_cache_key, alert_words_realm_id
+        )
+        if cached_rendering is not None:
+            if message is not None:
+                message.has_link = cached_rendering.has_link
+                message.has_image = cached_rendering.has_image
+            return cached_rendering.rendering_result
+
+    render_args = (
+        content,
+        (linkifiers_key, email_gateway),
+        message,
+        message_realm,
+        db_data,
+        image_preview,
+        url_embed_preview,
+        url_embed_data,
+    )
+
     try:
-        # Spend at most 5 seconds rendering; this protects the backend
-        # from being overloaded by bugs (e.g. Markdown logic that is
-        # extremely inefficient in corner cases) as well as user
-        # errors (e.g. a linkifier that makes some syntax
-        # infinite-loop).
-        rendering_result.rendered_content = timeout(5, lambda: _md_engine.convert(content))
+        if render_pool is None:
+            # Spend at most 5 seconds rendering; this protects the backend
+            # from being overloaded by bugs (e.g. Markdown logic that is
+            # extremely inefficient in corner cases) as well as user
+            # errors (e.g. a linkifier that makes some syntax
+            # infinite-loop).
+            rendering_result = timeout(5, lambda: render_with_md_engine(*render_args))
+        else:
+            rendering_result, has_link, has_image = render_pool.render(linkifiers, *render_args)
+            if message is not None:
+                # Copy back what the processors set on the worker's
+                # copy of the message.
+                message.has_link = has_link
+                message.has_image = has_image
 
         # Throw an exception if the content is huge; this protects the
         # rest of the codebase from any bugs where we end up rendering
@@ -2698,7 +2975,6 @@ def do_convert(
             raise MarkdownRenderingError(
                 f"Rendered content exceeds {MAX_MESSAGE_LENGTH * 100} characters (message {logging_message_id})"
             )
-        return rendering_result
     except Exception:
         cleaned = privacy_clean_markdown(content)
         markdown_logger.exception(
@@ -2708,6 +2984,58 @@ def do_convert(
         )
 
         raise MarkdownRenderingError
+
+    if rendering_cache_key is not None:
+        cache_rendering(
+            rendering_cache_key,
+            CachedRendering(
+                rendering_result=rendering_result,
+                has_link=message is not None and message.has_link,
+                has_image=message is not None and message.has_image,
+                alert_words_version=alert_words_version,
+            ),
+        )
+    return rendering_result
+
+
+def render_with_md_engine(
+    content: str,
+    md_engine_key: Tuple[int, bool],
+    message: Optional[Message],
+    message_realm: Optional[Realm],
+    db_data: Optional[DbData],
+    image_preview: bool,
+    url_embed_preview: bool,
+    url_embed_data: Optional[Dict[str, Optional[UrlEmbedData]]],
+) -> MessageRenderingResult:
+    _md_engine = md_engines[md_engine_key]
+    # Reset the parser; otherwise it will get slower over time.
+    _md_engine.reset()
+
+    # Filters such as UserMentionPattern need a message.
+    rendering_result: MessageRenderingResult = MessageRenderingResult(
+        rendered_content="",
+        mentions_topic_wildcard=False,
+        mentions_stream_wildcard=False,
+        mentions_user_ids=set(),
+        mentions_user_group_ids=set(),
+        alert_words=set(),
+        links_for_preview=set(),
+        user_ids_with_alert_words=set(),
+        potential_attachment_path_ids=[],
+    )
+
+    _md_engine.zulip_message = message
+    _md_engine.zulip_rendering_result = rendering_result
+    _md_engine.zulip_realm = message_realm
+    _md_engine.zulip_db_data = db_data
+    _md_engine.image_preview_enabled = image_preview
+    _md_engine.url_embed_preview_enabled = url_embed_preview
+    _md_engine.url_embed_data = url_embed_data
+
+    try:
+        rendering_result.rendered_content = _md_engine.convert(content)
+        return rendering_result
     finally:
         # These next three lines are slightly paranoid, since
         # we always set these right before actually using the
@@ -2717,9 +3045,50 @@ def do_convert(
         _md_engine.zulip_db_data = None
 
 
+def render_in_worker(
+    linkifiers: List[LinkifierDict],
+    content: str,
+    md_engine_key: Tuple[int, bool],
+    message: Optional[Message],
+    *args: Any,
+) -> Tuple[MessageRenderingResult, bool, bool]:
+    linkifiers_key, email_gateway = md_engine_key
+    update_markdown_engines(linkifiers_key, email_gateway, linkifiers)
+    rendering_result = render_with_md_engine(content, md_engine_key, message, *args)
+    if message is None:
+        return rendering_result, False, False
+    return rendering_result, message.has_link, message.has_image
+
+
+markdown_render_pool: Optional[RenderPool[Tuple[MessageRenderingResult, bool, bool]]] = None
+
+
+def get_markdown_render_pool() -> Optional[RenderPool[Tuple[MessageRenderingResult, bool, bool]]]:
+    global markdown_render_pool
+    if settings.MARKDOWN_RENDER_PROCESSES == 0:
+        return None
+    if markdown_render_pool is None or markdown_render_pool.pid != os.getpid():
+        # A pool inherited over a fork belongs to the parent process.
+        markdown_render_pool = RenderPool(
+            render_in_worker,
+            num_workers=settings.MARKDOWN_RENDER_PROCESSES,
+            cpu_limit=settings.MARKDOWN_RENDER_CPU_LIMIT,
+            max_renders=settings.MARKDOWN_RENDER_MAX_RENDERS_PER_PROCESS,
+        )
+    return markdown_render_pool
+
+
+def get_markdown_render_pool_stats() -> Optional[RenderPoolStats]:
+    if markdown_render_pool is None or markdown_render_pool.pid != os.getpid():
+        return None
+    return markdown_render_pool.stats
+
+
 markdown_time_start = 0.0
 markdown_total_time = 0.0
 markdown_total_requests = 0
+markdown_cache_hits = 0
+markdown_cache_misses = 0
 
 
 def get_markdown_time() -> float:
@@ -2730,6 +3099,14 @@ def get_markdown_requests() -> int:
     return markdown_total_requests
 
 
+def get_markdown_cache_hits() -> int:
+    return markdown_cache_hits
+
+
+def get_markdown_cache_misses() -> int:
+    return markdown_cache_misses
+
+
 def markdown_stats_start() -> None:
     global markdown_time_start
     markdown_time_start = time.time()
@@ -2753,6 +3130,7 @@ def markdown_convert(
     mention_data: Optional[MentionData] = None,
     email_gateway: bool = False,
     no_previews: bool = False,
+    active_realm_emoji: Optional[Dict[str, EmojiInfo]] = None,
 ) -> MessageRenderingResult:
     markdown_stats_start()
     ret = do_convert(
@@ -2766,6 +3144,7 @@ def markdown_convert(
         mention_data,
         email_gateway,
         no_previews=no_previews,
+        active_realm_emoji=active_realm_emoji,
     )
     markdown_stats_finish()
     return ret
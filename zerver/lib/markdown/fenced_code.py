@@ -90,7 +90,7 @@ from typing_extensions import override
 
 from zerver.lib.exceptions import MarkdownRenderingError
 from zerver.lib.markdown.priorities import PREPROCESSOR_PRIORITES
-from zerver.lib.tex import render_tex
+from zerver.lib.tex import render_tex_many
 
 # Global vars
 FENCE_RE = re.compile(
@@ -545,8 +545,8 @@ class FencedBlockPreprocessor(Preprocessor):
     def format_tex(self, text: str) -> str:
         paragraphs = text.split("\n\n")
         tex_paragraphs = []
-        for paragraph in paragraphs:
-            html = render_tex(paragraph, is_inline=False)
+        rendered = render_tex_many([(paragraph, False) for paragraph in paragraphs])
+        for paragraph, html in zip(paragraphs, rendered):
             if html is not None:
                 tex_paragraphs.append(html)
             else:
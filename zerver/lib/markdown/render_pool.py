@@ -0,0 +1,250 @@
+# A pool of pre-forked worker processes for rendering Markdown.
+#
+# Rendering in-process is protected only by zerver.lib.timeout, which
+# raises an exception in the rendering thread; that cannot interrupt a
+# thread stuck inside a C extension, and a thread that ignores it keeps
+# running in the background.  Rendering in a separate process instead
+# lets us bound each render's CPU time with a SIGPROF timer in the
+# worker, and, as a last resort, kill the worker outright.
+#
+# Workers are forked from the process that owns the pool the first
+# time it renders something, so they share the already-imported code
+# and warm Markdown engines.  Each worker runs one render at a time;
+# requests and results are pickled over a pipe.
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+import traceback
+from dataclasses import dataclass
+from multiprocessing.connection import Connection
+from types import FrameType
+from typing import Any, Callable, Generic, List, Optional, Tuple, TypeVar
+
+from django.db import connections
+from typing_extensions import override
+
+ResultT = TypeVar("ResultT")
+
+render_pool_logger = logging.getLogger("zulip.markdown.render_pool")
+
+# Extra wall-clock time, beyond the CPU limit, that the parent waits
+# for a result before killing the worker; this covers time spent
+# blocked on the network or the database, which the CPU timer does
+# not count.
+WALL_CLOCK_GRACE_SECS = 5
+
+
+class RenderCPULimitExceededError(Exception):
+    @override
+    def __str__(self) -> str:
+        return "Markdown render exceeded its CPU time limit."
+
+
+class RenderWorkerError(Exception):
+    """Raised in the parent when a render fails in a worker process;
+    the message is the formatted traceback from the worker."""
+
+
+class RenderTimeoutError(Exception):
+    @override
+    def __str__(self) -> str:
+        return "Markdown render worker did not respond and was killed."
+
+
+@dataclass
+class RenderPoolStats:
+    renders: int = 0
+    # Callers currently waiting for a free worker.
+    queue_depth: int = 0
+    busy_workers: int = 0
+    cpu_limit_exceeded: int = 0
+    killed_workers: int = 0
+    recycled_workers: int = 0
+
+
+# Connections the worker inherited from its parent.  We hold on to
+# them for the lifetime of the worker, since letting them be garbage
+# collected would send a termination message over a socket the
+# parent is still using.
+inherited_db_connections: List[object] = []
+
+
+def detach_inherited_connections() -> None:  # nocoverage
+    for conn in connections.all(initialized_only=True):
+        if conn.connection is not None:
+            inherited_db_connections.append(conn.connection)
+            conn.connection = None
+
+    # Closing a socket in the child leaves the parent's copy open, so
+    # memcached clients can just be closed; they reconnect on use.
+    from django.core.cache import caches
+
+    for cache in caches.all(initialized_only=True):
+        cache.close()
+
+
+def raise_cpu_limit_exceeded(signum: int, frame: Optional[FrameType]) -> None:  # nocoverage
+    raise RenderCPULimitExceededError
+
+
+def worker_main(
+    connection: Connection, render: Callable[..., Any], cpu_limit: float
+) -> None:  # nocoverage
+    # This and the functions it calls run in the forked worker, whose
+    # coverage is not collected.
+    detach_inherited_connections()
+    # The parent handles interrupts for the whole pool.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGPROF, raise_cpu_limit_exceeded)
+
+    while True:
+        try:
+            args = connection.recv()
+        except EOFError:
+            return
+
+        try:
+            signal.setitimer(signal.ITIMER_PROF, cpu_limit)
+            try:
+                response: Tuple[str, Any] = ("ok", render(*args))
+            finally:
+                signal.setitimer(signal.ITIMER_PROF, 0)
+        except RenderCPULimitExceededError:
+            response = ("cpu_limit", None)
+        except Exception:
+            response = ("error", traceback.format_exc())
+        connection.send(response)
+
+
+class RenderWorker:
+    def __init__(self, render: Callable[..., Any], cpu_limit: float) -> None:
+        context = multiprocessing.get_context("fork")
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(
+            target=worker_main,
+            args=(child_connection, render, cpu_limit),
+            name="markdown-render-worker",
+            daemon=True,
+        )
+        self.process.start()
+        child_connection.close()
+        self.renders = 0
+
+    def stop(self) -> None:
+        self.connection.close()
+        self.process.join(1)
+        if self.process.is_alive():
+            self.kill()
+
+    def kill(self) -> None:
+        self.connection.close()
+        self.process.kill()
+        self.process.join()
+
+
+class RenderPool(Generic[ResultT]):
+    """Runs render(*args) in one of num_workers worker processes.
+
+    Each call gets at most cpu_limit seconds of CPU time; a worker
+    that does not respond within cpu_limit + WALL_CLOCK_GRACE_SECS
+    seconds is killed and replaced.  Workers are also replaced after
+    max_renders renders, which bounds any memory they accumulate.
+    """
+
+    def __init__(
+        self,
+        render: Callable[..., ResultT],
+        num_workers: int,
+        cpu_limit: float,
+        max_renders: int,
+    ) -> None:
+        self.render_function = render
+        self.num_workers = num_workers
+        self.cpu_limit = cpu_limit
+        self.max_renders = max_renders
+        self.pid = os.getpid()
+        self.idle_workers: List[RenderWorker] = []
+        self.num_started_workers = 0
+        self.lock = threading.Condition()
+        self.stats = RenderPoolStats()
+
+    def start_worker(self) -> RenderWorker:
+        return RenderWorker(self.render_function, self.cpu_limit)
+
+    def acquire_worker(self) -> RenderWorker:
+        with self.lock:
+            self.stats.queue_depth += 1
+            try:
+                while not self.idle_workers and self.num_started_workers >= self.num_workers:
+                    self.lock.wait()
+                self.stats.busy_workers += 1
+                if self.idle_workers:
+                    return self.idle_workers.pop()
+                self.num_started_workers += 1
+            finally:
+                self.stats.queue_depth -= 1
+
+        try:
+            return self.start_worker()
+        except BaseException:  # nocoverage
+            self.release_worker(None)
+            raise
+
+    def release_worker(self, worker: Optional[RenderWorker]) -> None:
+        if worker is not None and worker.renders >= self.max_renders:
+            self.stats.recycled_workers += 1
+            worker.stop()
+            worker = None
+
+        with self.lock:
+            self.stats.busy_workers -= 1
+            if worker is None:
+                # A replacement is started lazily, by the next caller
+                # that finds no idle worker.
+                self.num_started_workers -= 1
+            else:
+                self.idle_workers.append(worker)
+            self.lock.notify()
+
+    def render(self, *args: Any) -> ResultT:
+        worker: Optional[RenderWorker] = self.acquire_worker()
+        assert worker is not None
+        try:
+            worker.renders += 1
+            self.stats.renders += 1
+            worker.connection.send(args)
+            if not worker.connection.poll(self.cpu_limit + WALL_CLOCK_GRACE_SECS):
+                render_pool_logger.warning(
+                    "Killing Markdown render worker %d, which did not respond",
+                    worker.process.pid,
+                )
+                self.stats.killed_workers += 1
+                worker.kill()
+                worker = None
+                raise RenderTimeoutError
+            try:
+                status, value = worker.connection.recv()
+            except EOFError:
+                # The worker died mid-render.
+                self.stats.killed_workers += 1
+                worker.kill()
+                worker = None
+                raise RenderWorkerError("Markdown render worker exited unexpectedly")
+        finally:
+            self.release_worker(worker)
+
+        if status == "cpu_limit":
+            self.stats.cpu_limit_exceeded += 1
+            raise RenderCPULimitExceededError
+        if status == "error":
+            raise RenderWorkerError(value)
+        return value
+
+    def shutdown(self) -> None:
+        with self.lock:
+            workers, self.idle_workers = self.idle_workers, []
+            self.num_started_workers -= len(workers)
+        for worker in workers:
+            worker.stop()
@@ -1,11 +1,14 @@
 import functools
 import re
+import secrets
+import time
 from dataclasses import dataclass
-from typing import Dict, List, Match, Optional, Set, Tuple
+from typing import Dict, Iterable, List, Match, Optional, Set, Tuple
 
 from django.conf import settings
 from django.db.models import Q
 
+from zerver.lib.cache import cache_get, cache_set, realm_mention_data_version_cache_key
 from zerver.models import UserGroup, UserProfile, get_linkable_streams
 
 BEFORE_MENTION_ALLOWED_REGEX = r"(?<![^\s\'\"\(\{\[\/<])"
@@ -19,6 +22,13 @@ USER_GROUP_MENTIONS_RE = re.compile(
     rf"{BEFORE_MENTION_ALLOWED_REGEX}@(?P<silent>_?)(\*(?P<match>[^\*]+)\*)"
 )
 
+# How many mention filters we combine into one query when prefetching.
+MENTION_PREFETCH_BATCH_SIZE = 1000
+
+# A bound on how stale a shared RealmMentionCache can get through
+# changes which do not reset the realm's mention data version.
+REALM_MENTION_CACHE_MAX_AGE = 600
+
 topic_wildcards = frozenset(["topic"])
 stream_wildcards = frozenset(["all", "everyone", "stream"])
 
@@ -35,6 +45,18 @@ class UserFilter:
     id: Optional[int]
     full_name: Optional[str]
 
+    def cache_key(self) -> Tuple[Optional[int], Optional[str]]:
+        full_name = self.full_name.lower() if self.full_name is not None else None
+        return (self.id, full_name)
+
+    def matches(self, user: "FullNameInfo") -> bool:
+        # Python equivalent of the filter built by Q, below.
+        if self.id is not None and user.id != self.id:
+            return False
+        if self.full_name is not None and user.full_name.lower() != self.full_name.lower():
+            return False
+        return True
+
     def Q(self) -> Q:
         if self.full_name is not None and self.id is not None:
             return Q(full_name__iexact=self.full_name, id=self.id)
@@ -60,11 +82,83 @@ class PossibleMentions:
     message_has_stream_wildcards: bool
 
 
+class RealmMentionCache:
+    """The users and user groups that mentions in a realm resolved to.
+
+    A MentionBackend normally has its own RealmMentionCache, which
+    lives only as long as it does.  Long-running jobs, like bulk
+    re-rendering, instead share one per realm across all of their
+    batches; see get_realm_mention_backend.
+    """
+
+    def __init__(self, version: Optional[str] = None) -> None:
+        self.version = version
+        self.created = time.monotonic()
+        # Keyed by UserFilter.cache_key().
+        self.users: Dict[Tuple[Optional[int], Optional[str]], List[FullNameInfo]] = {}
+        self.user_groups: Dict[str, Optional[UserGroup]] = {}
+
+
+realm_mention_caches: Dict[int, RealmMentionCache] = {}
+
+
+def get_realm_mention_cache(realm_id: int) -> RealmMentionCache:
+    """Returns the in-process RealmMentionCache for the realm.
+
+    The cache is tagged with the realm's mention data version, which
+    is reset whenever a user's name or active status changes, or a
+    user group or its membership changes, so that all processes stop
+    using their cached lookups for the realm.
+    """
+    version_key = realm_mention_data_version_cache_key(realm_id)
+    cached_version = cache_get(version_key)
+    if cached_version is not None:
+        (version,) = cached_version
+    else:
+        version = secrets.token_hex(8)
+        cache_set(version_key, version, timeout=3600 * 24 * 7)
+
+    mention_cache = realm_mention_caches.get(realm_id)
+    if (
+        mention_cache is None
+        or mention_cache.version != version
+        or time.monotonic() - mention_cache.created > REALM_MENTION_CACHE_MAX_AGE
+    ):
+        mention_cache = RealmMentionCache(version)
+        realm_mention_caches[realm_id] = mention_cache
+    return mention_cache
+
+
 class MentionBackend:
-    def __init__(self, realm_id: int) -> None:
+    def __init__(self, realm_id: int, mention_cache: Optional[RealmMentionCache] = None) -> None:
         self.realm_id = realm_id
         self.user_cache: Dict[Tuple[int, str], FullNameInfo] = {}
         self.stream_cache: Dict[str, int] = {}
+        if mention_cache is None:
+            mention_cache = RealmMentionCache()
+        self.mention_cache = mention_cache
+
+    def prefetch_mention_data(self, contents: Iterable[str]) -> None:
+        """Fetches the users and user groups that any of the contents
+        might mention, so that rendering a batch of messages that share
+        this backend does not need to query the database per message.
+        """
+        mention_texts: Set[str] = set()
+        user_group_names: Set[str] = set()
+        for content in contents:
+            mention_texts |= possible_mentions(content).mention_texts
+            user_group_names |= possible_user_group_mentions(content)
+
+        user_filters = get_user_filters(mention_texts)
+        for i in range(0, len(user_filters), MENTION_PREFETCH_BATCH_SIZE):
+            batch = user_filters[i : i + MENTION_PREFETCH_BATCH_SIZE]
+            user_list = self.fetch_full_name_info_list(batch)
+            for user_filter in batch:
+                self.mention_cache.users[user_filter.cache_key()] = [
+                    user for user in user_list if user_filter.matches(user)
+                ]
+
+        self.get_user_groups(user_group_names)
 
     def get_full_name_info_list(self, user_filters: List[UserFilter]) -> List[FullNameInfo]:
         result: List[FullNameInfo] = []
@@ -75,6 +169,11 @@ class MentionBackend:
         #  - results are the objects we pull from cache
         #  - unseen_user_filters are filters where need to hit the DB
         for user_filter in user_filters:
+            prefetched_users = self.mention_cache.users.get(user_filter.cache_key())
+            if prefetched_users is not None:
+                result += prefetched_users
+                continue
+
             # We expect callers who take advantage of our user_cache to supply both
             # id and full_name in the user mentions in their messages.
             if user_filter.id is not None and user_filter.full_name is not None:
@@ -89,26 +188,12 @@ class MentionBackend:
         # Most of the time, we have to go to the database to get user info,
         # unless our last loop found everything in the cache.
         if unseen_user_filters:
-            q_list = [user_filter.Q() for user_filter in unseen_user_filters]
-
-            rows = (
-                UserProfile.objects.filter(
-                    Q(realm_id=self.realm_id) | Q(email__in=settings.CROSS_REALM_BOT_EMAILS),
-                )
-                .filter(
-                    functools.reduce(lambda a, b: a | b, q_list),
-                )
-                .only(
-                    "id",
-                    "full_name",
-                    "is_active",
-                )
-            )
+            user_list = self.fetch_full_name_info_list(unseen_user_filters)
 
-            user_list = [
-                FullNameInfo(id=row.id, full_name=row.full_name, is_active=row.is_active)
-                for row in rows
-            ]
+            for user_filter in unseen_user_filters:
+                self.mention_cache.users[user_filter.cache_key()] = [
+                    user for user in user_list if user_filter.matches(user)
+                ]
 
             # We expect callers who take advantage of our cache to supply both
             # id and full_name in the user mentions in their messages.
@@ -119,6 +204,53 @@ class MentionBackend:
 
         return result
 
+    def fetch_full_name_info_list(self, user_filters: List[UserFilter]) -> List[FullNameInfo]:
+        q_list = [user_filter.Q() for user_filter in user_filters]
+
+        rows = (
+            UserProfile.objects.filter(
+                Q(realm_id=self.realm_id) | Q(email__in=settings.CROSS_REALM_BOT_EMAILS),
+            )
+            .filter(
+                functools.reduce(lambda a, b: a | b, q_list),
+            )
+            .only(
+                "id",
+                "full_name",
+                "is_active",
+            )
+        )
+
+        return [
+            FullNameInfo(id=row.id, full_name=row.full_name, is_active=row.is_active)
+            for row in rows
+        ]
+
+    def get_user_groups(self, user_group_names: Set[str]) -> List[UserGroup]:
+        """Returns the non-system user groups with these names, with
+        their direct members prefetched."""
+        result: List[UserGroup] = []
+        unseen_user_group_names: Set[str] = set()
+
+        for user_group_name in user_group_names:
+            if user_group_name in self.mention_cache.user_groups:
+                user_group = self.mention_cache.user_groups[user_group_name]
+                if user_group is not None:
+                    result.append(user_group)
+            else:
+                unseen_user_group_names.add(user_group_name)
+
+        if unseen_user_group_names:
+            for user_group_name in unseen_user_group_names:
+                self.mention_cache.user_groups[user_group_name] = None
+            for user_group in UserGroup.objects.filter(
+                realm_id=self.realm_id, name__in=unseen_user_group_names, is_system_group=False
+            ).prefetch_related("direct_members"):
+                self.mention_cache.user_groups[user_group.name] = user_group
+                result.append(user_group)
+
+        return result
+
     def get_stream_name_map(self, stream_names: Set[str]) -> Dict[str, int]:
         if not stream_names:
             return {}
@@ -203,6 +335,10 @@ def get_possible_mentions_info(
     if not mention_texts:
         return []
 
+    return mention_backend.get_full_name_info_list(get_user_filters(mention_texts))
+
+
+def get_user_filters(mention_texts: Set[str]) -> List[UserFilter]:
     user_filters = list()
 
     name_re = r"(?P<full_name>.+)?\|(?P<mention_id>\d+)$"
@@ -222,7 +358,7 @@ def get_possible_mentions_info(
             # For **name** syntax.
             user_filters.append(UserFilter(full_name=mention_text, id=None))
 
-    return mention_backend.get_full_name_info_list(user_filters)
+    return user_filters
 
 
 class MentionData:
@@ -248,9 +384,7 @@ class MentionData:
         self.user_group_members: Dict[int, List[int]] = {}
         user_group_names = possible_user_group_mentions(content)
         if user_group_names:
-            for group in UserGroup.objects.filter(
-                realm_id=realm_id, name__in=user_group_names, is_system_group=False
-            ).prefetch_related("direct_members"):
+            for group in self.mention_backend.get_user_groups(user_group_names):
                 self.user_group_name_info[group.name.lower()] = group
                 self.user_group_members[group.id] = [m.id for m in group.direct_members.all()]
 
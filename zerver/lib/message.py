@@ -30,6 +30,7 @@ from analytics.lib.counts import COUNT_STATS
 from analytics.models import RealmCount
 from zerver.lib.avatar import get_avatar_field
 from zerver.lib.cache import (
+    cache_delete_many,
     cache_set_many,
     cache_with_key,
     generic_bulk_cached_fetch,
@@ -37,10 +38,15 @@ from zerver.lib.cache import (
     to_dict_cache_key_id,
 )
 from zerver.lib.display_recipient import bulk_fetch_display_recipients
-from zerver.lib.exceptions import JsonableError, MissingAuthenticationError
-from zerver.lib.markdown import MessageRenderingResult, markdown_convert, topic_links
+from zerver.lib.exceptions import JsonableError, MarkdownRenderingError, MissingAuthenticationError
+from zerver.lib.markdown import (
+    MessageRenderingResult,
+    markdown_convert,
+    possible_linked_stream_names,
+    topic_links,
+)
 from zerver.lib.markdown import version as markdown_version
-from zerver.lib.mention import MentionData
+from zerver.lib.mention import MentionBackend, MentionData, get_realm_mention_cache
 from zerver.lib.request import RequestVariableConversionError
 from zerver.lib.stream_subscription import (
     get_stream_subscriptions_for_user,
@@ -62,6 +68,7 @@ from zerver.lib.user_groups import is_user_in_group
 from zerver.lib.user_topics import build_get_topic_visibility_policy, get_topic_visibility_policy
 from zerver.models import (
     MAX_TOPIC_NAME_LENGTH,
+    EmojiInfo,
     Message,
     Reaction,
     Realm,
@@ -74,6 +81,7 @@ from zerver.models import (
     UserProfile,
     UserTopic,
     get_display_recipient_by_id,
+    get_name_keyed_dict_for_active_realm_emoji,
     get_usermessage_by_message_id,
     query_for_ids,
 )
@@ -240,7 +248,7 @@ def truncate_topic(topic: str) -> str:
 
 def messages_for_ids(
     message_ids: List[int],
-    user_message_flags: Dict[int, List[str]],
+    user_message_flags: Optional[Dict[int, List[str]]],
     search_fields: Dict[int, Dict[str, str]],
     apply_markdown: bool,
     client_gravatar: bool,
@@ -263,15 +271,18 @@ def messages_for_ids(
 
     for message_id in message_ids:
         msg_dict = message_dicts[message_id]
-        flags = user_message_flags[message_id]
-        # TODO/compatibility: The `wildcard_mentioned` flag was deprecated in favor of
-        # the `stream_wildcard_mentioned` and `topic_wildcard_mentioned` flags.  The
-        # `wildcard_mentioned` flag exists for backwards-compatibility with older
-        # clients.  Remove this when we no longer support legacy clients that have not
-        # been updated to access `stream_wildcard_mentioned`.
-        if "stream_wildcard_mentioned" in flags or "topic_wildcard_mentioned" in flags:
-            flags.append("wildcard_mentioned")
-        msg_dict.update(flags=flags)
+        # Callers which do not need flags pass None, and the
+        # messages are returned without a `flags` field.
+        if user_message_flags is not None:
+            flags = user_message_flags[message_id]
+            # TODO/compatibility: The `wildcard_mentioned` flag was deprecated in favor of
+            # the `stream_wildcard_mentioned` and `topic_wildcard_mentioned` flags.  The
+            # `wildcard_mentioned` flag exists for backwards-compatibility with older
+            # clients.  Remove this when we no longer support legacy clients that have not
+            # been updated to access `stream_wildcard_mentioned`.
+            if "stream_wildcard_mentioned" in flags or "topic_wildcard_mentioned" in flags:
+                flags.append("wildcard_mentioned")
+            msg_dict.update(flags=flags)
         if message_id in search_fields:
             msg_dict.update(search_fields[message_id])
         # Make sure that we never send message edit history to clients
@@ -978,6 +989,7 @@ def render_markdown(
     url_embed_data: Optional[Dict[str, Optional[UrlEmbedData]]] = None,
     mention_data: Optional[MentionData] = None,
     email_gateway: bool = False,
+    active_realm_emoji: Optional[Dict[str, EmojiInfo]] = None,
 ) -> MessageRenderingResult:
     """
     This is basically just a wrapper for do_render_markdown.
@@ -1000,11 +1012,96 @@ def render_markdown(
         url_embed_data=url_embed_data,
         mention_data=mention_data,
         email_gateway=email_gateway,
+        active_realm_emoji=active_realm_emoji,
     )
 
     return rendering_result
 
 
+@dataclass
+class RenderingBatchData:
+    mention_backend: MentionBackend
+    active_realm_emoji: Dict[str, EmojiInfo]
+
+
+def prefetch_rendering_batch_data(realm: Realm, contents: Sequence[str]) -> RenderingBatchData:
+    """Fetches the users, user groups, streams, and emoji that rendering
+    any of the contents might need, in a handful of queries, so that
+    rendering a batch of messages does not query the database per
+    message."""
+    # Jobs that render many batches share their user and user group
+    # lookups across batches, through the realm's mention cache.
+    mention_backend = MentionBackend(realm.id, get_realm_mention_cache(realm.id))
+    mention_backend.prefetch_mention_data(contents)
+
+    stream_names: Set[str] = set()
+    for content in contents:
+        stream_names |= possible_linked_stream_names(content)
+    mention_backend.get_stream_name_map(stream_names)
+
+    return RenderingBatchData(
+        mention_backend=mention_backend,
+        active_realm_emoji=get_name_keyed_dict_for_active_realm_emoji(realm.id),
+    )
+
+
+def render_markdown_batch(
+    realm: Realm,
+    messages: Sequence[Message],
+    contents: Optional[Sequence[str]] = None,
+) -> List[Optional[MessageRenderingResult]]:
+    """
+    Renders a batch of messages from a single realm, as render_markdown
+    does, but fetching the data needed for rendering once for the whole
+    batch.  Messages which fail to render get None.
+    """
+    if contents is None:
+        contents = [message.content for message in messages]
+    batch_data = prefetch_rendering_batch_data(realm, contents)
+
+    rendering_results: List[Optional[MessageRenderingResult]] = []
+    for message, content in zip(messages, contents):
+        try:
+            rendering_result: Optional[MessageRenderingResult] = render_markdown(
+                message,
+                content,
+                realm=realm,
+                mention_data=MentionData(batch_data.mention_backend, content),
+                active_realm_emoji=batch_data.active_realm_emoji,
+            )
+        except MarkdownRenderingError:
+            # do_convert has already logged the error.
+            rendering_result = None
+        rendering_results.append(rendering_result)
+    return rendering_results
+
+
+def rerender_messages(realm: Realm, messages: QuerySet[Message]) -> int:
+    """
+    Re-renders the messages with the current Markdown processor, and
+    saves the results with bulk UPDATEs.  Returns the number of
+    messages which were re-rendered.
+    """
+    message_list = list(messages.filter(realm_id=realm.id).select_related("sender").order_by("id"))
+    rendering_results = render_markdown_batch(realm, message_list)
+
+    rerendered_messages = []
+    for message, rendering_result in zip(message_list, rendering_results):
+        if rendering_result is None:
+            continue
+        message.rendered_content = rendering_result.rendered_content
+        message.rendered_content_version = markdown_version
+        rerendered_messages.append(message)
+
+    # bulk_update does not send post_save, so we need to flush the
+    # cached message dictionaries ourselves.
+    Message.objects.bulk_update(
+        rerendered_messages, ["rendered_content", "rendered_content_version"]
+    )
+    cache_delete_many(to_dict_cache_key_id(message.id) for message in rerendered_messages)
+    return len(rerendered_messages)
+
+
 def huddle_users(recipient_id: int) -> str:
     display_recipient: List[UserDisplayRecipient] = get_display_recipient_by_id(
         recipient_id,
@@ -1,5 +1,7 @@
-import os
+import logging
+import random
 import re
+import time
 from dataclasses import dataclass
 from typing import (
     Any,
@@ -21,10 +23,9 @@ from typing import (
 import orjson
 from django.conf import settings
 from django.core.exceptions import ValidationError
-from django.db import connection
 from django.utils.translation import gettext as _
 from sqlalchemy.dialects import postgresql
-from sqlalchemy.engine import Connection, Row
+from sqlalchemy.engine import Connection, CursorResult, Row
 from sqlalchemy.sql import (
     ClauseElement,
     ColumnElement,
@@ -50,6 +51,7 @@ from zerver.lib.exceptions import ErrorCode, JsonableError
 from zerver.lib.message import get_first_visible_message_id
 from zerver.lib.narrow_helpers import NarrowTerm
 from zerver.lib.recipient_users import recipient_for_user_profiles
+from zerver.lib.search_index import SEARCH_INDEX_MAX_CANDIDATES, get_search_index
 from zerver.lib.sqlalchemy_utils import get_sqlalchemy_connection
 from zerver.lib.streams import (
     can_access_stream_history_by_id,
@@ -66,6 +68,7 @@ from zerver.lib.topic import (
     topic_match_sa,
 )
 from zerver.lib.types import Validator
+from zerver.lib.unread_index import get_unread_candidates
 from zerver.lib.user_topics import exclude_topic_mutes
 from zerver.lib.validator import (
     check_bool,
@@ -87,19 +90,7 @@ from zerver.models import (
     get_user_including_cross_realm,
 )
 
-stop_words_list: Optional[List[str]] = None
-
-
-def read_stop_words() -> List[str]:
-    global stop_words_list
-    if stop_words_list is None:
-        file_path = os.path.join(
-            settings.DEPLOY_ROOT, "puppet/zulip/files/postgresql/zulip_english.stop"
-        )
-        with open(file_path) as f:
-            stop_words_list = f.read().splitlines()
-
-    return stop_words_list
+slow_query_logger = logging.getLogger("zulip.slow_queries")
 
 
 def check_narrow_for_events(narrow: Collection[NarrowTerm]) -> None:
@@ -139,6 +130,74 @@ class NarrowPredicate(Protocol):
         ...
 
 
+NarrowTermCheck: TypeAlias = Callable[[Dict[str, Any], List[str]], bool]
+
+
+def build_narrow_term_check(*, operator: str, operand: str) -> Optional[NarrowTermCheck]:
+    """Returns a function checking whether a message satisfies a
+    single narrow term, or None if every message does.  Operands are
+    normalized here, once, rather than for every message checked."""
+    if operator == "stream":
+        stream_name = operand.lower()
+
+        def check_stream(message: Dict[str, Any], flags: List[str]) -> bool:
+            return (
+                message["type"] == "stream" and message["display_recipient"].lower() == stream_name
+            )
+
+        return check_stream
+    elif operator == "topic":
+        topic_name = operand.lower()
+
+        def check_topic(message: Dict[str, Any], flags: List[str]) -> bool:
+            return (
+                message["type"] == "stream"
+                and get_topic_from_message_info(message).lower() == topic_name
+            )
+
+        return check_topic
+    elif operator == "sender":
+        sender_email = operand.lower()
+
+        def check_sender(message: Dict[str, Any], flags: List[str]) -> bool:
+            return message["sender_email"].lower() == sender_email
+
+        return check_sender
+    elif operator == "is" and operand in ["dm", "private"]:
+        # "is:private" is a legacy alias for "is:dm"
+        def check_dm(message: Dict[str, Any], flags: List[str]) -> bool:
+            return message["type"] == "private"
+
+        return check_dm
+    elif operator == "is" and operand in ["starred"]:
+
+        def check_starred(message: Dict[str, Any], flags: List[str]) -> bool:
+            return "starred" in flags
+
+        return check_starred
+    elif operator == "is" and operand == "unread":
+
+        def check_unread(message: Dict[str, Any], flags: List[str]) -> bool:
+            return "read" not in flags
+
+        return check_unread
+    elif operator == "is" and operand in ["alerted", "mentioned"]:
+
+        def check_mentioned(message: Dict[str, Any], flags: List[str]) -> bool:
+            return "mentioned" in flags
+
+        return check_mentioned
+    elif operator == "is" and operand == "resolved":
+
+        def check_resolved(message: Dict[str, Any], flags: List[str]) -> bool:
+            return message["type"] == "stream" and get_topic_from_message_info(message).startswith(
+                RESOLVED_TOPIC_PREFIX
+            )
+
+        return check_resolved
+    return None
+
+
 def build_narrow_predicate(
     narrow: Collection[NarrowTerm],
 ) -> NarrowPredicate:
@@ -146,55 +205,28 @@ def build_narrow_predicate(
     NarrowLibraryTest."""
     check_narrow_for_events(narrow)
 
-    def narrow_predicate(*, message: Dict[str, Any], flags: List[str]) -> bool:
-        def satisfies_operator(*, operator: str, operand: str) -> bool:
-            if operator == "stream":
-                if message["type"] != "stream":
-                    return False
-                if operand.lower() != message["display_recipient"].lower():
-                    return False
-            elif operator == "topic":
-                if message["type"] != "stream":
-                    return False
-                topic_name = get_topic_from_message_info(message)
-                if operand.lower() != topic_name.lower():
-                    return False
-            elif operator == "sender":
-                if operand.lower() != message["sender_email"].lower():
-                    return False
-            elif operator == "is" and operand in ["dm", "private"]:
-                # "is:private" is a legacy alias for "is:dm"
-                if message["type"] != "private":
-                    return False
-            elif operator == "is" and operand in ["starred"]:
-                if operand not in flags:
-                    return False
-            elif operator == "is" and operand == "unread":
-                if "read" in flags:
-                    return False
-            elif operator == "is" and operand in ["alerted", "mentioned"]:
-                if "mentioned" not in flags:
-                    return False
-            elif operator == "is" and operand == "resolved":
-                if message["type"] != "stream":
-                    return False
-                topic_name = get_topic_from_message_info(message)
-                if not topic_name.startswith(RESOLVED_TOPIC_PREFIX):
-                    return False
-            return True
-
-        for narrow_term in narrow:
-            # TODO: Eventually handle negated narrow terms.
-            if not satisfies_operator(operator=narrow_term.operator, operand=narrow_term.operand):
-                return False
+    term_checks: List[NarrowTermCheck] = []
+    for narrow_term in narrow:
+        # TODO: Eventually handle negated narrow terms.
+        term_check = build_narrow_term_check(
+            operator=narrow_term.operator, operand=narrow_term.operand
+        )
+        if term_check is not None:
+            term_checks.append(term_check)
 
-        return True
+    def narrow_predicate(*, message: Dict[str, Any], flags: List[str]) -> bool:
+        return all(term_check(message, flags) for term_check in term_checks)
 
     return narrow_predicate
 
 
 LARGER_THAN_MAX_MESSAGE_ID = 10000000000000000
 
+# How many candidates for the first unread message in a narrow we
+# check, from the user's index of unread messages, before falling
+# back to searching all of their unread messages.
+MAX_UNREAD_CANDIDATES = 100
+
 
 class BadNarrowOperatorError(JsonableError):
     code = ErrorCode.BAD_NARROW
@@ -698,11 +730,35 @@ class NarrowBuilder:
         return query.where(maybe_negate(cond))
 
     def by_search(self, query: Select, operand: str, maybe_negate: ConditionTransform) -> Select:
+        # A search which matches too many messages to intersect with
+        # the query cheaply is left to PostgreSQL.
+        search_index = get_search_index()
+        if search_index is not None:
+            message_ids = search_index.search(
+                self.realm.id, operand, SEARCH_INDEX_MAX_CANDIDATES + 1
+            )
+            if message_ids is not None and len(message_ids) <= SEARCH_INDEX_MAX_CANDIDATES:
+                return self._by_search_index(query, operand, message_ids, maybe_negate)
+
         if settings.USING_PGROONGA:
             return self._by_search_pgroonga(query, operand, maybe_negate)
         else:
             return self._by_search_tsearch(query, operand, maybe_negate)
 
+    def _by_search_index(
+        self,
+        query: Select,
+        operand: str,
+        message_ids: List[int],
+        maybe_negate: ConditionTransform,
+    ) -> Select:
+        # The index only gives us candidates; intersecting them with
+        # the query keeps the security invariant.  We still highlight
+        # the matches, in just the rows returned, with PostgreSQL.
+        query = self._add_tsearch_match_columns(query, self._tsearch_tsquery(operand))
+        cond = self.msg_id_column.in_(message_ids)
+        return query.where(maybe_negate(cond))
+
     def _by_search_pgroonga(
         self, query: Select, operand: str, maybe_negate: ConditionTransform
     ) -> Select:
@@ -721,11 +777,8 @@ class NarrowBuilder:
         condition = column("search_pgroonga", Text).op("&@~")(operand_escaped)
         return query.where(maybe_negate(condition))
 
-    def _by_search_tsearch(
-        self, query: Select, operand: str, maybe_negate: ConditionTransform
-    ) -> Select:
-        tsquery = func.plainto_tsquery(literal("zulip.english_us_search"), literal(operand))
-        query = query.add_columns(
+    def _add_tsearch_match_columns(self, query: Select, tsquery: ColumnElement[Any]) -> Select:
+        return query.add_columns(
             ts_locs_array(
                 literal("zulip.english_us_search", Text), column("rendered_content", Text), tsquery
             ).label("content_matches"),
@@ -737,19 +790,29 @@ class NarrowBuilder:
             ).label("topic_matches"),
         )
 
-        # Do quoted string matching.  We really want phrase
-        # search here so we can ignore punctuation and do
-        # stemming, but there isn't a standard phrase search
-        # mechanism in PostgreSQL
+    def _tsearch_tsquery(self, operand: str) -> ColumnElement[Any]:
+        tsquery: ColumnElement[Any] = func.plainto_tsquery(
+            literal("zulip.english_us_search"), literal(operand)
+        )
+
+        # Quoted terms must also match as phrases: the same words, in
+        # order, after stemming and ignoring punctuation and stop
+        # words.  Folding them into the tsquery lets the
+        # search_tsvector index check them, rather than scanning the
+        # content of every candidate row, and highlights the phrases.
         for term in re.findall(r'"[^"]+"|\S+', operand):
             if term[0] == '"' and term[-1] == '"':
-                term = term[1:-1]
-                term = "%" + connection.ops.prep_for_like_query(term) + "%"
-                cond: ClauseElement = or_(
-                    column("content", Text).ilike(term), topic_column_sa().ilike(term)
+                phrase_tsquery = func.phraseto_tsquery(
+                    literal("zulip.english_us_search"), literal(term[1:-1])
                 )
-                query = query.where(maybe_negate(cond))
+                tsquery = tsquery.op("&&")(phrase_tsquery)
+        return tsquery
 
+    def _by_search_tsearch(
+        self, query: Select, operand: str, maybe_negate: ConditionTransform
+    ) -> Select:
+        tsquery = self._tsearch_tsquery(operand)
+        query = self._add_tsearch_match_columns(query, tsquery)
         cond = column("search_tsvector", postgresql.TSVECTOR).op("@@")(tsquery)
         return query.where(maybe_negate(cond))
 
@@ -1053,6 +1116,24 @@ def find_first_unread_anchor(
 
     first_unread_query = query.where(condition)
     first_unread_query = first_unread_query.order_by(inner_msg_id_col.asc()).limit(1)
+
+    # For common narrows, the user's index of unread messages gives us
+    # a few candidates for the first unread message, so we only need
+    # to check those, and any messages past the index's watermark,
+    # rather than every unread message the user has.
+    unread_candidates = get_unread_candidates(user_profile, narrow, MAX_UNREAD_CANDIDATES)
+    if unread_candidates is not None:
+        candidate_ids, more_candidates, watermark = unread_candidates
+        candidate_condition = inner_msg_id_col.in_(candidate_ids)
+        if not more_candidates:
+            candidate_condition = or_(candidate_condition, inner_msg_id_col > watermark)
+        candidate_query = first_unread_query.where(candidate_condition)
+        first_unread_result = list(sa_conn.execute(candidate_query).fetchall())
+        if len(first_unread_result) > 0:
+            return first_unread_result[0][0]
+        if not more_candidates:
+            return LARGER_THAN_MAX_MESSAGE_ID
+
     first_unread_result = list(sa_conn.execute(first_unread_query).fetchall())
     if len(first_unread_result) > 0:
         anchor = first_unread_result[0][0]
@@ -1268,6 +1349,48 @@ class FetchedMessages(LimitedMessages[Row]):
     is_search: bool
 
 
+def narrow_log_string(narrow: OptionalNarrowListT) -> str:
+    """A summary of the narrow's operators, for logs; `is:` operators
+    include their operand, since each selects a very different query."""
+    verbose_operators = []
+    for term in narrow or []:
+        if term["operator"] == "is":
+            verbose_operators.append("is:" + term["operand"])
+        else:
+            verbose_operators.append(term["operator"])
+    return "[{}]".format(",".join(verbose_operators))
+
+
+def maybe_explain_narrow_query(
+    sa_conn: Connection,
+    result: CursorResult,
+    narrow: OptionalNarrowListT,
+    include_history: bool,
+    duration: float,
+) -> None:
+    """Logs the query plan for a sample of slow narrow queries, per
+    NARROW_EXPLAIN_SAMPLE_RATE; this runs the query a second time."""
+    if duration < settings.NARROW_EXPLAIN_MIN_DURATION:
+        return
+    if random.random() >= settings.NARROW_EXPLAIN_SAMPLE_RATE:
+        return
+
+    # SQLAlchemy compiles each shape of query once, and binds the
+    # parameters on each execution; we explain exactly the statement
+    # and parameters which were executed.
+    context = result.context
+    plan_rows = sa_conn.exec_driver_sql(
+        "EXPLAIN (ANALYZE, BUFFERS) " + context.statement, context.parameters[0]
+    ).fetchall()
+    slow_query_logger.info(
+        "Narrow query %s (include_history=%s) took %.3fs:\n%s",
+        narrow_log_string(narrow),
+        include_history,
+        duration,
+        "\n".join(row[0] for row in plan_rows),
+    )
+
+
 def fetch_messages(
     *,
     narrow: OptionalNarrowListT,
@@ -1357,7 +1480,12 @@ def fetch_messages(
         )
         # This is a hack to tag the query we use for testing
         query = query.prefix_with("/* get_messages */")
-        rows = list(sa_conn.execute(query).fetchall())
+        start_time = time.monotonic()
+        result = sa_conn.execute(query)
+        rows = list(result.fetchall())
+        maybe_explain_narrow_query(
+            sa_conn, result, narrow, include_history, time.monotonic() - start_time
+        )
 
     query_info = post_process_limited_query(
         rows=rows,
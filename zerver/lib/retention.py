@@ -39,6 +39,8 @@ from psycopg2.sql import SQL, Composable, Identifier, Literal
 
 from zerver.lib.logging_util import log_to_file
 from zerver.lib.request import RequestVariableConversionError
+from zerver.lib.search_index import queue_search_index_update
+from zerver.lib.unread_index import discard_unread_indexes_for_messages
 from zerver.models import (
     ArchivedAttachment,
     ArchivedReaction,
@@ -585,6 +587,8 @@ def restore_data_from_archive(archive_transaction: ArchiveTransaction) -> int:
         restore_models_with_message_key_from_archive(archive_transaction.id)
         restore_attachments_from_archive(archive_transaction.id)
         restore_attachment_messages_from_archive(archive_transaction.id)
+        discard_unread_indexes_for_messages(msg_ids)
+        queue_search_index_update(msg_ids)
 
         archive_transaction.restored = True
         archive_transaction.save()
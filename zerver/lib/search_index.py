@@ -0,0 +1,219 @@
+import os
+import re
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from typing import Callable, Collection, Dict, Iterable, List, Optional, Tuple
+
+from django.conf import settings
+
+from zerver.lib.queue import queue_event_on_commit
+from zerver.lib.topic import DB_TOPIC_NAME
+from zerver.models import Message
+
+# A search index answers `search:` narrows with a list of candidate
+# message IDs, which NarrowBuilder intersects with the rest of the
+# narrow in SQL; it never decides on its own which messages a user
+# may see.  If a search matches more than this many messages in the
+# realm, we cannot intersect them cheaply, and fall back to searching
+# in PostgreSQL.
+SEARCH_INDEX_MAX_CANDIDATES = 10000
+
+INDEX_BATCH_SIZE = 1000
+
+
+stop_words_list: Optional[List[str]] = None
+
+
+def read_stop_words() -> List[str]:
+    global stop_words_list
+    if stop_words_list is None:
+        file_path = os.path.join(
+            settings.DEPLOY_ROOT, "puppet/zulip/files/postgresql/zulip_english.stop"
+        )
+        with open(file_path) as f:
+            stop_words_list = f.read().splitlines()
+
+    return stop_words_list
+
+
+@dataclass
+class IndexedMessage:
+    id: int
+    realm_id: int
+    topic: str
+    rendered_content: Optional[str]
+
+
+def rendered_content_text(rendered_content: Optional[str]) -> str:
+    if not rendered_content or rendered_content.isspace():
+        return ""
+
+    # We import lxml here, because only the search_index worker
+    # needs it, and this module is imported by every server process.
+    from lxml import html
+
+    return html.fragment_fromstring(rendered_content, create_parent=True).text_content()
+
+
+def search_terms(operand: str) -> List[Tuple[str, bool]]:
+    """Splits a search operand into its words and "quoted phrases",
+    as the PostgreSQL search does, returning (text, is_phrase) pairs.
+    Terms without any word characters cannot match anything, and
+    are dropped."""
+    terms = []
+    for term in re.findall(r'"[^"]+"|\S+', operand):
+        is_phrase = term[0] == '"' and term[-1] == '"' and len(term) > 1
+        if is_phrase:
+            term = term[1:-1]
+        if re.search(r"\w", term):
+            terms.append((term, is_phrase))
+    return terms
+
+
+class SearchIndex(ABC):
+    """A full-text index of messages, kept outside PostgreSQL.
+
+    The index is kept up to date by the search_index queue worker, so
+    it lags for a moment behind messages being sent, edited, and
+    deleted.  Deleted messages which linger in it are harmless, since
+    the narrow's SQL query does not find them.
+    """
+
+    @abstractmethod
+    def index_messages(self, messages: Collection[IndexedMessage]) -> None:
+        pass
+
+    @abstractmethod
+    def remove_messages(self, message_ids: Collection[int]) -> None:
+        pass
+
+    @abstractmethod
+    def search(self, realm_id: int, operand: str, limit: int) -> Optional[List[int]]:
+        """Returns the IDs of the most recent `limit` messages in the
+        realm that match the operand, or None if the index cannot
+        answer the search.  This must match the same messages as the
+        PostgreSQL search would, since which of the two answers a
+        search depends on how many messages it matches: words match
+        by their stems, ignoring stop words, and quoted phrases as
+        phrases."""
+
+
+class SqliteSearchIndex(SearchIndex):
+    """A search index in a local SQLite database, using its FTS5
+    full-text search extension with the Porter stemmer, which natively
+    supports phrase queries.  Each thread uses its own connection;
+    SQLite's write-ahead log lets processes search while the worker
+    writes.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.local = threading.local()
+
+    def get_connection(self) -> sqlite3.Connection:
+        # A connection inherited across a fork must not be used.
+        if getattr(self.local, "pid", None) != os.getpid():
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS messages USING fts5("
+                "topic, content, realm_id UNINDEXED,"
+                " tokenize='porter unicode61 remove_diacritics 2')"
+            )
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return self.local.connection
+
+    def index_messages(self, messages: Collection[IndexedMessage]) -> None:
+        connection = self.get_connection()
+        with connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO messages (rowid, topic, content, realm_id)"
+                " VALUES (?, ?, ?, ?)",
+                [
+                    (
+                        message.id,
+                        message.topic,
+                        rendered_content_text(message.rendered_content),
+                        message.realm_id,
+                    )
+                    for message in messages
+                ],
+            )
+
+    def remove_messages(self, message_ids: Collection[int]) -> None:
+        connection = self.get_connection()
+        with connection:
+            connection.executemany(
+                "DELETE FROM messages WHERE rowid = ?",
+                [(message_id,) for message_id in message_ids],
+            )
+
+    def search(self, realm_id: int, operand: str, limit: int) -> Optional[List[int]]:
+        stop_words = set(read_stop_words())
+        terms = [
+            (text, is_phrase)
+            for text, is_phrase in search_terms(operand)
+            if is_phrase or text.lower() not in stop_words
+        ]
+        if not terms:
+            return None
+
+        # FTS5 query strings quote each term, doubling any quotes in it.
+        match = " AND ".join('"' + text.replace('"', '""') + '"' for text, is_phrase in terms)
+        rows = self.get_connection().execute(
+            "SELECT rowid FROM messages WHERE messages MATCH ? AND realm_id = ?"
+            " ORDER BY rowid DESC LIMIT ?",
+            (match, realm_id, limit),
+        )
+        return [message_id for (message_id,) in rows]
+
+
+# Maps each SEARCH_INDEX_BACKEND to a function from SEARCH_INDEX_PATH
+# to the index.
+SEARCH_INDEX_BACKENDS: Dict[str, Callable[[str], SearchIndex]] = {
+    "sqlite": SqliteSearchIndex,
+}
+
+search_indexes: Dict[Tuple[str, str], SearchIndex] = {}
+
+
+def get_search_index() -> Optional[SearchIndex]:
+    """Returns the configured SEARCH_INDEX_BACKEND, or None if
+    searches use PostgreSQL's full-text search."""
+    if settings.SEARCH_INDEX_BACKEND is None:
+        return None
+    key = (settings.SEARCH_INDEX_BACKEND, settings.SEARCH_INDEX_PATH)
+    if key not in search_indexes:
+        make_search_index = SEARCH_INDEX_BACKENDS[settings.SEARCH_INDEX_BACKEND]
+        search_indexes[key] = make_search_index(settings.SEARCH_INDEX_PATH)
+    return search_indexes[key]
+
+
+def queue_search_index_update(message_ids: List[int]) -> None:
+    """Queues the messages to be (re-)indexed, once the current
+    transaction commits."""
+    if settings.SEARCH_INDEX_BACKEND is not None:
+        queue_event_on_commit("search_index", {"message_ids": message_ids})
+
+
+def update_search_index(search_index: SearchIndex, message_ids: Iterable[int]) -> None:
+    """Brings the index up to date for the messages, removing any
+    which no longer exist."""
+    message_id_set = set(message_ids)
+    messages = [
+        IndexedMessage(
+            id=row["id"],
+            realm_id=row["realm_id"],
+            topic=row[DB_TOPIC_NAME],
+            rendered_content=row["rendered_content"],
+        )
+        for row in Message.objects.filter(id__in=message_id_set).values(
+            "id", "realm_id", DB_TOPIC_NAME, "rendered_content"
+        )
+    ]
+    search_index.index_messages(messages)
+    search_index.remove_messages(message_id_set - {message.id for message in messages})
@@ -11,6 +11,7 @@ from sentry_sdk import capture_exception
 
 from zerver.lib.logging_util import log_to_file
 from zerver.lib.queue import queue_json_publish
+from zerver.lib.unread_index import discard_unread_indexes
 from zerver.lib.utils import assert_is_not_none
 from zerver.models import (
     Message,
@@ -242,6 +243,11 @@ def add_missing_messages(user_profile: UserProfile) -> None:
         user_profile, stream_messages, all_stream_subscription_logs
     )
 
+    # The new rows are older than messages in the user's index of
+    # unread messages, which would otherwise skip them.
+    if user_messages_to_insert:
+        discard_unread_indexes([user_profile.id])
+
     # Doing a bulk create for all the UserMessage objects stored for creation.
     while len(user_messages_to_insert) > 0:
         messages, user_messages_to_insert = (
@@ -1,12 +1,20 @@
 import itertools
+import secrets
 from collections import defaultdict
 from dataclasses import dataclass
 from operator import itemgetter
-from typing import AbstractSet, Any, Collection, Dict, List, Optional, Set
+from typing import AbstractSet, Any, Collection, Dict, List, Mapping, NamedTuple, Optional, Set
 
 from django.db.models import Q, QuerySet
 from django_stubs_ext import ValuesQuerySet
 
+from zerver.lib.alert_words import alert_words_in_realm_by_id
+from zerver.lib.cache import (
+    cache_get_many,
+    cache_set,
+    realm_subscriber_settings_version_cache_key,
+    stream_subscriber_settings_cache_key,
+)
 from zerver.models import AlertWord, Realm, Recipient, Stream, Subscription, UserProfile, UserTopic
 
 
@@ -287,15 +295,112 @@ def subscriber_ids_with_stream_history_access(stream: Stream) -> Set[int]:
     )
 
 
+class SubscriberNotificationSettings(NamedTuple):
+    user_profile_id: int
+    is_muted: bool
+    long_term_idle: bool
+    # Stream-specific settings, which override the user's global
+    # settings below unless they are None.
+    push_notifications: Optional[bool]
+    email_notifications: Optional[bool]
+    wildcard_mentions_notify: Optional[bool]
+    user_profile_push_notifications: bool
+    user_profile_email_notifications: bool
+    user_profile_wildcard_mentions_notify: bool
+    followed_topic_push_notifications: bool
+    followed_topic_email_notifications: bool
+    followed_topic_wildcard_mentions_notify: bool
+
+
+# Streams with more subscribers than this are not cached, since their
+# entries would approach memcached's 1MB limit on the size of an item;
+# see get_subscriptions_for_send_message.
+STREAM_SUBSCRIBER_SETTINGS_CACHE_MAX_SIZE = 10000
+
+
+def get_subscriber_settings_query(recipient_id: int) -> QuerySet[Subscription]:
+    return Subscription.objects.filter(
+        recipient_id=recipient_id,
+        active=True,
+        is_user_active=True,
+    ).order_by("user_profile_id")
+
+
+def subscriber_settings_from_query(
+    query: QuerySet[Subscription], limit: Optional[int] = None
+) -> List[SubscriberNotificationSettings]:
+    rows = query.values_list(
+        "user_profile_id",
+        "is_muted",
+        "user_profile__long_term_idle",
+        "push_notifications",
+        "email_notifications",
+        "wildcard_mentions_notify",
+        "user_profile__enable_stream_push_notifications",
+        "user_profile__enable_stream_email_notifications",
+        "user_profile__wildcard_mentions_notify",
+        "user_profile__enable_followed_topic_push_notifications",
+        "user_profile__enable_followed_topic_email_notifications",
+        "user_profile__enable_followed_topic_wildcard_mentions_notify",
+    )
+    if limit is not None:
+        rows = rows[:limit]
+    return [SubscriberNotificationSettings(*row) for row in rows]
+
+
+def get_stream_subscriber_settings(
+    realm_id: int, recipient_id: int
+) -> Optional[List[SubscriberNotificationSettings]]:
+    """Returns the notification settings of all active subscribers of
+    the stream with the given recipient, ordered by user ID, or None if
+    the stream has more than STREAM_SUBSCRIBER_SETTINGS_CACHE_MAX_SIZE
+    subscribers.
+
+    These are needed for every message sent to the stream, but rarely
+    change, so they are cached.  Saving a Subscription deletes the
+    stream's entry.  Since a change to one of a user's settings affects
+    every stream they are subscribed to, such changes instead delete
+    the realm's version key; an entry is only used if it was computed
+    under the realm's current version.  Both are deleted again when
+    the change commits, in case a message sent in the meantime cached
+    the old settings.  For streams which are too
+    large, we cache None, so that we don't fetch their subscribers
+    only to discard them on every message.
+    """
+    version_key = realm_subscriber_settings_version_cache_key(realm_id)
+    settings_key = stream_subscriber_settings_cache_key(recipient_id)
+    cached = cache_get_many([version_key, settings_key])
+
+    if version_key not in cached:
+        version = secrets.token_hex(8)
+        cache_set(version_key, version, timeout=3600 * 24 * 7)
+    else:
+        version = cached[version_key][0]
+        if settings_key in cached:
+            cached_version, subscriber_settings = cached[settings_key][0]
+            if cached_version == version:
+                return subscriber_settings
+
+    subscriber_settings = subscriber_settings_from_query(
+        get_subscriber_settings_query(recipient_id),
+        limit=STREAM_SUBSCRIBER_SETTINGS_CACHE_MAX_SIZE + 1,
+    )
+    if len(subscriber_settings) > STREAM_SUBSCRIBER_SETTINGS_CACHE_MAX_SIZE:
+        cache_set(settings_key, (version, None), timeout=3600 * 24 * 7)
+        return None
+    cache_set(settings_key, (version, subscriber_settings), timeout=3600 * 24 * 7)
+    return subscriber_settings
+
+
 def get_subscriptions_for_send_message(
     *,
     realm_id: int,
-    stream_id: int,
-    topic_name: str,
+    recipient_id: int,
     possible_stream_wildcard_mention: bool,
     topic_participant_user_ids: AbstractSet[int],
     possibly_mentioned_user_ids: AbstractSet[int],
-) -> QuerySet[Subscription]:
+    user_id_to_visibility_policy: Mapping[int, int],
+) -> List[SubscriberNotificationSettings]:
     """This function optimizes an important use case for large
     streams. Open realms often have many long_term_idle users, which
     can result in 10,000s of long_term_idle recipients in default
@@ -303,10 +408,10 @@ def get_subscriptions_for_send_message(
     for long_term_idle unless message flags or notifications should be
     generated.
 
-    However, it's expensive even to fetch and process them all in
-    Python at all. This function returns all recipients of a stream
-    message that could possibly require action in the send-message
-    codepath.
+    However, it's expensive even to process them all in Python at
+    all. This function returns the settings of all recipients of a
+    stream message that could possibly require action in the
+    send-message codepath.
 
     Basically, it returns all subscribers, excluding all long-term
     idle users who it can prove will not receive a UserMessage row or
@@ -324,33 +429,66 @@ def get_subscriptions_for_send_message(
     parsed the message, will do the precise determination.
     """
 
-    query = get_active_subscriptions_for_stream_id(
-        stream_id,
-        include_deactivated_users=False,
-    )
+    subscriber_settings = get_stream_subscriber_settings(realm_id, recipient_id)
+    if subscriber_settings is None:
+        # The stream is too large to cache, so we filter out the
+        # long-term idle users in the database instead.
+        query = get_subscriber_settings_query(recipient_id)
+        if not possible_stream_wildcard_mention:
+            followed_user_ids = [
+                user_id
+                for user_id, visibility_policy in user_id_to_visibility_policy.items()
+                if visibility_policy == UserTopic.VisibilityPolicy.FOLLOWED
+            ]
+            query = query.filter(
+                Q(user_profile__long_term_idle=False)
+                | Q(push_notifications=True)
+                | (
+                    Q(push_notifications=None)
+                    & Q(user_profile__enable_stream_push_notifications=True)
+                )
+                | Q(email_notifications=True)
+                | (
+                    Q(email_notifications=None)
+                    & Q(user_profile__enable_stream_email_notifications=True)
+                )
+                | Q(user_profile_id__in=possibly_mentioned_user_ids)
+                | Q(user_profile_id__in=topic_participant_user_ids)
+                | Q(
+                    user_profile_id__in=AlertWord.objects.filter(realm_id=realm_id).values_list(
+                        "user_profile_id"
+                    )
+                )
+                | Q(user_profile_id__in=followed_user_ids)
+            )
+        return subscriber_settings_from_query(query)
 
     if possible_stream_wildcard_mention:
-        return query
-
-    query = query.filter(
-        Q(user_profile__long_term_idle=False)
-        | Q(push_notifications=True)
-        | (Q(push_notifications=None) & Q(user_profile__enable_stream_push_notifications=True))
-        | Q(email_notifications=True)
-        | (Q(email_notifications=None) & Q(user_profile__enable_stream_email_notifications=True))
-        | Q(user_profile_id__in=possibly_mentioned_user_ids)
-        | Q(user_profile_id__in=topic_participant_user_ids)
-        | Q(
-            user_profile_id__in=AlertWord.objects.filter(realm_id=realm_id).values_list(
-                "user_profile_id"
-            )
-        )
-        | Q(
-            user_profile_id__in=UserTopic.objects.filter(
-                stream_id=stream_id,
-                topic_name__iexact=topic_name,
-                visibility_policy=UserTopic.VisibilityPolicy.FOLLOWED,
-            ).values_list("user_profile_id")
-        )
-    )
-    return query
+        return subscriber_settings
+
+    alert_word_user_ids: Optional[AbstractSet[int]] = None
+
+    def is_possible_recipient(row: SubscriberNotificationSettings) -> bool:
+        nonlocal alert_word_user_ids
+
+        if (
+            not row.long_term_idle
+            or row.push_notifications
+            or (row.push_notifications is None and row.user_profile_push_notifications)
+            or row.email_notifications
+            or (row.email_notifications is None and row.user_profile_email_notifications)
+            or row.user_profile_id in possibly_mentioned_user_ids
+            or row.user_profile_id in topic_participant_user_ids
+            or user_id_to_visibility_policy.get(row.user_profile_id)
+            == UserTopic.VisibilityPolicy.FOLLOWED
+        ):
+            return True
+
+        # Only fetch the realm's alert words if some subscriber is
+        # long-term idle and has none of the above reasons to be
+        # included.
+        if alert_word_user_ids is None:
+            alert_word_user_ids = alert_words_in_realm_by_id(realm_id).keys()
+        return row.user_profile_id in alert_word_user_ids
+
+    return [row for row in subscriber_settings if is_possible_recipient(row)]
@@ -296,6 +296,8 @@ Output:
         """
         if not url.startswith(("/json", "/api/v1")):
             return
+        if result.streaming:
+            return
         try:
             content = orjson.loads(result.content)
         except orjson.JSONDecodeError:
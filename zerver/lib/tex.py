@@ -1,12 +1,190 @@
 import logging
 import os
+import select
 import subprocess
-from typing import Optional
+import threading
+import time
+from collections import OrderedDict
+from contextlib import suppress
+from typing import List, Optional, Sequence, Tuple
 
+import orjson
 from django.conf import settings
 
 from zerver.lib.storage import static_path
 
+# Rendering TeX used to start a new node process for every formula,
+# which costs far more than KaTeX itself.  Instead, each server
+# process keeps a KaTeX daemon (web/server/katex_server.js) running,
+# and speaks newline-delimited JSON with it over its stdin/stdout.
+# Results are also memoized in-process, since the same formulas are
+# rendered over and over again when messages are edited or
+# re-rendered.
+
+# How long we wait for the daemon to render a single formula before
+# giving up on it, and killing and later restarting the daemon.
+KATEX_TIMEOUT_SECS = 2
+
+# How many bytes of requests we write before reading their responses;
+# keeping this under the pipe buffer size ensures that we never block
+# writing to the daemon while it is blocked writing to us.
+KATEX_MAX_BATCH_BYTES = 32 * 1024
+
+TEX_CACHE_SIZE = 1000
+
+TexRequest = Tuple[str, bool]
+
+tex_cache: "OrderedDict[TexRequest, Optional[str]]" = OrderedDict()
+
+
+class KatexServerError(Exception):
+    pass
+
+
+class KatexTimeoutError(KatexServerError):
+    pass
+
+
+class KatexServer:
+    def __init__(self, katex_path: str) -> None:
+        self.pid = os.getpid()
+        self.process = subprocess.Popen(
+            ["node", katex_path],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+        self.buffer = b""
+
+    def send(self, lines: List[bytes]) -> None:
+        assert self.process.stdin is not None
+        self.process.stdin.write(b"".join(lines))
+        self.process.stdin.flush()
+
+    def receive(self) -> Optional[str]:
+        assert self.process.stdout is not None
+        fd = self.process.stdout.fileno()
+        deadline = time.monotonic() + KATEX_TIMEOUT_SECS
+        while b"\n" not in self.buffer:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+                raise KatexTimeoutError
+            data = os.read(fd, 65536)
+            if not data:
+                raise KatexServerError("KaTeX server exited")
+            self.buffer += data
+        line, self.buffer = self.buffer.split(b"\n", 1)
+        html = orjson.loads(line)["html"]
+        assert html is None or isinstance(html, str)
+        return html
+
+    def stop(self) -> None:
+        self.process.kill()
+        self.process.wait()
+        for pipe in (self.process.stdin, self.process.stdout):
+            assert pipe is not None
+            # Closing stdin flushes anything left in its buffer, which
+            # fails if the daemon has already gone away.
+            with suppress(OSError):
+                pipe.close()
+
+
+katex_server: Optional[KatexServer] = None
+katex_server_lock = threading.Lock()
+
+
+def get_katex_server(katex_path: str) -> KatexServer:
+    global katex_server
+    # A daemon inherited across a fork belongs to our parent, which
+    # is still talking to it; start our own.
+    if katex_server is None or katex_server.pid != os.getpid():
+        katex_server = KatexServer(katex_path)
+    return katex_server
+
+
+def stop_katex_server() -> None:
+    global katex_server
+    if katex_server is not None and katex_server.pid == os.getpid():
+        katex_server.stop()
+    katex_server = None
+
+
+def get_katex_path() -> Optional[str]:
+    katex_path = (
+        static_path("webpack-bundles/katex-server.js")
+        if settings.PRODUCTION
+        else os.path.join(settings.DEPLOY_ROOT, "web/server/katex_server.js")
+    )
+    if not os.path.isfile(katex_path):
+        logging.error("Cannot find KaTeX for latex rendering!")
+        return None
+    return katex_path
+
+
+def render_with_katex_server(katex_path: str, requests: List[TexRequest]) -> None:
+    """Renders the requests, in batches, storing the results in tex_cache"""
+    pending = list(requests)
+    restarted = False
+    while pending:
+        batch: List[TexRequest] = []
+        lines: List[bytes] = []
+        batch_bytes = 0
+        for tex, is_inline in pending:
+            line = orjson.dumps({"tex": tex, "display_mode": not is_inline}) + b"\n"
+            if lines and batch_bytes + len(line) > KATEX_MAX_BATCH_BYTES:
+                break
+            batch.append((tex, is_inline))
+            lines.append(line)
+            batch_bytes += len(line)
+
+        server = get_katex_server(katex_path)
+        try:
+            server.send(lines)
+            for request in batch:
+                tex_cache[request] = server.receive()
+                pending.pop(0)
+        except KatexTimeoutError:
+            # The daemon is still busy with this formula; give up on
+            # it, and start a fresh daemon for the rest.
+            logging.warning("Timed out rendering TeX: %s", pending[0][0][:100])
+            stop_katex_server()
+            pending.pop(0)
+        except (OSError, KatexServerError):
+            # The daemon died underneath us; restart it once.
+            stop_katex_server()
+            if restarted:
+                logging.exception("KaTeX server failed")
+                return
+            restarted = True
+        except BaseException:
+            # We do not know how much of the output we have read.
+            stop_katex_server()
+            raise
+
+
+def render_tex_many(requests: Sequence[TexRequest]) -> List[Optional[str]]:
+    """Render several (tex, is_inline) pairs, as with render_tex
+
+    The formulas are rendered in a single round-trip to the KaTeX
+    server, rather than one round-trip each.
+    """
+    katex_path = get_katex_path()
+    if katex_path is None:
+        return [None for request in requests]
+
+    with katex_server_lock:
+        missing = [request for request in dict.fromkeys(requests) if request not in tex_cache]
+        if missing:
+            render_with_katex_server(katex_path, missing)
+
+        results = [tex_cache.get(request) for request in requests]
+        for request in requests:
+            if request in tex_cache:
+                tex_cache.move_to_end(request)
+        while len(tex_cache) > TEX_CACHE_SIZE:
+            tex_cache.popitem(last=False)
+    return results
+
 
 def render_tex(tex: str, is_inline: bool = True) -> Optional[str]:
     r"""Render a TeX string into HTML using KaTeX
@@ -22,20 +200,5 @@ def render_tex(tex: str, is_inline: bool = True) -> Optional[str]:
                  (default True)
     """
 
-    katex_path = (
-        static_path("webpack-bundles/katex-cli.js")
-        if settings.PRODUCTION
-        else os.path.join(settings.DEPLOY_ROOT, "node_modules/katex/cli.js")
-    )
-    if not os.path.isfile(katex_path):
-        logging.error("Cannot find KaTeX for latex rendering!")
-        return None
-    command = ["node", katex_path]
-    if not is_inline:
-        command.extend(["--display-mode"])
-    try:
-        stdout = subprocess.check_output(command, input=tex, stderr=subprocess.DEVNULL, text=True)
-        # stdout contains a newline at the end
-        return stdout.strip()
-    except subprocess.CalledProcessError:
-        return None
+    [rendered] = render_tex_many([(tex, is_inline)])
+    return rendered
@@ -0,0 +1,234 @@
+import heapq
+import secrets
+from collections import defaultdict
+from dataclasses import dataclass, field
+from itertools import islice
+from typing import Any, Collection, Dict, List, Optional, Tuple
+
+from django.db import transaction
+
+from zerver.lib.cache import (
+    cache_delete_many,
+    cache_get_many,
+    cache_set,
+    unread_index_cache_key,
+    unread_index_version_cache_key,
+)
+from zerver.lib.streams import get_stream_by_narrow_operand_access_unchecked
+from zerver.lib.topic import MESSAGE__TOPIC
+from zerver.models import Recipient, Stream, UserMessage, UserProfile
+
+# How many of a user's oldest unread messages the index holds.  Any
+# further unread messages are past the index's watermark, like the
+# messages sent after it was built.
+UNREAD_INDEX_MAX_MESSAGES = 5000
+
+UNREAD_INDEX_CACHE_TIMEOUT = 3600
+
+
+@dataclass
+class UnreadIndex:
+    """The IDs of a user's unread messages, with IDs up to the
+    watermark, grouped by conversation and in ascending order.
+
+    This is a superset of the user's unread messages: it is updated
+    when messages are marked as read only once the change commits, and
+    may miss those updates entirely, so callers must check that a
+    message is still unread.  Changes which could make a message
+    unread, or move it to another conversation, discard the index.
+    """
+
+    watermark: int
+    # Stream recipient ID -> lowercased topic name -> message IDs
+    stream_messages: Dict[int, Dict[str, List[int]]] = field(default_factory=dict)
+    direct_messages: List[int] = field(default_factory=list)
+
+    def remove(self, message_ids: Collection[int]) -> None:
+        removed = set(message_ids)
+        for topics in self.stream_messages.values():
+            for topic, ids in topics.items():
+                topics[topic] = [message_id for message_id in ids if message_id not in removed]
+        self.direct_messages = [
+            message_id for message_id in self.direct_messages if message_id not in removed
+        ]
+
+
+def build_unread_index(user_profile: UserProfile) -> UnreadIndex:
+    # Every unread message up to the user's latest message is in the
+    # index, except for any message which was being sent with a lower
+    # ID than that one, and had not committed yet; such a message may
+    # be skipped as the first unread message until the index expires.
+    user_messages = UserMessage.objects.filter(user_profile=user_profile)
+    latest = user_messages.order_by("-message_id").values_list("message_id", flat=True).first()
+    if latest is None:
+        return UnreadIndex(watermark=0)
+
+    rows = list(
+        user_messages.filter(message_id__lte=latest)
+        .extra(where=[UserMessage.where_unread()])
+        .order_by("message_id")
+        .values_list(
+            "message_id", "message__recipient_id", "message__recipient__type", MESSAGE__TOPIC
+        )[: UNREAD_INDEX_MAX_MESSAGES + 1]
+    )
+    if len(rows) > UNREAD_INDEX_MAX_MESSAGES:
+        rows = rows[:UNREAD_INDEX_MAX_MESSAGES]
+        unread_index = UnreadIndex(watermark=rows[-1][0])
+    else:
+        unread_index = UnreadIndex(watermark=latest)
+
+    stream_messages: Dict[int, Dict[str, List[int]]] = defaultdict(lambda: defaultdict(list))
+    for message_id, recipient_id, recipient_type, topic in rows:
+        if recipient_type == Recipient.STREAM:
+            stream_messages[recipient_id][topic.lower()].append(message_id)
+        else:
+            unread_index.direct_messages.append(message_id)
+    unread_index.stream_messages = {
+        recipient_id: dict(topics) for recipient_id, topics in stream_messages.items()
+    }
+    return unread_index
+
+
+def get_cached_unread_index(user_profile_id: int) -> Tuple[str, Optional[UnreadIndex]]:
+    """Returns the user's current index version, creating one if
+    needed, and their cached index, if it was stored under that
+    version."""
+    version_key = unread_index_version_cache_key(user_profile_id)
+    index_key = unread_index_cache_key(user_profile_id)
+    cached = cache_get_many([version_key, index_key])
+
+    if version_key not in cached:
+        version = secrets.token_hex(8)
+        cache_set(version_key, version, timeout=UNREAD_INDEX_CACHE_TIMEOUT)
+        return (version, None)
+    version = cached[version_key][0]
+    if index_key in cached:
+        cached_version, unread_index = cached[index_key][0]
+        if cached_version == version:
+            return (version, unread_index)
+    return (version, None)
+
+
+def get_unread_index(user_profile: UserProfile) -> UnreadIndex:
+    # We must get the version before reading the database, so that if
+    # the index is discarded while we build it, we store the index
+    # under a version which is no longer current.
+    version, unread_index = get_cached_unread_index(user_profile.id)
+    if unread_index is not None:
+        return unread_index
+    unread_index = build_unread_index(user_profile)
+    cache_set(
+        unread_index_cache_key(user_profile.id),
+        (version, unread_index),
+        timeout=UNREAD_INDEX_CACHE_TIMEOUT,
+    )
+    return unread_index
+
+
+def get_unread_candidates(
+    user_profile: UserProfile, narrow: Optional[List[Dict[str, Any]]], limit: int
+) -> Optional[Tuple[List[int], bool, int]]:
+    """For the common narrows -- all messages, a stream, a topic, or
+    direct messages -- returns the `limit` oldest messages which may be
+    the first unread message in the narrow, whether there were any
+    more, and the watermark, past which any message may be unread.
+    Returns None for other narrows."""
+    stream_operand = None
+    topic_operand = None
+    direct_messages = False
+    for term in narrow or []:
+        if term.get("negated", False):
+            return None
+        operator, operand = term["operator"], term["operand"]
+        if operator == "stream" and stream_operand is None:
+            stream_operand = operand
+        elif operator == "topic" and topic_operand is None:
+            topic_operand = operand
+        elif operator in ("dm", "pm-with", "pm_with") or (
+            operator == "is" and operand in ("dm", "private")
+        ):
+            direct_messages = True
+        else:
+            return None
+
+    unread_index = get_unread_index(user_profile)
+    if direct_messages:
+        if stream_operand is not None or topic_operand is not None:
+            return None
+        ids_lists = [unread_index.direct_messages]
+    elif stream_operand is not None:
+        try:
+            stream = get_stream_by_narrow_operand_access_unchecked(
+                stream_operand, user_profile.realm
+            )
+        except Stream.DoesNotExist:
+            return None
+        if stream.recipient_id is None:  # nocoverage
+            return None
+        topics = unread_index.stream_messages.get(stream.recipient_id, {})
+        if topic_operand is not None:
+            ids_lists = [topics.get(topic_operand.lower(), [])]
+        else:
+            ids_lists = list(topics.values())
+    elif topic_operand is not None:
+        return None
+    else:
+        ids_lists = [
+            ids for topics in unread_index.stream_messages.values() for ids in topics.values()
+        ]
+        ids_lists.append(unread_index.direct_messages)
+
+    message_ids = list(islice(heapq.merge(*ids_lists), limit + 1))
+    return (message_ids[:limit], len(message_ids) > limit, unread_index.watermark)
+
+
+def remove_from_unread_index(user_profile_id: int, message_ids: Collection[int]) -> None:
+    """Drops messages the user has marked as read from their index,
+    once that change commits."""
+
+    def remove() -> None:
+        version, unread_index = get_cached_unread_index(user_profile_id)
+        if unread_index is not None:
+            unread_index.remove(message_ids)
+            cache_set(
+                unread_index_cache_key(user_profile_id),
+                (version, unread_index),
+                timeout=UNREAD_INDEX_CACHE_TIMEOUT,
+            )
+
+    transaction.on_commit(remove)
+
+
+def discard_unread_indexes(user_profile_ids: Collection[int]) -> None:
+    """Discards the users' indexes, after changes which they may be
+    missing, like messages being marked as unread or moved, or which
+    are cheaper to rebuild from than to apply.
+
+    We discard them by deleting their versions, both now and once the
+    change commits.  An index built concurrently from the old state
+    was stored under the deleted version, so it is never used."""
+    keys = [
+        key
+        for user_profile_id in user_profile_ids
+        for key in [
+            unread_index_version_cache_key(user_profile_id),
+            unread_index_cache_key(user_profile_id),
+        ]
+    ]
+    cache_delete_many(keys)
+    transaction.on_commit(lambda: cache_delete_many(keys))
+
+
+def discard_unread_indexes_for_messages(message_ids: Collection[int]) -> None:
+    """Discards the indexes of users with any of the messages unread,
+    after the messages are moved to another conversation, or after
+    their UserMessage rows are created other than when they are
+    sent."""
+    discard_unread_indexes(
+        list(
+            UserMessage.objects.filter(message_id__in=message_ids)
+            .extra(where=[UserMessage.where_unread()])
+            .values_list("user_profile_id", flat=True)
+            .distinct()
+        )
+    )
@@ -1,4 +1,5 @@
 from zerver.lib.url_preview.parsers.generic import GenericParser
+from zerver.lib.url_preview.parsers.head import HeadParser
 from zerver.lib.url_preview.parsers.open_graph import OpenGraphParser
 
-__all__ = ["OpenGraphParser", "GenericParser"]
+__all__ = ["OpenGraphParser", "GenericParser", "HeadParser"]
@@ -0,0 +1,38 @@
+class HeadParser:
+    """Incrementally parses the start of an HTML document, as it is
+    downloaded, to tell when we have read enough of it to preview.
+
+    We have enough once the <head> is over, if it had everything that
+    OpenGraphParser and GenericParser look for; otherwise, they will
+    look for some of it in the <body>.
+    """
+
+    def __init__(self) -> None:
+        # Imported here for the same reason as bs4 in BaseParser.
+        from lxml import etree
+
+        self._parser = etree.HTMLPullParser(events=("start", "end"))
+        self.head_done = False
+        self.has_title = False
+        self.has_description = False
+        self.has_image = False
+
+    def feed(self, data: bytes) -> None:
+        self._parser.feed(data)
+        for event, element in self._parser.read_events():
+            if event == "start" and element.tag == "meta" and element.get("content"):
+                meta_property = element.get("property")
+                if meta_property == "og:title":
+                    self.has_title = True
+                elif meta_property == "og:description" or element.get("name") == "description":
+                    self.has_description = True
+                elif meta_property == "og:image":
+                    self.has_image = True
+            elif event == "end" and element.tag == "title" and element.text:
+                self.has_title = True
+            elif (event == "end" and element.tag == "head") or element.tag == "body":
+                self.head_done = True
+
+    @property
+    def complete(self) -> bool:
+        return self.head_done and self.has_title and self.has_description and self.has_image
@@ -1,6 +1,11 @@
 import re
-from typing import Any, Callable, Match, Optional
-from urllib.parse import urljoin
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Dict, Iterator, Match, Optional, Set
+from urllib.parse import urljoin, urlsplit
 
 import magic
 import requests
@@ -8,11 +13,18 @@ from django.conf import settings
 from django.utils.encoding import smart_str
 
 from version import ZULIP_VERSION
-from zerver.lib.cache import cache_with_key, preview_url_cache_key
+from zerver.lib.cache import (
+    cache_get,
+    cache_get_many,
+    cache_set,
+    preview_host_failure_cache_key,
+    preview_url_cache_key,
+    preview_url_fresh_cache_key,
+)
 from zerver.lib.outgoing_http import OutgoingSession
 from zerver.lib.pysa import mark_sanitized
 from zerver.lib.url_preview.oembed import get_oembed_data
-from zerver.lib.url_preview.parsers import GenericParser, OpenGraphParser
+from zerver.lib.url_preview.parsers import GenericParser, HeadParser, OpenGraphParser
 from zerver.lib.url_preview.types import UrlEmbedData, UrlOEmbedData
 
 # Based on django.core.validators.URLValidator, with ftp support removed.
@@ -34,61 +46,198 @@ ZULIP_URL_PREVIEW_USER_AGENT = (
 HEADERS = {"User-Agent": ZULIP_URL_PREVIEW_USER_AGENT}
 TIMEOUT = 15
 
+# Previews are cached for PREVIEW_CACHE_TIMEOUT, but are only fresh
+# for PREVIEW_FRESH_SECS; a stale preview is still used, while it is
+# refetched in the background for later messages.
+PREVIEW_FRESH_SECS = 300
+PREVIEW_CACHE_TIMEOUT = 7 * 24 * 3600
+
+# After a host fails to respond, we do not try to fetch previews from
+# it again for this long, rather than waiting out TIMEOUT each time.
+HOST_FAILURE_CACHE_SECS = 300
+
+# The most requests we make to any one host at once.
+MAX_FETCHES_PER_HOST = 2
+
+# How much of a page we read, at most, looking for its metadata.
+MAX_PREVIEW_BYTES = 1024 * 1024
+PREVIEW_READ_SECS = 5
+PREVIEW_CHUNK_SIZE = 16 * 1024
+
 
 class PreviewSession(OutgoingSession):
     def __init__(self) -> None:
         super().__init__(role="preview", timeout=TIMEOUT, headers=HEADERS)
 
 
+# A single session, shared between threads, so that connections to
+# each host are pooled across fetches.
+preview_session: Optional[PreviewSession] = None
+
+# Only hosts with fetches in progress, or waiting, have a semaphore;
+# host_semaphore_users counts those fetches.
+host_semaphores: Dict[str, threading.BoundedSemaphore] = {}
+host_semaphore_users: Dict[str, int] = {}
+host_semaphores_lock = threading.Lock()
+
+revalidation_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="preview")
+revalidating_urls: Set[str] = set()
+revalidating_urls_lock = threading.Lock()
+
+
+def get_preview_session() -> PreviewSession:
+    global preview_session
+    if preview_session is None:
+        preview_session = PreviewSession()
+    return preview_session
+
+
+@contextmanager
+def limit_host_fetches(host: str) -> Iterator[None]:
+    """Waits until fewer than MAX_FETCHES_PER_HOST fetches from the
+    host are in progress.  A host's semaphore is dropped once no fetch
+    holds or waits on it, so we do not keep one for every host that
+    was ever linked to."""
+    with host_semaphores_lock:
+        if host not in host_semaphores:
+            host_semaphores[host] = threading.BoundedSemaphore(MAX_FETCHES_PER_HOST)
+            host_semaphore_users[host] = 0
+        semaphore = host_semaphores[host]
+        host_semaphore_users[host] += 1
+    try:
+        with semaphore:
+            yield
+    finally:
+        with host_semaphores_lock:
+            host_semaphore_users[host] -= 1
+            if host_semaphore_users[host] == 0:
+                del host_semaphores[host]
+                del host_semaphore_users[host]
+
+
 def is_link(url: str) -> Optional[Match[str]]:
     return link_regex.match(smart_str(url))
 
 
-def guess_mimetype_from_content(response: requests.Response) -> str:
+@dataclass
+class HtmlPrefix:
+    content: bytes
+    content_type: Optional[str]
+    url: str
+
+
+def guess_mimetype_from_content(content: bytes) -> str:
     mime_magic = magic.Magic(mime=True)
-    try:
-        content = next(response.iter_content(1000))
-    except StopIteration:
-        content = ""
     return mime_magic.from_buffer(content)
 
 
-def valid_content_type(url: str) -> bool:
-    try:
-        response = PreviewSession().get(url, stream=True)
-    except requests.RequestException:
-        return False
+def fetch_html_prefix(url: str) -> Optional[HtmlPrefix]:
+    """Downloads the start of the page, if it is HTML.
 
-    if not response.ok:
-        return False
+    We stop reading as soon as we have the metadata from its <head>,
+    or after MAX_PREVIEW_BYTES or PREVIEW_READ_SECS, whichever is
+    first; the parsers are happy with a truncated document."""
+    with get_preview_session().get(mark_sanitized(url), stream=True) as response:
+        if not response.ok:
+            return None
 
-    content_type = response.headers.get("content-type")
-    # Be accommodating of bad servers: assume content may be html if no content-type header
-    if not content_type or content_type.startswith("text/html"):
-        # Verify that the content is actually HTML if the server claims it is
-        content_type = guess_mimetype_from_content(response)
-    return content_type.startswith("text/html")
+        chunks = response.iter_content(PREVIEW_CHUNK_SIZE)
+        first_chunk = next(chunks, b"")
+        content_type = response.headers.get("content-type")
+        # Be accommodating of bad servers: assume content may be html if no content-type header
+        if not content_type or content_type.startswith("text/html"):
+            # Verify that the content is actually HTML if the server claims it is
+            content_type = guess_mimetype_from_content(first_chunk)
+        if not content_type.startswith("text/html"):
+            return None
 
+        deadline = time.monotonic() + PREVIEW_READ_SECS
+        head_parser = HeadParser()
+        content = [first_chunk]
+        content_bytes = len(first_chunk)
+        head_parser.feed(first_chunk)
+        while (
+            not head_parser.complete
+            and content_bytes < MAX_PREVIEW_BYTES
+            and time.monotonic() < deadline
+        ):
+            chunk = next(chunks, None)
+            if chunk is None:
+                break
+            content.append(chunk)
+            content_bytes += len(chunk)
+            head_parser.feed(chunk)
 
-def catch_network_errors(func: Callable[..., Any]) -> Callable[..., Any]:
-    def wrapper(*args: Any, **kwargs: Any) -> Any:
-        try:
-            return func(*args, **kwargs)
-        except requests.exceptions.RequestException:
-            pass
+        return HtmlPrefix(
+            content=b"".join(content),
+            content_type=response.headers.get("Content-Type"),
+            url=response.url,
+        )
 
-    return wrapper
 
-
-@catch_network_errors
-@cache_with_key(preview_url_cache_key)
 def get_link_embed_data(
     url: str, maxwidth: int = 640, maxheight: int = 480
 ) -> Optional[UrlEmbedData]:
+    """Returns the preview for the URL, from the cache if we have one.
+
+    This is safe to call from several threads at once."""
     if not is_link(url):
         return None
 
-    if not valid_content_type(url):
+    cache_key = preview_url_cache_key(url)
+    fresh_cache_key = preview_url_fresh_cache_key(url)
+    cached = cache_get_many([cache_key, fresh_cache_key])
+    if cache_key in cached:
+        if fresh_cache_key not in cached:
+            revalidate_link_embed_data(url, maxwidth, maxheight)
+        return cached[cache_key][0]
+
+    return fetch_link_embed_data(url, maxwidth, maxheight)
+
+
+def revalidate_link_embed_data(url: str, maxwidth: int, maxheight: int) -> None:
+    with revalidating_urls_lock:
+        if url in revalidating_urls:
+            return
+        revalidating_urls.add(url)
+
+    def revalidate() -> None:
+        try:
+            fetch_link_embed_data(url, maxwidth, maxheight)
+        finally:
+            with revalidating_urls_lock:
+                revalidating_urls.discard(url)
+
+    revalidation_executor.submit(revalidate)
+
+
+def fetch_link_embed_data(url: str, maxwidth: int, maxheight: int) -> Optional[UrlEmbedData]:
+    """Fetches the preview for the URL, and caches it.
+
+    Network errors are not cached, so that we try again next time;
+    but we skip hosts which have recently failed to respond at all."""
+    host = urlsplit(url).hostname
+    assert host is not None
+    if cache_get(preview_host_failure_cache_key(host)) is not None:
+        return None
+
+    try:
+        with limit_host_fetches(host):
+            data = get_uncached_link_embed_data(url, maxwidth, maxheight)
+    except (requests.ConnectionError, requests.Timeout):
+        cache_set(preview_host_failure_cache_key(host), True, timeout=HOST_FAILURE_CACHE_SECS)
+        return None
+    except requests.RequestException:
+        return None
+
+    cache_set(preview_url_cache_key(url), data, timeout=PREVIEW_CACHE_TIMEOUT)
+    cache_set(preview_url_fresh_cache_key(url), True, timeout=PREVIEW_FRESH_SECS)
+    return data
+
+
+def get_uncached_link_embed_data(url: str, maxwidth: int, maxheight: int) -> Optional[UrlEmbedData]:
+    html_prefix = fetch_html_prefix(url)
+    if html_prefix is None:
         return None
 
     # The oembed data from pyoembed may be complete enough to return
@@ -99,17 +248,13 @@ def get_link_embed_data(
     if data is not None and isinstance(data, UrlOEmbedData):
         return data
 
-    response = PreviewSession().get(mark_sanitized(url), stream=True)
-    if not response.ok:
-        return None
-
     if data is None:
         data = UrlEmbedData()
 
     for parser_class in (OpenGraphParser, GenericParser):
-        parser = parser_class(response.content, response.headers.get("Content-Type"))
+        parser = parser_class(html_prefix.content, html_prefix.content_type)
         data.merge(parser.extract_data())
 
     if data.image:
-        data.image = urljoin(response.url, data.image)
+        data.image = urljoin(html_prefix.url, data.image)
     return data
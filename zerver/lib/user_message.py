@@ -1,11 +1,24 @@
-from typing import List
+import io
+import logging
+import struct
+import time
+from array import array
+from typing import TYPE_CHECKING, Iterable, Iterator, List, Sequence, Tuple, Union
 
 from django.db import connection
 from psycopg2.extras import execute_values
 from psycopg2.sql import SQL
+from typing_extensions import TypeAlias, override
 
 from zerver.models import UserMessage
 
+if TYPE_CHECKING:
+    from _typeshed import WriteableBuffer
+
+# Batches with at least this many rows are inserted with COPY, which
+# avoids building and parsing one enormous INSERT statement.
+BULK_INSERT_UMS_COPY_THRESHOLD = 5000
+
 
 class UserMessageLite:
     """
@@ -23,24 +36,135 @@ class UserMessageLite:
         return UserMessage.flags_list_for_flags(self.flags)
 
 
-def bulk_insert_ums(ums: List[UserMessageLite]) -> None:
+class UserMessageLiteBatch:
+    """
+    A columnar equivalent of List[UserMessageLite], for code paths
+    that create UserMessage rows for very large numbers of
+    recipients or messages.  Rows are stored in three parallel arrays
+    of machine integers, so each row costs 24 bytes rather than a
+    Python object with its own __dict__.
+    """
+
+    def __init__(self) -> None:
+        self.user_profile_ids = array("q")
+        self.message_ids = array("q")
+        self.flags = array("q")
+
+    def __len__(self) -> int:
+        return len(self.user_profile_ids)
+
+    def append(self, user_profile_id: int, message_id: int, flags: int) -> None:
+        self.user_profile_ids.append(user_profile_id)
+        self.message_ids.append(message_id)
+        self.flags.append(flags)
+
+    def extend(self, other: "UserMessageLiteBatch") -> None:
+        self.user_profile_ids.extend(other.user_profile_ids)
+        self.message_ids.extend(other.message_ids)
+        self.flags.extend(other.flags)
+
+    def rows(self) -> Iterator[Tuple[int, int, int]]:
+        return zip(self.user_profile_ids, self.message_ids, self.flags)
+
+
+UserMessageRows: TypeAlias = Union[Sequence[UserMessageLite], UserMessageLiteBatch]
+
+
+def user_message_rows(ums: UserMessageRows) -> Iterator[Tuple[int, int, int]]:
+    if isinstance(ums, UserMessageLiteBatch):
+        return ums.rows()
+    return ((um.user_profile_id, um.message_id, um.flags) for um in ums)
+
+
+# See https://www.postgresql.org/docs/current/sql-copy.html#id-1.9.3.55.9.4
+# for the binary COPY format.  Each row is a field count followed by
+# (length, value) pairs for user_profile_id (integer), message_id
+# (integer), and flags (bigint).
+COPY_BINARY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)
+COPY_BINARY_TRAILER = struct.pack(">h", -1)
+COPY_BINARY_ROW = struct.Struct(">hiiiiiq")
+
+
+class UserMessageCopyStream(io.RawIOBase):
+    """A file-like object producing the binary COPY representation of
+    a sequence of (user_profile_id, message_id, flags) rows, which
+    psycopg2's copy_expert reads incrementally, so the encoded rows
+    are never all held in memory at once."""
+
+    def __init__(self, rows: Iterable[Tuple[int, int, int]]) -> None:
+        super().__init__()
+        self.chunks = self.generate_chunks(rows)
+        self.buffer = memoryview(b"")
+
+    @staticmethod
+    def generate_chunks(rows: Iterable[Tuple[int, int, int]]) -> Iterator[bytes]:
+        yield COPY_BINARY_HEADER
+        pack = COPY_BINARY_ROW.pack
+        chunk = bytearray()
+        for user_profile_id, message_id, flags in rows:
+            chunk += pack(3, 4, user_profile_id, 4, message_id, 8, flags)
+            if len(chunk) >= 64 * 1024:
+                yield bytes(chunk)
+                chunk.clear()
+        chunk += COPY_BINARY_TRAILER
+        yield bytes(chunk)
+
+    @override
+    def readable(self) -> bool:
+        return True
+
+    @override
+    def readinto(self, b: "WriteableBuffer") -> int:
+        while len(self.buffer) == 0:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                return 0
+            self.buffer = memoryview(chunk)
+        target = memoryview(b).cast("B")
+        size = min(len(target), len(self.buffer))
+        target[:size] = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return size
+
+
+def bulk_insert_ums(ums: UserMessageRows) -> None:
     """
     Doing bulk inserts this way is much faster than using Django,
     since we don't have any ORM overhead.  Profiling with 1000
     users shows a speedup of 0.436 -> 0.027 seconds, so we're
     talking about a 15x speedup.
+
+    Large batches, such as a message sent to a stream with tens of
+    thousands of subscribers, are streamed into the table with COPY.
     """
     if not ums:
         return
 
-    vals = [(um.user_profile_id, um.message_id, um.flags) for um in ums]
-    query = SQL(
+    start_time = time.time()
+    if len(ums) >= BULK_INSERT_UMS_COPY_THRESHOLD:
+        method = "COPY"
+        with connection.cursor() as cursor:
+            cursor.cursor.copy_expert(
+                "COPY zerver_usermessage (user_profile_id, message_id, flags)"
+                " FROM STDIN WITH (FORMAT binary)",
+                UserMessageCopyStream(user_message_rows(ums)),
+            )
+    else:
+        method = "INSERT"
+        vals = list(user_message_rows(ums))
+        query = SQL(
+            """
+            INSERT into
+                zerver_usermessage (user_profile_id, message_id, flags)
+            VALUES %s
         """
-        INSERT into
-            zerver_usermessage (user_profile_id, message_id, flags)
-        VALUES %s
-    """
-    )
+        )
 
-    with connection.cursor() as cursor:
-        execute_values(cursor.cursor, query, vals)
+        with connection.cursor() as cursor:
+            execute_values(cursor.cursor, query, vals)
+    logging.debug(
+        "bulk_insert_ums: %s of %d rows took %sms",
+        method,
+        len(ums),
+        int(1000 * (time.time() - start_time)),
+    )
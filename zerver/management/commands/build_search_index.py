@@ -0,0 +1,47 @@
+from argparse import ArgumentParser
+from typing import Any, List
+
+from django.core.management.base import CommandError
+from typing_extensions import override
+
+from zerver.lib.management import ZulipBaseCommand
+from zerver.lib.search_index import INDEX_BATCH_SIZE, get_search_index, update_search_index
+from zerver.models import Message
+
+
+class Command(ZulipBaseCommand):
+    help = """Add existing messages to the SEARCH_INDEX_BACKEND.
+
+New and edited messages are indexed by the search_index queue worker;
+this only needs to be run when first enabling the index, or to rebuild it."""
+
+    @override
+    def add_arguments(self, parser: ArgumentParser) -> None:
+        self.add_realm_args(parser)
+
+    @override
+    def handle(self, *args: Any, **options: Any) -> None:
+        search_index = get_search_index()
+        if search_index is None:
+            raise CommandError("SEARCH_INDEX_BACKEND is not set.")
+
+        realm = self.get_realm(options)
+        messages = Message.objects.all()
+        if realm is not None:
+            messages = messages.filter(realm_id=realm.id)
+
+        indexed_count = 0
+        batch: List[int] = []
+        for message_id in (
+            messages.order_by("id").values_list("id", flat=True).iterator(chunk_size=10000)
+        ):
+            batch.append(message_id)
+            if len(batch) == INDEX_BATCH_SIZE:
+                update_search_index(search_index, batch)
+                indexed_count += len(batch)
+                batch = []
+                print(f"Indexed {indexed_count} messages so far")
+        if batch:
+            update_search_index(search_index, batch)
+            indexed_count += len(batch)
+        print(f"Indexed {indexed_count} messages.")
@@ -0,0 +1,106 @@
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Any, Iterator, List, Tuple
+
+import bmemcached
+from django.core.cache import cache
+from django.core.management.base import CommandError
+from django.db import connection
+from django.db.models import Q, QuerySet
+from typing_extensions import override
+
+from zerver.lib.management import ZulipBaseCommand
+from zerver.lib.markdown import version as markdown_version
+from zerver.lib.message import rerender_messages
+from zerver.models import Message, Realm
+
+
+def messages_to_rerender(realm: Realm, rerender_all: bool) -> QuerySet[Message]:
+    messages = Message.objects.filter(realm_id=realm.id)
+    if not rerender_all:
+        messages = messages.filter(
+            Q(rendered_content_version__lt=markdown_version) | Q(rendered_content_version=None)
+        )
+    return messages
+
+
+def message_id_ranges(messages: QuerySet[Message], batch_size: int) -> Iterator[Tuple[int, int]]:
+    # We only hold the boundaries of each batch in memory, not the
+    # IDs of every message in the realm.
+    message_ids = messages.order_by("id").values_list("id", flat=True)
+    batch: List[int] = []
+    for message_id in message_ids.iterator(chunk_size=10000):
+        batch.append(message_id)
+        if len(batch) == batch_size:
+            yield (batch[0], batch[-1])
+            batch = []
+    if batch:
+        yield (batch[0], batch[-1])
+
+
+def rerender_message_range(realm_id: int, rerender_all: bool, first_id: int, last_id: int) -> int:
+    realm = Realm.objects.get(id=realm_id)
+    messages = messages_to_rerender(realm, rerender_all).filter(id__gte=first_id, id__lte=last_id)
+    return rerender_messages(realm, messages)
+
+
+class Command(ZulipBaseCommand):
+    help = """Re-render the messages in a realm with the current Markdown processor.
+
+By default, only messages rendered by an older version of the Markdown
+processor are re-rendered."""
+
+    @override
+    def add_arguments(self, parser: ArgumentParser) -> None:
+        self.add_realm_args(parser, required=True)
+        parser.add_argument(
+            "--all",
+            action="store_true",
+            help="Re-render all messages, not only those rendered by an older version.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Number of messages to render and save at a time.",
+        )
+        parser.add_argument(
+            "--processes",
+            type=int,
+            default=1,
+            help="Number of processes to render messages in parallel.",
+        )
+
+    @override
+    def handle(self, *args: Any, **options: Any) -> None:
+        realm = self.get_realm(options)
+        assert realm is not None  # Should be ensured by parser
+        if options["processes"] < 1:
+            raise CommandError("You must have at least one process.")
+
+        ranges = list(
+            message_id_ranges(messages_to_rerender(realm, options["all"]), options["batch_size"])
+        )
+        rerendered_count = 0
+        if options["processes"] == 1:
+            for first_id, last_id in ranges:
+                rerendered_count += rerender_message_range(
+                    realm.id, options["all"], first_id, last_id
+                )
+        else:
+            # The forked processes must not share our database or
+            # memcached connections.
+            connection.close()
+            _cache = cache._cache  # type: ignore[attr-defined] # not in stubs
+            assert isinstance(_cache, bmemcached.Client)
+            _cache.disconnect_all()
+            with ProcessPoolExecutor(max_workers=options["processes"]) as executor:
+                for future in as_completed(
+                    executor.submit(
+                        rerender_message_range, realm.id, options["all"], first_id, last_id
+                    )
+                    for first_id, last_id in ranges
+                ):
+                    rerendered_count += future.result()
+                    print(f"Re-rendered {rerendered_count} messages so far")
+        print(f"Re-rendered {rerendered_count} messages.")
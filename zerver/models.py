@@ -72,11 +72,14 @@ from zerver.lib.cache import (
     flush_realm,
     flush_stream,
     flush_submessage,
+    flush_subscription,
     flush_used_upload_space_cache,
     flush_user_profile,
     get_realm_used_upload_space_cache_key,
     realm_alert_words_automaton_cache_key,
     realm_alert_words_cache_key,
+    realm_alert_words_version_cache_key,
+    realm_mention_data_version_cache_key,
     realm_user_dict_fields,
     realm_user_dicts_cache_key,
     user_profile_by_api_key_cache_key,
@@ -2433,6 +2436,18 @@ class GroupGroupMembership(models.Model):
         ]
 
 
+def flush_realm_mention_data(realm_id: int) -> None:
+    cache_delete(realm_mention_data_version_cache_key(realm_id))
+
+
+def flush_user_group(*, instance: UserGroup, **kwargs: object) -> None:
+    flush_realm_mention_data(instance.realm_id)
+
+
+post_save.connect(flush_user_group, sender=UserGroup)
+post_delete.connect(flush_user_group, sender=UserGroup)
+
+
 def remote_user_to_email(remote_user: str) -> str:
     if settings.SSO_APPEND_DOMAIN is not None:
         return Address(username=remote_user, domain=settings.SSO_APPEND_DOMAIN).addr_spec
@@ -4054,6 +4069,9 @@ class Subscription(models.Model):
     ]
 
 
+post_save.connect(flush_subscription, sender=Subscription)
+
+
 @cache_with_key(user_profile_by_id_cache_key, timeout=3600 * 24 * 7)
 def get_user_profile_by_id(user_profile_id: int) -> UserProfile:
     return UserProfile.objects.select_related(
@@ -5202,6 +5220,7 @@ class AlertWord(models.Model):
 def flush_realm_alert_words(realm_id: int) -> None:
     cache_delete(realm_alert_words_cache_key(realm_id))
     cache_delete(realm_alert_words_automaton_cache_key(realm_id))
+    cache_delete(realm_alert_words_version_cache_key(realm_id))
 
 
 def flush_alert_word(*, instance: AlertWord, **kwargs: object) -> None:
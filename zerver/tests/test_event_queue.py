@@ -1,3 +1,5 @@
+import os
+import tempfile
 import time
 from typing import Any, Callable, Collection, Dict, List
 from unittest import mock
@@ -17,14 +19,29 @@ from zerver.lib.test_classes import ZulipTestCase
 from zerver.lib.test_helpers import HostRequestMock, dummy_handler, mock_queue_publish
 from zerver.models import Recipient, Subscription, UserProfile, UserTopic, get_stream
 from zerver.tornado.event_queue import (
+    EVENT_QUEUE_MIGRATION_GRACE_PERIOD_SECS,
     ClientDescriptor,
     access_client_descriptor,
     allocate_client_descriptor,
+    clear_client_event_queues_for_testing,
+    clients,
+    dump_event_queues,
+    expire_event_queue_migrations,
+    get_client_descriptors_for_realm_all_streams,
+    get_client_descriptors_for_realm_stream,
+    get_client_descriptors_for_user,
+    get_wrapped_process_notification,
+    held_user_events,
+    load_event_queues,
     maybe_enqueue_notifications,
+    migrate_misplaced_event_queues,
+    migrated_user_ports,
     missedmessage_hook,
     persistent_queue_filename,
     process_notification,
 )
+from zerver.tornado.queue_snapshot import SNAPSHOT_HEADER, SNAPSHOT_MAGIC, SNAPSHOT_VERSION
+from zerver.tornado.sharding import get_user_id_tornado_port
 from zerver.tornado.views import cleanup_event_queue, get_events
 
 
@@ -122,6 +139,54 @@ class StreamWatchersTest(ZulipTestCase):
             last_for_client=True,
         )
 
+    def test_stream_narrow_index(self) -> None:
+        cordelia = self.example_user("cordelia")
+        hamlet = self.example_user("hamlet")
+        realm = hamlet.realm
+
+        self.subscribe(cordelia, "Denmark")
+        self.subscribe(cordelia, "Verona")
+        self.unsubscribe(hamlet, "Denmark")
+        self.unsubscribe(hamlet, "Verona")
+
+        def allocate_narrowed_client(narrow: List[List[str]]) -> ClientDescriptor:
+            queue_data = dict(
+                all_public_streams=False,
+                apply_markdown=True,
+                client_gravatar=True,
+                client_type_name="home grown API program",
+                event_types=["message"],
+                last_connection_time=time.time(),
+                queue_timeout=600,
+                realm_id=realm.id,
+                user_profile_id=hamlet.id,
+                narrow=narrow,
+            )
+            return allocate_client_descriptor(queue_data)
+
+        denmark_client = allocate_narrowed_client([["stream", "denmark"]])
+        sender_client = allocate_narrowed_client([["sender", cordelia.email]])
+
+        self.assertEqual(
+            get_client_descriptors_for_realm_stream(realm.id, "Denmark"), [denmark_client]
+        )
+        self.assertEqual(get_client_descriptors_for_realm_stream(realm.id, "Verona"), [])
+        self.assertEqual(get_client_descriptors_for_realm_all_streams(realm.id), [sender_client])
+
+        self.send_stream_message(cordelia, "Denmark")
+        self.send_stream_message(cordelia, "Verona")
+        self.assertEqual(
+            [
+                event["message"]["display_recipient"]
+                for event in denmark_client.event_queue.contents()
+            ],
+            ["Denmark"],
+        )
+        self.assert_length(sender_client.event_queue.contents(), 2)
+
+        denmark_client.cleanup()
+        self.assertEqual(get_client_descriptors_for_realm_stream(realm.id, "Denmark"), [])
+
 
 class MissedMessageHookTest(ZulipTestCase):
     """Tests what arguments missedmessage_hook passes into maybe_enqueue_notifications.
@@ -1199,6 +1264,307 @@ class FileReloadLogicTest(ZulipTestCase):
                 "/home/zulip/tornado/event_queues.9800.last.json",
             )
 
+    def allocate_test_client(self) -> ClientDescriptor:
+        user_profile = self.example_user("hamlet")
+        queue_data = dict(
+            all_public_streams=False,
+            apply_markdown=True,
+            client_gravatar=True,
+            client_type_name="website",
+            event_types=None,
+            last_connection_time=time.time(),
+            queue_timeout=600,
+            realm_id=user_profile.realm.id,
+            user_profile_id=user_profile.id,
+        )
+        client = allocate_client_descriptor(queue_data)
+        client.event_queue.push(dict(type="test", data="first"))
+        client.event_queue.push(dict(type="test", data="second"))
+        return client
+
+    def test_dump_and_load_event_queues(self) -> None:
+        for compression in [False, True]:
+            clear_client_event_queues_for_testing()
+            client = self.allocate_test_client()
+            expected = client.to_dict()
+            with tempfile.TemporaryDirectory() as tmpdir, self.settings(
+                JSON_PERSISTENT_QUEUE_FILENAME_PATTERN=os.path.join(tmpdir, "queues%s.json"),
+                TORNADO_QUEUE_SNAPSHOT_COMPRESSION=compression,
+            ):
+                with self.assertLogs(level="INFO") as logs:
+                    dump_event_queues(9800)
+                self.assertIn("dumped 1 event queues", logs.output[0])
+
+                clear_client_event_queues_for_testing()
+                with self.assertLogs(level="INFO") as logs:
+                    load_event_queues(9800)
+                self.assertIn("loaded 1 event queues", logs.output[0])
+
+            self.assertEqual(list(clients), [client.event_queue.id])
+            loaded = clients[client.event_queue.id]
+            self.assertEqual(loaded.to_dict(), expected)
+            self.assertEqual(
+                [event["data"] for event in loaded.event_queue.contents()], ["first", "second"]
+            )
+
+    def test_load_legacy_json_event_queues(self) -> None:
+        client = self.allocate_test_client()
+        with tempfile.TemporaryDirectory() as tmpdir, self.settings(
+            JSON_PERSISTENT_QUEUE_FILENAME_PATTERN=os.path.join(tmpdir, "queues%s.json")
+        ):
+            with open(persistent_queue_filename(9800), "wb") as f:
+                f.write(orjson.dumps([(client.event_queue.id, client.to_dict())]))
+
+            clear_client_event_queues_for_testing()
+            with self.assertLogs(level="INFO"):
+                load_event_queues(9800)
+        self.assertEqual(list(clients), [client.event_queue.id])
+
+    def test_load_truncated_event_queues(self) -> None:
+        first_client = self.allocate_test_client()
+        self.allocate_test_client()
+        with tempfile.TemporaryDirectory() as tmpdir, self.settings(
+            JSON_PERSISTENT_QUEUE_FILENAME_PATTERN=os.path.join(tmpdir, "queues%s.json")
+        ):
+            with self.assertLogs(level="INFO"):
+                dump_event_queues(9800)
+            filename = persistent_queue_filename(9800)
+            os.truncate(filename, os.path.getsize(filename) - 10)
+
+            clear_client_event_queues_for_testing()
+            with self.assertLogs(level="INFO") as logs:
+                load_event_queues(9800)
+        self.assertIn("could not deserialize event queues", logs.output[0])
+        # The first queue was loaded before the damaged record was reached.
+        self.assertEqual(list(clients), [first_client.event_queue.id])
+
+    def test_load_unsupported_snapshot_version(self) -> None:
+        with tempfile.TemporaryDirectory() as tmpdir, self.settings(
+            JSON_PERSISTENT_QUEUE_FILENAME_PATTERN=os.path.join(tmpdir, "queues%s.json")
+        ):
+            with open(persistent_queue_filename(9800), "wb") as f:
+                f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION + 1, 0))
+
+            with self.assertLogs(level="INFO") as logs:
+                load_event_queues(9800)
+        self.assertIn("could not deserialize event queues", logs.output[0])
+        self.assertEqual(clients, {})
+
+
+class ShardingTest(ZulipTestCase):
+    def test_consistent_hashing(self) -> None:
+        user_ids = range(1, 2001)
+        two_ports = {
+            user_id: get_user_id_tornado_port([9800, 9801], user_id) for user_id in user_ids
+        }
+        # The assignment does not depend on the order of the ports.
+        self.assertEqual(
+            two_ports,
+            {user_id: get_user_id_tornado_port([9801, 9800], user_id) for user_id in user_ids},
+        )
+        # Users are spread roughly evenly over the ports.
+        self.assertGreater(list(two_ports.values()).count(9800), 800)
+        self.assertGreater(list(two_ports.values()).count(9801), 800)
+
+        # Adding a port only moves users onto the new port.
+        three_ports = {
+            user_id: get_user_id_tornado_port([9800, 9801, 9802], user_id) for user_id in user_ids
+        }
+        moved = [user_id for user_id in user_ids if two_ports[user_id] != three_ports[user_id]]
+        self.assertTrue(all(three_ports[user_id] == 9802 for user_id in moved))
+        self.assertLess(len(moved), 900)
+
+        self.assertEqual(get_user_id_tornado_port([9803], 17), 9803)
+
+    def test_migrate_misplaced_event_queues(self) -> None:
+        hamlet = self.example_user("hamlet")
+        othello = self.example_user("othello")
+
+        def allocate_client(user_profile: UserProfile) -> ClientDescriptor:
+            queue_data = dict(
+                all_public_streams=False,
+                apply_markdown=True,
+                client_gravatar=True,
+                client_type_name="website",
+                event_types=None,
+                last_connection_time=time.time(),
+                queue_timeout=600,
+                realm_id=user_profile.realm_id,
+                user_profile_id=user_profile.id,
+            )
+            client = allocate_client_descriptor(queue_data)
+            client.event_queue.push(dict(type="test", data="pending"))
+            return client
+
+        hamlet_client = allocate_client(hamlet)
+        othello_client = allocate_client(othello)
+        othello_dict = othello_client.to_dict()
+
+        def user_port(realm_ports: List[int], user_id: int) -> int:
+            return 9801 if user_id == othello.id else 9800
+
+        with self.settings(TORNADO_PROCESSES=2), mock.patch(
+            "zerver.tornado.event_queue.get_realm_tornado_ports", return_value=[9800, 9801]
+        ), mock.patch(
+            "zerver.tornado.event_queue.get_user_id_tornado_port", side_effect=user_port
+        ), mock_queue_publish(
+            "zerver.tornado.event_queue.queue_json_publish"
+        ) as mock_publish, self.assertLogs(
+            level="INFO"
+        ) as logs:
+            migrate_misplaced_event_queues(9800)
+
+        self.assertIn("migrated 1 event queues to ports [9801]", logs.output[0])
+        self.assertEqual(list(clients), [hamlet_client.event_queue.id])
+        self.assertEqual(get_client_descriptors_for_user(othello.id), [])
+
+        mock_publish.assert_called_once()
+        queue_name, notice, _ = mock_publish.call_args[0]
+        self.assertEqual(queue_name, "notify_tornado_port_9801")
+        self.assertEqual(notice["users"], [othello.id])
+
+        # The receiving process restores the queue, with its pending events.
+        clear_client_event_queues_for_testing()
+        with self.assertLogs(level="INFO"):
+            process_notification(notice)
+        [migrated_client] = get_client_descriptors_for_user(othello.id)
+        self.assertEqual(migrated_client.event_queue.id, othello_client.event_queue.id)
+        self.assertEqual(migrated_client.to_dict(), othello_dict)
+        self.assertEqual(
+            [event["data"] for event in migrated_client.event_queue.contents()], ["pending"]
+        )
+
+    def test_events_for_migrating_event_queues(self) -> None:
+        hamlet = self.example_user("hamlet")
+        othello = self.example_user("othello")
+        queue_data = dict(
+            all_public_streams=False,
+            apply_markdown=True,
+            client_gravatar=True,
+            client_type_name="website",
+            event_types=None,
+            last_connection_time=time.time(),
+            queue_timeout=600,
+            realm_id=othello.realm_id,
+            user_profile_id=othello.id,
+        )
+        othello_client = allocate_client_descriptor(queue_data)
+
+        def notice(data: str) -> Dict[str, Any]:
+            return dict(
+                event=dict(type="test", data=data),
+                users=[othello.id, hamlet.id],
+                realm_id=othello.realm_id,
+            )
+
+        def user_port(realm_ports: List[int], user_id: int) -> int:
+            return 9801 if user_id == othello.id else 9800
+
+        # The old process hands off Othello's queue, and forwards the
+        # events which Django processes still send it for him.
+        with self.settings(TORNADO_PROCESSES=2), mock.patch(
+            "zerver.tornado.event_queue.tornado_port", 9800
+        ), mock.patch(
+            "zerver.tornado.event_queue.get_sharding_config_loaded_time", return_value=0
+        ), mock.patch(
+            "zerver.tornado.event_queue.get_realm_tornado_ports", return_value=[9800, 9801]
+        ), mock.patch(
+            "zerver.tornado.event_queue.get_user_id_tornado_port", side_effect=user_port
+        ), mock_queue_publish(
+            "zerver.tornado.event_queue.queue_json_publish"
+        ) as mock_publish, self.assertLogs(
+            level="INFO"
+        ):
+            migrate_misplaced_event_queues(9800)
+            process_notification(notice("forwarded"))
+
+        self.assertEqual(list(migrated_user_ports), [othello.id])
+        self.assertEqual(mock_publish.call_count, 2)
+        migrate_notice = mock_publish.call_args_list[0][0][1]
+        queue_name, forwarded_notice, _ = mock_publish.call_args_list[1][0]
+        self.assertEqual(queue_name, "notify_tornado_port_9801")
+        self.assertEqual(forwarded_notice, {**notice("forwarded"), "users": [othello.id]})
+
+        # The new process, which has just loaded the new configuration,
+        # holds events for users who used to be on port 9800 until
+        # their queues arrive.
+        clear_client_event_queues_for_testing()
+        with self.settings(TORNADO_PROCESSES=2), mock.patch(
+            "zerver.tornado.event_queue.tornado_port", 9801
+        ), mock.patch(
+            "zerver.tornado.event_queue.get_sharding_config_loaded_time",
+            return_value=time.time(),
+        ), mock.patch(
+            "zerver.tornado.event_queue.get_previous_realm_tornado_ports", return_value=[9800]
+        ):
+            process_notification(notice("early"))
+            self.assertEqual(sorted(held_user_events), sorted([othello.id, hamlet.id]))
+
+            with self.assertLogs(level="INFO"):
+                process_notification(migrate_notice)
+            process_notification(forwarded_notice)
+
+            [migrated_client] = get_client_descriptors_for_user(othello.id)
+            self.assertEqual(migrated_client.event_queue.id, othello_client.event_queue.id)
+            self.assertEqual(
+                [event["data"] for event in migrated_client.event_queue.contents()],
+                ["early", "forwarded"],
+            )
+
+            # Hamlet had no queues to hand off, so his events are
+            # processed once the grace period is over.
+            self.assertEqual(list(held_user_events), [hamlet.id])
+            with mock.patch(
+                "zerver.tornado.event_queue.time.time",
+                return_value=time.time() + EVENT_QUEUE_MIGRATION_GRACE_PERIOD_SECS,
+            ):
+                expire_event_queue_migrations()
+            self.assertEqual(held_user_events, {})
+
+    def test_held_message_for_all_public_streams_clients(self) -> None:
+        iago = self.example_user("iago")
+        othello = self.example_user("othello")
+        queue_data = dict(
+            all_public_streams=True,
+            apply_markdown=True,
+            client_gravatar=True,
+            client_type_name="website",
+            event_types=["message"],
+            last_connection_time=time.time(),
+            queue_timeout=600,
+            realm_id=iago.realm_id,
+            user_profile_id=iago.id,
+        )
+        iago_client = allocate_client_descriptor(queue_data)
+
+        with self.capture_send_event_calls(expected_num_events=1) as events:
+            self.send_stream_message(self.example_user("cordelia"), "Denmark")
+        [notice] = events
+        [othello_data] = [user for user in notice["users"] if user["id"] == othello.id]
+
+        # Othello's queue has yet to arrive from port 9800, but Iago's
+        # client for all public streams is here, and gets the message
+        # now, and only once.
+        with self.settings(TORNADO_PROCESSES=2), mock.patch(
+            "zerver.tornado.event_queue.tornado_port", 9801
+        ), mock.patch(
+            "zerver.tornado.event_queue.get_sharding_config_loaded_time",
+            return_value=time.time(),
+        ), mock.patch(
+            "zerver.tornado.event_queue.get_previous_realm_tornado_ports", return_value=[9800]
+        ):
+            process_notification({**notice, "users": [othello_data]})
+            self.assertEqual(list(held_user_events), [othello.id])
+            self.assert_length(iago_client.event_queue.contents(), 1)
+
+            with mock.patch(
+                "zerver.tornado.event_queue.time.time",
+                return_value=time.time() + EVENT_QUEUE_MIGRATION_GRACE_PERIOD_SECS,
+            ):
+                expire_event_queue_migrations()
+            self.assertEqual(held_user_events, {})
+            self.assert_length(iago_client.event_queue.contents(), 1)
+
 
 class PruneInternalDataTest(ZulipTestCase):
     def test_prune_internal_data(self) -> None:
@@ -1286,6 +1652,54 @@ class EventQueueTest(ZulipTestCase):
         self.assertEqual(queue.contents(), [out_dict])
         self.verify_to_dict_end_to_end(client)
 
+    def test_finish_handlers_after_batch(self) -> None:
+        client = self.get_client_descriptor()
+        # Pretend that a long-polling request is waiting on this queue.
+        client.current_handler_id = 1
+        notices = [
+            dict(event=dict(type="test", data=data), users=[client.user_profile_id])
+            for data in ["first", "second", "third"]
+        ]
+        with mock.patch("zerver.tornado.event_queue.get_handler_by_id"), mock.patch(
+            "zerver.tornado.event_queue.async_request_timer_restart"
+        ), mock.patch.object(ClientDescriptor, "finish_current_handler") as finish:
+            get_wrapped_process_notification("notify_tornado")(notices)
+
+        # The client was only woken up once, with all three events.
+        finish.assert_called_once_with()
+        self.assertEqual(
+            [event["data"] for event in client.event_queue.contents()],
+            ["first", "second", "third"],
+        )
+
+    def test_shared_event_payload(self) -> None:
+        first_queue = self.get_client_descriptor().event_queue
+        second_queue = self.get_client_descriptor().event_queue
+        second_queue.push(dict(type="arbitrary", x="first"))
+
+        event = dict(type="arbitrary", x="shared", data=[1, 2])
+        first_queue.push(event)
+        second_queue.push(event)
+
+        # Both queues store a reference to the same payload, which is
+        # not modified by being pushed.
+        self.assertIs(first_queue.queue[0][1], event)
+        self.assertIs(second_queue.queue[1][1], event)
+        self.assertEqual(event, dict(type="arbitrary", x="shared", data=[1, 2]))
+
+        # The id is only filled in when reading the queue.
+        self.assertEqual(
+            first_queue.contents(), [dict(id=0, type="arbitrary", x="shared", data=[1, 2])]
+        )
+        self.assertEqual(
+            second_queue.contents(),
+            [
+                dict(id=0, type="arbitrary", x="first"),
+                dict(id=1, type="arbitrary", x="shared", data=[1, 2]),
+            ],
+        )
+        self.assertNotIn("id", event)
+
     def test_event_collapsing(self) -> None:
         client = self.get_client_descriptor()
         queue = client.event_queue
@@ -1374,6 +1788,94 @@ class EventQueueTest(ZulipTestCase):
             ],
         )
 
+    def test_flag_read_unread_ordering(self) -> None:
+        client = self.get_client_descriptor()
+        queue = client.event_queue
+
+        def read_event(operation: str, messages: List[int]) -> Dict[str, Any]:
+            event: Dict[str, Any] = dict(
+                type="update_message_flags",
+                operation=operation,
+                flag="read",
+                all=False,
+                messages=messages,
+            )
+            if operation == "remove":
+                event["message_details"] = {
+                    str(message_id): dict(type="stream") for message_id in messages
+                }
+            return event
+
+        queue.push(read_event("add", [1, 2]))
+        queue.push(read_event("add", [3]))
+        # Marking a message as unread flushes the pending mark-as-read
+        # event, so the two are delivered in the order they happened.
+        queue.push(read_event("remove", [2]))
+        queue.push(read_event("remove", [3]))
+        queue.push(read_event("add", [2]))
+        self.verify_to_dict_end_to_end(client)
+
+        self.assertEqual(
+            [
+                (event["operation"], event["messages"], event.get("message_details"))
+                for event in queue.contents()
+            ],
+            [
+                ("add", [1, 2, 3], None),
+                ("remove", [2, 3], {"2": dict(type="stream"), "3": dict(type="stream")}),
+                ("add", [2], None),
+            ],
+        )
+
+    def test_typing_and_presence_collapsing(self) -> None:
+        client = self.get_client_descriptor()
+        queue = client.event_queue
+
+        def typing_event(op: str, sender_id: int, stream_id: int) -> Dict[str, Any]:
+            return dict(
+                type="typing",
+                message_type="stream",
+                op=op,
+                sender=dict(user_id=sender_id, email=f"user{sender_id}@zulip.testserver"),
+                stream_id=stream_id,
+                topic="test",
+            )
+
+        def presence_event(client_name: str, status: str, timestamp: int) -> Dict[str, Any]:
+            return dict(
+                type="presence",
+                user_id=10,
+                server_timestamp=timestamp,
+                presence={client_name: dict(status=status, timestamp=timestamp)},
+            )
+
+        queue.push(typing_event("start", sender_id=10, stream_id=1))
+        queue.push(presence_event("website", "active", timestamp=1))
+        queue.push(typing_event("start", sender_id=11, stream_id=1))
+        queue.push(dict(type="unknown"))
+        queue.push(typing_event("stop", sender_id=10, stream_id=1))
+        queue.push(presence_event("ZulipMobile", "idle", timestamp=2))
+        self.verify_to_dict_end_to_end(client)
+
+        self.assertEqual(
+            queue.contents(),
+            [
+                dict(id=2, **typing_event("start", sender_id=11, stream_id=1)),
+                dict(id=3, type="unknown"),
+                dict(id=4, **typing_event("stop", sender_id=10, stream_id=1)),
+                dict(
+                    id=5,
+                    type="presence",
+                    user_id=10,
+                    server_timestamp=2,
+                    presence={
+                        "website": dict(status="active", timestamp=1),
+                        "ZulipMobile": dict(status="idle", timestamp=2),
+                    },
+                ),
+            ],
+        )
+
     def test_flag_add_collapsing(self) -> None:
         client = self.get_client_descriptor()
         queue = client.event_queue
@@ -1476,7 +1978,7 @@ class EventQueueTest(ZulipTestCase):
         self.verify_to_dict_end_to_end(client)
 
         queue.push({"type": "unknown", "timestamp": "1"})
-        self.assertEqual(list(queue.queue), [{"id": 1, "type": "unknown", "timestamp": "1"}])
+        self.assertEqual(list(queue.queue), [(1, {"type": "unknown", "timestamp": "1"})])
         self.assertEqual(
             queue.virtual_events,
             {"restart": {"id": 0, "type": "restart", "server_generation": 1, "timestamp": "1"}},
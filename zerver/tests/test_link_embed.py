@@ -1,4 +1,5 @@
 import re
+import threading
 from collections import OrderedDict
 from typing import Any, Optional, Union
 from unittest import mock
@@ -12,14 +13,26 @@ from requests.exceptions import ConnectionError
 from typing_extensions import override
 
 from zerver.actions.message_delete import do_delete_messages
-from zerver.lib.cache import cache_delete, cache_get, preview_url_cache_key
+from zerver.lib.cache import (
+    cache_delete,
+    cache_get,
+    cache_set,
+    preview_host_failure_cache_key,
+    preview_url_cache_key,
+)
 from zerver.lib.camo import get_camo_url
 from zerver.lib.queue import queue_json_publish
 from zerver.lib.test_classes import ZulipTestCase
 from zerver.lib.test_helpers import mock_queue_publish
 from zerver.lib.url_preview.oembed import get_oembed_data, strip_cdata
-from zerver.lib.url_preview.parsers import GenericParser, OpenGraphParser
-from zerver.lib.url_preview.preview import get_link_embed_data
+from zerver.lib.url_preview.parsers import GenericParser, HeadParser, OpenGraphParser
+from zerver.lib.url_preview.preview import (
+    PREVIEW_CHUNK_SIZE,
+    fetch_html_prefix,
+    get_link_embed_data,
+    host_semaphores,
+    limit_host_fetches,
+)
 from zerver.lib.url_preview.types import UrlEmbedData, UrlOEmbedData
 from zerver.models import Message, Realm, UserProfile
 from zerver.worker.queue_processors import FetchLinksEmbedData
@@ -838,7 +851,7 @@ class PreviewTestCase(ZulipTestCase):
 
     @responses.activate
     @override_settings(INLINE_URL_EMBED_PREVIEW=True)
-    def test_valid_content_type_error_get_data(self) -> None:
+    def test_page_fetch_error_get_data(self) -> None:
         url = "http://test.org/"
         with mock_queue_publish("zerver.actions.message_send.queue_json_publish"):
             msg_id = self.send_personal_message(
@@ -860,20 +873,17 @@ class PreviewTestCase(ZulipTestCase):
             "zerver.lib.url_preview.preview.get_oembed_data",
             side_effect=lambda *args, **kwargs: None,
         ):
-            with mock.patch(
-                "zerver.lib.url_preview.preview.valid_content_type", side_effect=lambda k: True
-            ):
-                with self.settings(TEST_SUITE=False):
-                    with self.assertLogs(level="INFO") as info_logs:
-                        FetchLinksEmbedData().consume(event)
-                    self.assertTrue(
-                        "INFO:root:Time spent on get_link_embed_data for http://test.org/: "
-                        in info_logs.output[0]
-                    )
+            with self.settings(TEST_SUITE=False):
+                with self.assertLogs(level="INFO") as info_logs:
+                    FetchLinksEmbedData().consume(event)
+                self.assertTrue(
+                    "INFO:root:Time spent on get_link_embed_data for http://test.org/: "
+                    in info_logs.output[0]
+                )
 
-                    # This did not get cached -- hence the lack of [0] on the cache_get
-                    cached_data = cache_get(preview_url_cache_key(url))
-                    self.assertIsNone(cached_data)
+                # This did not get cached -- hence the lack of [0] on the cache_get
+                cached_data = cache_get(preview_url_cache_key(url))
+                self.assertIsNone(cached_data)
 
         msg.refresh_from_db()
         self.assertEqual(
@@ -1035,3 +1045,141 @@ class PreviewTestCase(ZulipTestCase):
         msg.refresh_from_db()
         expected_content = f"""<p><a href="https://www.youtube.com/watch?v=eSJTXC7Ixgg">YouTube link</a></p>\n<div class="youtube-video message_inline_image"><a data-id="eSJTXC7Ixgg" href="https://www.youtube.com/watch?v=eSJTXC7Ixgg"><img src="{get_camo_url("https://i.ytimg.com/vi/eSJTXC7Ixgg/default.jpg")}"></a></div>"""
         self.assertEqual(expected_content, msg.rendered_content)
+
+    @responses.activate
+    @override_settings(INLINE_URL_EMBED_PREVIEW=True)
+    def test_fetch_links_in_parallel(self) -> None:
+        urls = ["http://test.org/", "http://edited.org/"]
+        with mock_queue_publish("zerver.actions.message_send.queue_json_publish") as patched:
+            self.send_personal_message(
+                self.example_user("hamlet"),
+                self.example_user("cordelia"),
+                content=" ".join(urls),
+            )
+            event = patched.call_args[0][1]
+
+        # Neither fetch can finish until both have started.
+        barrier = threading.Barrier(len(urls), timeout=5)
+
+        def get_link_embed_data(url: str) -> UrlEmbedData:
+            barrier.wait()
+            return UrlEmbedData(title=url)
+
+        with self.settings(TEST_SUITE=False), self.assertLogs(level="INFO") as info_logs:
+            with mock.patch(
+                "zerver.worker.queue_processors.url_preview.get_link_embed_data",
+                get_link_embed_data,
+            ):
+                FetchLinksEmbedData().consume(event)
+        for url in urls:
+            self.assertTrue(
+                any(f"Time spent on get_link_embed_data for {url}: " in o for o in info_logs.output)
+            )
+
+    @responses.activate
+    def test_stale_preview_revalidated(self) -> None:
+        url = "http://test.org/"
+        stale_data = UrlEmbedData(title="Stale title")
+        cache_set(preview_url_cache_key(url), stale_data)
+        self.create_mock_response(url)
+
+        with mock.patch("zerver.lib.url_preview.preview.revalidation_executor") as executor:
+            # The stale preview is used while it is refetched, once.
+            self.assertEqual(get_link_embed_data(url), stale_data)
+            self.assertEqual(get_link_embed_data(url), stale_data)
+            executor.submit.assert_called_once()
+            [revalidate] = executor.submit.call_args[0]
+            revalidate()
+
+            embed_data = get_link_embed_data(url)
+            executor.submit.assert_called_once()
+        assert embed_data is not None
+        self.assertEqual(embed_data.title, "The Rock")
+
+    @responses.activate
+    def test_failing_host_skipped(self) -> None:
+        url = "http://test.org/"
+        other_url = "http://test.org/other"
+        self.create_mock_response(url, body=ConnectionError())
+        self.create_mock_response(other_url)
+
+        self.assertIsNone(get_link_embed_data(url))
+        # The failure is not cached for the URL...
+        self.assertIsNone(cache_get(preview_url_cache_key(url)))
+        # ...but we stop trying the host for a while.
+        self.assertIsNone(get_link_embed_data(other_url))
+        self.assertTrue(responses.assert_call_count(other_url, 0))
+
+        cache_delete(preview_host_failure_cache_key("test.org"))
+        embed_data = get_link_embed_data(other_url)
+        assert embed_data is not None
+        self.assertEqual(embed_data.title, "The Rock")
+
+    @responses.activate
+    def test_host_semaphores_dropped_when_idle(self) -> None:
+        url = "http://test.org/"
+        self.create_mock_response(url)
+
+        with limit_host_fetches("test.org"):
+            self.assertEqual(list(host_semaphores), ["test.org"])
+            # Fetches from the same host share its semaphore.
+            self.assertIsNotNone(get_link_embed_data(url))
+            self.assertEqual(list(host_semaphores), ["test.org"])
+        self.assertEqual(host_semaphores, {})
+
+    @responses.activate
+    def test_fetch_html_prefix(self) -> None:
+        url = "http://test.org/"
+        head = """<html><head>
+            <meta property="og:title" content="The Rock" />
+            <meta property="og:description" content="The Rock film" />
+            <meta property="og:image" content="http://ia.media-imdb.com/images/rock.jpg" />
+            </head><body>"""
+        body = "<p>Filler text</p>" * 100000
+        self.create_mock_response(url, body=head + body)
+
+        # With everything we need from the <head>, we stop reading.
+        html_prefix = fetch_html_prefix(url)
+        assert html_prefix is not None
+        self.assert_length(html_prefix.content, PREVIEW_CHUNK_SIZE)
+        self.assertEqual(
+            OpenGraphParser(html_prefix.content, "text/html").extract_data().title, "The Rock"
+        )
+
+        # Otherwise, we keep looking in the body, up to a limit...
+        self.create_mock_response(url, body=head.replace("og:image", "og:other") + body)
+        with mock.patch("zerver.lib.url_preview.preview.MAX_PREVIEW_BYTES", 4 * PREVIEW_CHUNK_SIZE):
+            html_prefix = fetch_html_prefix(url)
+        assert html_prefix is not None
+        self.assert_length(html_prefix.content, 4 * PREVIEW_CHUNK_SIZE)
+
+        # ...of both size and time.
+        with mock.patch("zerver.lib.url_preview.preview.PREVIEW_READ_SECS", 0):
+            html_prefix = fetch_html_prefix(url)
+        assert html_prefix is not None
+        self.assert_length(html_prefix.content, PREVIEW_CHUNK_SIZE)
+
+
+class HeadParserTestCase(ZulipTestCase):
+    def test_head_parser(self) -> None:
+        html = b"""<html>
+          <head>
+            <title>Test title</title>
+            <meta name="description" content="Description text" />
+            <meta property="og:image" content="http://test.com/test.jpg" />
+          </head>
+          <body>
+            <h1>Main header</h1>"""
+        parser = HeadParser()
+        parser.feed(html[:100])
+        self.assertTrue(parser.has_title)
+        self.assertFalse(parser.complete)
+        parser.feed(html[100:])
+        self.assertTrue(parser.complete)
+
+        # Without an image, we need to look for one in the body.
+        parser = HeadParser()
+        parser.feed(html.replace(b"og:image", b"og:other"))
+        self.assertTrue(parser.head_done)
+        self.assertFalse(parser.has_image)
+        self.assertFalse(parser.complete)
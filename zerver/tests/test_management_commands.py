@@ -18,6 +18,7 @@ from confirmation.models import RealmCreationKey, generate_realm_creation_url
 from zerver.actions.create_user import do_create_user
 from zerver.actions.reactions import do_add_reaction
 from zerver.lib.management import ZulipBaseCommand, check_config
+from zerver.lib.markdown import version as markdown_version
 from zerver.lib.test_classes import ZulipTestCase
 from zerver.lib.test_helpers import most_recent_message, stdout_suppressed
 from zerver.models import (
@@ -392,6 +393,50 @@ class TestCalculateFirstVisibleMessageID(ZulipTestCase):
         m.assert_has_calls(calls, any_order=True)
 
 
+class TestRerenderMessages(ZulipTestCase):
+    COMMAND_NAME = "rerender_messages"
+
+    def test_rerender_messages(self) -> None:
+        hamlet = self.example_user("hamlet")
+        message_ids = [
+            self.send_stream_message(hamlet, "Denmark", f"Hello @**King Hamlet** {i}")
+            for i in range(3)
+        ]
+        expected = {
+            message.id: message.rendered_content
+            for message in Message.objects.filter(id__in=message_ids)
+        }
+        Message.objects.filter(id__in=message_ids[:2]).update(
+            rendered_content="<p>stale</p>", rendered_content_version=None
+        )
+        Message.objects.filter(id=message_ids[2]).update(rendered_content="<p>current</p>")
+
+        with stdout_suppressed():
+            call_command(self.COMMAND_NAME, "--realm=zulip", "--batch-size=1")
+        messages = Message.objects.filter(id__in=message_ids).order_by("id")
+        self.assertEqual(
+            [message.rendered_content for message in messages],
+            [expected[message_ids[0]], expected[message_ids[1]], "<p>current</p>"],
+        )
+        for message in messages:
+            self.assertEqual(message.rendered_content_version, markdown_version)
+
+        # With --all, messages rendered by the current version are
+        # re-rendered too.
+        with mock.patch(
+            "zerver.management.commands.rerender_messages.messages_to_rerender",
+            return_value=Message.objects.filter(id__in=message_ids),
+        ) as m, stdout_suppressed():
+            call_command(self.COMMAND_NAME, "--realm=zulip", "--all")
+        m.assert_called_with(get_realm("zulip"), True)
+        self.assertEqual(
+            Message.objects.get(id=message_ids[2]).rendered_content, expected[message_ids[2]]
+        )
+
+        with self.assertRaisesRegex(CommandError, "You must have at least one process."):
+            call_command(self.COMMAND_NAME, "--realm=zulip", "--processes=0")
+
+
 class TestPasswordRestEmail(ZulipTestCase):
     COMMAND_NAME = "send_password_reset_email"
 
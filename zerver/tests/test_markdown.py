@@ -1,6 +1,8 @@
 import copy
 import os
 import re
+import time
+from collections import OrderedDict
 from html import escape
 from textwrap import dedent
 from typing import Any, Dict, List, Optional, Set, Tuple
@@ -17,9 +19,10 @@ from zerver.actions.alert_words import do_add_alert_words
 from zerver.actions.create_realm import do_create_realm
 from zerver.actions.realm_emoji import do_remove_realm_emoji
 from zerver.actions.realm_settings import do_set_realm_property
-from zerver.actions.user_groups import check_add_user_group
-from zerver.actions.user_settings import do_change_user_setting
+from zerver.actions.user_groups import bulk_add_members_to_user_groups, check_add_user_group
+from zerver.actions.user_settings import do_change_full_name, do_change_user_setting
 from zerver.actions.users import change_user_is_active
+from zerver.lib import tex
 from zerver.lib.alert_words import get_alert_word_automaton
 from zerver.lib.camo import get_camo_url
 from zerver.lib.create_user import create_user
@@ -27,23 +30,36 @@ from zerver.lib.emoji import codepoint_to_name, get_emoji_url
 from zerver.lib.emoji_utils import hex_codepoint_to_emoji
 from zerver.lib.exceptions import JsonableError, MarkdownRenderingError
 from zerver.lib.markdown import (
+    DEFAULT_MARKDOWN_KEY,
     POSSIBLE_EMOJI_RE,
     InlineInterestingLinkProcessor,
+    LinkifierPrefilter,
     MarkdownListPreprocessor,
     MessageRenderingResult,
     clear_state_for_testing,
     content_has_emoji_syntax,
     fetch_tweet_data,
+    get_markdown_cache_hits,
+    get_markdown_cache_misses,
+    get_markdown_render_pool,
+    get_markdown_render_pool_stats,
     get_tweet_id,
     image_preview_enabled,
     markdown_convert,
     maybe_update_markdown_engines,
+    md_engines,
     possible_linked_stream_names,
     topic_links,
     url_embed_preview_enabled,
     url_to_a,
 )
 from zerver.lib.markdown.fenced_code import FencedBlockPreprocessor
+from zerver.lib.markdown.render_pool import (
+    RenderCPULimitExceededError,
+    RenderPool,
+    RenderTimeoutError,
+    RenderWorkerError,
+)
 from zerver.lib.mdiff import diff_strings
 from zerver.lib.mention import (
     FullNameInfo,
@@ -51,15 +67,17 @@ from zerver.lib.mention import (
     MentionData,
     PossibleMentions,
     get_possible_mentions_info,
+    get_realm_mention_cache,
     possible_mentions,
     possible_user_group_mentions,
     stream_wildcards,
     topic_wildcards,
 )
-from zerver.lib.message import render_markdown
+from zerver.lib.message import render_markdown, render_markdown_batch
 from zerver.lib.per_request_cache import flush_per_request_caches
 from zerver.lib.test_classes import ZulipTestCase
-from zerver.lib.tex import render_tex
+from zerver.lib.test_helpers import queries_captured
+from zerver.lib.tex import render_tex, render_tex_many
 from zerver.models import (
     Message,
     RealmEmoji,
@@ -302,6 +320,68 @@ class MarkdownMiscTest(ZulipTestCase):
                 render_tex("random text")
             self.assertEqual(m.output, ["ERROR:root:Cannot find KaTeX for latex rendering!"])
 
+    def test_katex_server(self) -> None:
+        tex.tex_cache.clear()
+        html = render_tex("x^2")
+        assert html is not None
+        self.assertIn('class="katex"', html)
+        self.assertIsNone(render_tex(r"\frac{"))
+
+        # Results, including errors, are memoized.
+        with mock.patch.object(tex.KatexServer, "send") as send:
+            self.assertEqual(render_tex("x^2"), html)
+            self.assertIsNone(render_tex(r"\frac{"))
+        send.assert_not_called()
+
+        # Several formulas can be rendered at once, and are split into
+        # batches that fit in the pipe buffers.
+        with mock.patch("zerver.lib.tex.KATEX_MAX_BATCH_BYTES", 1):
+            rendered = render_tex_many([("x^2", True), ("y", False), ("z", True), ("y", False)])
+        self.assertEqual(rendered[0], html)
+        assert rendered[1] is not None
+        self.assertIn('class="katex-display"', rendered[1])
+        self.assertEqual(rendered[1], rendered[3])
+        self.assertIsNotNone(rendered[2])
+
+        tex.tex_cache.clear()
+        with mock.patch("zerver.lib.tex.TEX_CACHE_SIZE", 1):
+            render_tex_many([("x^2", True), ("y", True)])
+        self.assertEqual(list(tex.tex_cache), [("y", True)])
+
+        # The server is restarted if it has died.
+        server = tex.katex_server
+        assert server is not None
+        server.process.kill()
+        server.process.wait()
+        self.assertEqual(render_tex("x^2"), html)
+        self.assertIsNot(tex.katex_server, server)
+
+        # Formulas that take too long are given up on, and the server
+        # is restarted for the next one.
+        with mock.patch("zerver.lib.tex.KATEX_TIMEOUT_SECS", 0), self.assertLogs(
+            level="WARNING"
+        ) as m:
+            self.assertIsNone(render_tex("a"))
+        self.assertEqual(m.output, ["WARNING:root:Timed out rendering TeX: a"])
+        self.assertIsNone(tex.katex_server)
+        self.assertIsNotNone(render_tex("a"))
+
+        # We only restart the server once per render.
+        with mock.patch.object(
+            tex.KatexServer, "send", side_effect=BrokenPipeError
+        ) as send, self.assertLogs(level="ERROR") as m:
+            self.assertIsNone(render_tex("b"))
+        self.assertEqual(send.call_count, 2)
+        self.assertTrue(m.output[0].startswith("ERROR:root:KaTeX server failed"))
+
+        # Any other error leaves the server in an unknown state.
+        render_tex("c")
+        with mock.patch.object(tex.KatexServer, "receive", side_effect=ValueError):
+            with self.assertRaises(ValueError):
+                render_tex("d")
+        self.assertIsNone(tex.katex_server)
+        tex.tex_cache.clear()
+
 
 class MarkdownListPreprocessorTest(ZulipTestCase):
     # We test that the preprocessor inserts blank lines at correct places.
@@ -1108,6 +1188,22 @@ class MarkdownTest(ZulipTestCase):
         converted = render_markdown(msg, content)
         self.assertEqual(converted.rendered_content, expected)
 
+    def test_mixed_emoji(self) -> None:
+        user_profile = self.example_user("othello")
+        do_change_user_setting(user_profile, "translate_emoticons", True, acting_user=None)
+        msg = Message(
+            sender=user_profile, sending_client=get_client("test"), realm=user_profile.realm
+        )
+
+        # Each way of writing emoji, side by side in one message.
+        content = ":green_tick: :coffee: :) \u2615 :not_an_emoji: 1:)"
+        converted = render_markdown(msg, content).rendered_content
+        assert converted is not None
+        self.assertIn('<img alt=":green_tick:" class="emoji"', converted)
+        self.assertEqual(converted.count('title="coffee">:coffee:</span>'), 2)
+        self.assertIn('title="smile">:smile:</span>', converted)
+        self.assertIn(" :not_an_emoji: 1:)</p>", converted)
+
     def test_same_markup(self) -> None:
         msg = "\u2615"  # ☕
         unicode_converted = markdown_convert_wrapper(msg)
@@ -1208,6 +1304,79 @@ class MarkdownTest(ZulipTestCase):
             linkifier.save()
             self.assertEqual(repr(linkifier), expected_linkifier_repr)
 
+    def test_linkifier_prefilter(self) -> None:
+        prefilter = LinkifierPrefilter([r"#(?P<id>[0-9]+)", r"(?P<id>ZUL-[0-9]+)"])
+        self.assertTrue(prefilter.may_match(0, "See #123"))
+        self.assertFalse(prefilter.may_match(1, "See #123"))
+        self.assertTrue(prefilter.may_match(1, "See ZUL-123"))
+        self.assertFalse(prefilter.may_match(0, ""))
+
+        # A linkifier set that cannot be compiled does not filter anything.
+        self.assertTrue(LinkifierPrefilter(["("]).may_match(0, "anything"))
+
+    def test_linkifier_change_patches_md_engine(self) -> None:
+        realm = get_realm("zulip")
+        content = "Fix #224 and ZUL-123"
+        self.assertEqual(
+            markdown_convert(content, message_realm=realm).rendered_content,
+            "<p>Fix #224 and ZUL-123</p>",
+        )
+        md_engine = md_engines[(realm.id, False)]
+
+        linkifier = RealmFilter(
+            realm=realm,
+            pattern=r"#(?P<id>[0-9]{2,8})",
+            url_template=r"https://trac.example.com/ticket/{id}",
+        )
+        linkifier.save()
+        RealmFilter(
+            realm=realm,
+            pattern=r"(?P<id>ZUL-[0-9]+)",
+            url_template=r"https://jira.example.com/browse/{id}",
+        ).save()
+        flush_per_request_caches()
+        self.assertEqual(
+            markdown_convert(content, message_realm=realm).rendered_content,
+            '<p>Fix <a href="https://trac.example.com/ticket/224">#224</a>'
+            ' and <a href="https://jira.example.com/browse/ZUL-123">ZUL-123</a></p>',
+        )
+        # The engine's linkifier patterns were replaced in place.
+        self.assertIs(md_engines[(realm.id, False)], md_engine)
+
+        linkifier.delete()
+        flush_per_request_caches()
+        self.assertEqual(
+            markdown_convert(content, message_realm=realm).rendered_content,
+            '<p>Fix #224 and <a href="https://jira.example.com/browse/ZUL-123">ZUL-123</a></p>',
+        )
+        self.assertIs(md_engines[(realm.id, False)], md_engine)
+
+    def test_md_engine_eviction(self) -> None:
+        zulip_realm = get_realm("zulip")
+        lear_realm = get_realm("lear")
+        with mock.patch("zerver.lib.markdown.MAX_MD_ENGINE_REALMS", 2), mock.patch(
+            "zerver.lib.markdown.md_engines", {}
+        ) as engines, mock.patch(
+            "zerver.lib.markdown.linkifier_data", OrderedDict()
+        ) as linkifiers_by_key:
+            markdown_convert("test", message_realm=zulip_realm)
+            markdown_convert("test", message_realm=zulip_realm, email_gateway=True)
+            markdown_convert("test", message_realm=lear_realm)
+            markdown_convert("test", message_realm=zulip_realm)
+            self.assertEqual(list(linkifiers_by_key), [lear_realm.id, zulip_realm.id])
+
+            # The least recently used realm's engines are dropped.
+            markdown_convert("test")
+            self.assertEqual(list(linkifiers_by_key), [zulip_realm.id, DEFAULT_MARKDOWN_KEY])
+            self.assertEqual(
+                set(engines),
+                {
+                    (zulip_realm.id, False),
+                    (zulip_realm.id, True),
+                    (DEFAULT_MARKDOWN_KEY, False),
+                },
+            )
+
     def test_realm_patterns(self) -> None:
         realm = get_realm("zulip")
         self.check_add_linkifiers(
@@ -3197,8 +3366,10 @@ class MarkdownErrorTests(ZulipTestCase):
         """A rendered message with an ultra-long length (> 100 * MAX_MESSAGE_LENGTH)
         throws an exception"""
         msg = "mock rendered message\n" * 10 * settings.MAX_MESSAGE_LENGTH
+        rendering_result = markdown_convert("")
+        rendering_result.rendered_content = msg
 
-        with mock.patch("zerver.lib.markdown.timeout", return_value=msg), mock.patch(
+        with mock.patch("zerver.lib.markdown.timeout", return_value=rendering_result), mock.patch(
             "zerver.lib.markdown.markdown_logger"
         ):
             with self.assertRaises(MarkdownRenderingError):
@@ -3242,6 +3413,292 @@ class MarkdownErrorTests(ZulipTestCase):
         self.assertEqual(result, expected)
 
 
+class MarkdownRenderingCacheTest(ZulipTestCase):
+    def assert_cache_counts(self, hits: int, misses: int) -> None:
+        self.assertEqual(get_markdown_cache_hits() - self.initial_hits, hits)
+        self.assertEqual(get_markdown_cache_misses() - self.initial_misses, misses)
+
+    @override
+    def setUp(self) -> None:
+        super().setUp()
+        self.initial_hits = get_markdown_cache_hits()
+        self.initial_misses = get_markdown_cache_misses()
+
+    @override_settings(MARKDOWN_RENDER_CACHE=True)
+    def test_rendering_cache(self) -> None:
+        hamlet = self.example_user("hamlet")
+        realm = hamlet.realm
+        content = "Hi @**King Hamlet**, see https://example.com/ :smile:"
+
+        first = markdown_convert(content, message_realm=realm)
+        self.assert_cache_counts(hits=0, misses=1)
+        self.assertEqual(markdown_convert(content, message_realm=realm), first)
+        self.assert_cache_counts(hits=1, misses=1)
+
+        # Messages get the has_link flag of the cached render.
+        message = Message(sender=hamlet, sending_client=get_client("test"), realm=realm)
+        render_markdown(message, content)
+        self.assert_cache_counts(hits=1, misses=2)
+        message = Message(sender=hamlet, sending_client=get_client("test"), realm=realm)
+        self.assertEqual(render_markdown(message, content), first)
+        self.assert_cache_counts(hits=2, misses=2)
+        self.assertTrue(message.has_link)
+
+        # Renaming the mentioned user changes the data the render
+        # depends on, so the cached render is not used.
+        do_change_full_name(hamlet, "Prince Hamlet", acting_user=None)
+        renamed = markdown_convert(content, message_realm=realm)
+        self.assert_cache_counts(hits=2, misses=3)
+        self.assertEqual(renamed.mentions_user_ids, set())
+
+        # Renders are not cached when embed data is passed in, nor
+        # if they are too large.
+        markdown_convert(content, message_realm=realm, url_embed_data={})
+        with mock.patch("zerver.lib.markdown.RENDERING_CACHE_MAX_LENGTH", 10):
+            markdown_convert("too long to cache", message_realm=realm)
+        markdown_convert("too long to cache", message_realm=realm)
+        self.assert_cache_counts(hits=2, misses=5)
+
+    @override_settings(MARKDOWN_RENDER_CACHE=True)
+    def test_rendering_cache_alert_words(self) -> None:
+        othello = self.example_user("othello")
+        cordelia = self.example_user("cordelia")
+        realm = othello.realm
+        content = "Is the castle ready?"
+
+        do_add_alert_words(othello, ["castle"])
+        rendering_result = markdown_convert(
+            content,
+            message_realm=realm,
+            realm_alert_words_automaton=get_alert_word_automaton(realm),
+        )
+        self.assertEqual(rendering_result.user_ids_with_alert_words, {othello.id})
+        rendering_result = markdown_convert(
+            content,
+            message_realm=realm,
+            realm_alert_words_automaton=get_alert_word_automaton(realm),
+        )
+        self.assertEqual(rendering_result.user_ids_with_alert_words, {othello.id})
+        self.assert_cache_counts(hits=1, misses=1)
+
+        # A render without alert words does not use that cache entry.
+        rendering_result = markdown_convert(content, message_realm=realm)
+        self.assertEqual(rendering_result.user_ids_with_alert_words, set())
+        self.assert_cache_counts(hits=1, misses=2)
+
+        do_add_alert_words(cordelia, ["castle"])
+        rendering_result = markdown_convert(
+            content,
+            message_realm=realm,
+            realm_alert_words_automaton=get_alert_word_automaton(realm),
+        )
+        self.assertEqual(rendering_result.user_ids_with_alert_words, {othello.id, cordelia.id})
+        self.assert_cache_counts(hits=1, misses=3)
+
+
+def render_pool_test_function(action: str) -> int:
+    if action == "spin":
+        while True:
+            pass
+    elif action == "sleep":
+        time.sleep(60)
+    elif action == "fail":
+        raise ValueError("bad input")
+    elif action == "exit":
+        os._exit(1)
+    return os.getpid()
+
+
+class MarkdownBatchRenderingTest(ZulipTestCase):
+    def test_render_markdown_batch(self) -> None:
+        hamlet = self.example_user("hamlet")
+        othello = self.example_user("othello")
+        realm = hamlet.realm
+        check_add_user_group(realm, "support", [othello], acting_user=None)
+
+        def make_messages(contents: List[str]) -> List[Message]:
+            return [
+                Message(sender=hamlet, sending_client=get_client("test"), realm=realm)
+                for content in contents
+            ]
+
+        contents = [
+            "Hi @**king hamlet** and @**Othello, the Moor of Venice**",
+            f"@**King Hamlet|{hamlet.id}**, @**|{othello.id}** and @**Nobody**",
+            "@*support* and @*nonexistent*, see #**Verona** and #**nowhere** :green_tick:",
+            "Nothing to see here",
+        ]
+        expected = [
+            render_markdown(message, content).rendered_content
+            for message, content in zip(make_messages(contents), contents)
+        ]
+        rendering_results = render_markdown_batch(realm, make_messages(contents), contents)
+        self.assertEqual(
+            [
+                rendering_result.rendered_content
+                for rendering_result in rendering_results
+                if rendering_result
+            ],
+            expected,
+        )
+
+        # The number of queries does not grow with the number of
+        # messages in the batch.
+        with mock.patch("zerver.lib.mention.realm_mention_caches", {}), queries_captured(
+            keep_cache_warm=True
+        ) as queries:
+            render_markdown_batch(realm, make_messages(contents[:1]), contents[:1])
+        one_message_queries = len(queries)
+        with mock.patch("zerver.lib.mention.realm_mention_caches", {}), queries_captured(
+            keep_cache_warm=True
+        ) as queries:
+            render_markdown_batch(realm, make_messages(contents), contents)
+        # Only the user group and stream mentions add queries: one for
+        # the groups, one for their members, and one for the streams.
+        self.assertEqual(len(queries), one_message_queries + 3)
+
+        # Messages which fail to render are skipped.
+        with mock.patch("zerver.lib.message.render_markdown", side_effect=MarkdownRenderingError):
+            self.assertEqual(
+                render_markdown_batch(realm, make_messages(contents), contents),
+                [None] * len(contents),
+            )
+
+    def test_mention_backend_prefetch(self) -> None:
+        hamlet = self.example_user("hamlet")
+        mention_backend = MentionBackend(hamlet.realm_id)
+        contents = [
+            f"@**King Hamlet** @**King Hamlet|{hamlet.id}** @**|{hamlet.id}**",
+            "@**Nobody**",
+        ]
+        with self.assert_database_query_count(1):
+            mention_backend.prefetch_mention_data(contents)
+
+        with self.assert_database_query_count(0):
+            mention_data = MentionData(mention_backend, contents[0])
+            MentionData(mention_backend, contents[1])
+        user = mention_data.get_user_by_id(hamlet.id)
+        assert user is not None
+        self.assertEqual(user.full_name, "King Hamlet")
+
+    def test_realm_mention_cache(self) -> None:
+        hamlet = self.example_user("hamlet")
+        realm = hamlet.realm
+        user_group = check_add_user_group(realm, "support", [], acting_user=None)
+        content = "@**King Hamlet** @*support*"
+
+        def get_mention_data() -> MentionData:
+            mention_backend = MentionBackend(realm.id, get_realm_mention_cache(realm.id))
+            return MentionData(mention_backend, content)
+
+        get_mention_data()
+        # Later batches reuse the lookups.
+        with self.assert_database_query_count(0, keep_cache_warm=True):
+            mention_data = get_mention_data()
+        self.assertIsNotNone(mention_data.get_user_by_name("King Hamlet"))
+        self.assertEqual(mention_data.get_group_members(user_group.id), [])
+
+        # Changes to user groups reset the realm's cache.
+        bulk_add_members_to_user_groups([user_group], [hamlet.id], acting_user=None)
+        self.assertEqual(get_mention_data().get_group_members(user_group.id), [hamlet.id])
+
+        # As do changes to users' names.
+        do_change_full_name(hamlet, "Prince Hamlet", acting_user=None)
+        self.assertIsNone(get_mention_data().get_user_by_name("King Hamlet"))
+
+        # Cached lookups are only used for a limited time.
+        with mock.patch(
+            "zerver.lib.mention.REALM_MENTION_CACHE_MAX_AGE", -1
+        ), self.assert_database_query_count(3, keep_cache_warm=True):
+            get_mention_data()
+
+
+class MarkdownRenderPoolTest(ZulipTestCase):
+    def test_render_message_in_pool(self) -> None:
+        hamlet = self.example_user("hamlet")
+        content = "**hello** @**King Hamlet** https://example.com/"
+        expected = markdown_convert(content, message_realm=hamlet.realm)
+        expected_message = Message(
+            sender=hamlet, sending_client=get_client("test"), realm=hamlet.realm
+        )
+        render_markdown(expected_message, content)
+
+        with self.settings(MARKDOWN_RENDER_PROCESSES=1), mock.patch(
+            "zerver.lib.markdown.markdown_render_pool", None
+        ):
+            self.assertIsNone(get_markdown_render_pool_stats())
+            rendering_result = markdown_convert(content, message_realm=hamlet.realm)
+            self.assertEqual(rendering_result, expected)
+            self.assertEqual(rendering_result.mentions_user_ids, {hamlet.id})
+
+            message = Message(sender=hamlet, sending_client=get_client("test"), realm=hamlet.realm)
+            render_markdown(message, content)
+            self.assertTrue(message.has_link)
+            self.assertEqual(message.has_link, expected_message.has_link)
+            self.assertEqual(message.has_image, expected_message.has_image)
+
+            stats = get_markdown_render_pool_stats()
+            assert stats is not None
+            self.assertEqual(stats.renders, 2)
+            self.assertEqual(stats.busy_workers, 0)
+            self.assertEqual(stats.queue_depth, 0)
+
+            render_pool = get_markdown_render_pool()
+            assert render_pool is not None
+            self.assertEqual(len(render_pool.idle_workers), 1)
+            render_pool.shutdown()
+
+    def test_render_pool_limits(self) -> None:
+        render_pool = RenderPool(
+            render_pool_test_function, num_workers=1, cpu_limit=0.5, max_renders=3
+        )
+        try:
+            worker_pid = render_pool.render("pid")
+            self.assertNotEqual(worker_pid, os.getpid())
+
+            with self.assertRaises(RenderCPULimitExceededError):
+                render_pool.render("spin")
+            self.assertEqual(render_pool.stats.cpu_limit_exceeded, 1)
+
+            with self.assertRaisesRegex(RenderWorkerError, "ValueError: bad input"):
+                render_pool.render("fail")
+
+            # The worker has done max_renders renders, and is replaced.
+            self.assertEqual(render_pool.stats.recycled_workers, 1)
+            self.assertNotEqual(render_pool.render("pid"), worker_pid)
+
+            with self.assertRaisesRegex(RenderWorkerError, "exited unexpectedly"):
+                render_pool.render("exit")
+            self.assertEqual(render_pool.stats.killed_workers, 1)
+
+            with mock.patch(
+                "zerver.lib.markdown.render_pool.WALL_CLOCK_GRACE_SECS", 0
+            ), self.assertLogs("zulip.markdown.render_pool", level="WARNING"):
+                with self.assertRaises(RenderTimeoutError):
+                    render_pool.render("sleep")
+            self.assertEqual(render_pool.stats.killed_workers, 2)
+
+            self.assertEqual(render_pool.stats.renders, 6)
+            self.assertEqual(render_pool.num_started_workers, 0)
+            render_pool.render("pid")
+            self.assertEqual(render_pool.num_started_workers, 1)
+        finally:
+            render_pool.shutdown()
+        self.assertEqual(render_pool.num_started_workers, 0)
+
+    @override_settings(MARKDOWN_RENDER_PROCESSES=1, MARKDOWN_RENDER_CPU_LIMIT=0.01)
+    def test_render_pool_error_handling(self) -> None:
+        with mock.patch("zerver.lib.markdown.markdown_render_pool", None), mock.patch(
+            "zerver.lib.markdown.render_in_worker",
+            lambda *args: render_pool_test_function("spin"),
+        ):
+            with self.assertLogs(level="ERROR"), self.assertRaises(MarkdownRenderingError):
+                markdown_convert_wrapper("hello")
+            render_pool = get_markdown_render_pool()
+            assert render_pool is not None
+            render_pool.shutdown()
+
+
 class MarkdownEmojiTest(ZulipTestCase):
     def test_all_emoji_match_regex(self) -> None:
         non_matching_emoji = [
@@ -13,6 +13,7 @@ from typing_extensions import override
 from analytics.lib.counts import COUNT_STATS
 from analytics.models import RealmCount
 from zerver.actions.message_edit import do_update_message
+from zerver.actions.message_flags import do_mark_all_as_read, do_update_message_flags
 from zerver.actions.realm_settings import do_set_realm_property
 from zerver.actions.uploads import do_claim_attachments
 from zerver.actions.user_settings import do_change_user_setting
@@ -39,12 +40,22 @@ from zerver.lib.narrow import (
     post_process_limited_query,
 )
 from zerver.lib.narrow_helpers import NarrowTerm
+from zerver.lib.soft_deactivation import (
+    do_soft_deactivate_users,
+    reactivate_user_if_soft_deactivated,
+)
 from zerver.lib.sqlalchemy_utils import get_sqlalchemy_connection
 from zerver.lib.streams import StreamDict, create_streams_if_needed, get_public_streams_queryset
 from zerver.lib.test_classes import ZulipTestCase
 from zerver.lib.test_helpers import HostRequestMock, get_user_messages, queries_captured
 from zerver.lib.topic import MATCH_TOPIC, RESOLVED_TOPIC_PREFIX, TOPIC_NAME
 from zerver.lib.types import UserDisplayRecipient
+from zerver.lib.unread_index import (
+    UnreadIndex,
+    build_unread_index,
+    discard_unread_indexes,
+    get_unread_index,
+)
 from zerver.lib.upload.base import create_attachment
 from zerver.lib.url_encoding import near_message_url
 from zerver.lib.user_topics import set_topic_visibility_policy
@@ -434,7 +445,7 @@ class NarrowBuilderTest(ZulipTestCase):
         term = dict(operator="search", operand='"french fries"')
         self._do_add_term_test(
             term,
-            "WHERE (content ILIKE %(content_1)s OR subject ILIKE %(subject_1)s) AND (search_tsvector @@ plainto_tsquery(%(param_4)s, %(param_5)s))",
+            "WHERE search_tsvector @@ (plainto_tsquery(%(param_4)s, %(param_5)s) && phraseto_tsquery(%(param_6)s, %(param_7)s))",
         )
 
     @override_settings(USING_PGROONGA=False)
@@ -442,7 +453,7 @@ class NarrowBuilderTest(ZulipTestCase):
         term = dict(operator="search", operand='"french fries"', negated=True)
         self._do_add_term_test(
             term,
-            "WHERE NOT (content ILIKE %(content_1)s OR subject ILIKE %(subject_1)s) AND NOT (search_tsvector @@ plainto_tsquery(%(param_4)s, %(param_5)s))",
+            "WHERE NOT (search_tsvector @@ (plainto_tsquery(%(param_4)s, %(param_5)s) && phraseto_tsquery(%(param_6)s, %(param_7)s)))",
         )
 
     @override_settings(USING_PGROONGA=True)
@@ -598,6 +609,45 @@ class NarrowBuilderTest(ZulipTestCase):
     def _build_query(self, term: Dict[str, Any]) -> Select:
         return self.builder.add_term(self.raw_query, term)
 
+    def test_queries_share_compiled_cache(self) -> None:
+        # SQLAlchemy caches the compiled SQL for each statement,
+        # keyed by its structure, and binds the parameters on each
+        # execution.  Narrows of the same shape with different
+        # operands must share that key, so that they are only
+        # compiled once.
+        def cache_key(narrow: List[Dict[str, Any]]) -> object:
+            query = self.raw_query
+            for term in narrow:
+                query = self.builder.add_term(query, term)
+            key = query._generate_cache_key()
+            assert key is not None
+            return key.key
+
+        self.assertEqual(
+            cache_key(
+                [
+                    dict(operator="stream", operand="Scotland"),
+                    dict(operator="topic", operand="lunch"),
+                    dict(operator="search", operand="muffins"),
+                ]
+            ),
+            cache_key(
+                [
+                    dict(operator="stream", operand="Verona"),
+                    dict(operator="topic", operand="dinner plans"),
+                    dict(operator="search", operand="pizza tonight"),
+                ]
+            ),
+        )
+        self.assertEqual(
+            cache_key([dict(operator="sender", operand=self.hamlet_email)]),
+            cache_key([dict(operator="sender", operand=self.othello_email)]),
+        )
+        self.assertNotEqual(
+            cache_key([dict(operator="sender", operand=self.hamlet_email)]),
+            cache_key([dict(operator="sender", operand=self.hamlet_email, negated=True)]),
+        )
+
 
 class NarrowLibraryTest(ZulipTestCase):
     def test_build_narrow_predicate(self) -> None:
@@ -2616,6 +2666,29 @@ class GetOldMessagesTest(ZulipTestCase):
         self.assertEqual(lunch_message[MATCH_TOPIC], '<span class="highlight">lunch</span> plans')
         self.assertEqual(lunch_message["match_content"], "<p>I am hungry!</p>")
 
+        # Quoted phrases must match their words in order, after
+        # stemming and ignoring punctuation.
+        for phrase, expected_topics in [
+            ('"discuss lunch"', ["meetings"]),
+            ('"discussing lunches"', ["meetings"]),
+            ('"lunch, after"', ["meetings"]),
+            ('"lunch discuss"', []),
+            ('"conference room" muffins', ["breakfast"]),
+            ('"conference room" lunch', []),
+        ]:
+            narrow = [dict(operator="search", operand=phrase)]
+            phrase_search_result: Dict[str, Any] = self.get_and_check_messages(
+                dict(
+                    narrow=orjson.dumps(narrow).decode(),
+                    anchor=next_message_id,
+                    num_before=0,
+                    num_after=10,
+                )
+            )
+            self.assertEqual(
+                [m[TOPIC_NAME] for m in phrase_search_result["messages"]], expected_topics
+            )
+
         # Should not crash when multiple search operands are present
         multi_search_narrow = [
             dict(operator="search", operand="discuss"),
@@ -3586,6 +3659,96 @@ class GetOldMessagesTest(ZulipTestCase):
             {unsub_message_id, muted_message_id, first_message_id, extra_message_id},
         )
 
+    def test_find_first_unread_anchor_with_unread_index(self) -> None:
+        hamlet = self.example_user("hamlet")
+        cordelia = self.example_user("cordelia")
+        self.make_stream("England")
+        self.subscribe(hamlet, "England")
+        self.subscribe(cordelia, "England")
+        do_mark_all_as_read(hamlet)
+
+        first_message_id = self.send_stream_message(cordelia, "England", topic_name="first")
+        second_message_id = self.send_stream_message(cordelia, "England", topic_name="second")
+        dm_message_id = self.send_personal_message(cordelia, hamlet)
+
+        def first_unread(narrow: List[Dict[str, Any]], user: UserProfile = hamlet) -> int:
+            with get_sqlalchemy_connection() as sa_conn:
+                return find_first_unread_anchor(sa_conn, user, narrow)
+
+        england = [dict(operator="stream", operand="England")]
+        self.assertEqual(first_unread([]), first_message_id)
+        self.assertEqual(first_unread(england), first_message_id)
+        self.assertEqual(
+            first_unread([*england, dict(operator="topic", operand="SECOND")]), second_message_id
+        )
+        self.assertEqual(first_unread([dict(operator="is", operand="dm")]), dm_message_id)
+
+        # Only the candidates from the index are checked.
+        with queries_captured() as queries:
+            self.assertEqual(first_unread(england), first_message_id)
+        [query] = [q for q in queries if q.sql.startswith("SELECT message_id, flags")]
+        self.assertIn(f"message_id IN ({first_message_id}, {second_message_id})", query.sql)
+
+        # The index may still have messages which have been read.
+        do_update_message_flags(hamlet, "add", "read", [first_message_id])
+        self.assertEqual(first_unread(england), second_message_id)
+
+        # Messages sent since the index was built are past its watermark.
+        third_message_id = self.send_stream_message(cordelia, "England", topic_name="third")
+        self.assertEqual(
+            first_unread([*england, dict(operator="topic", operand="third")]), third_message_id
+        )
+
+        # Marking messages as unread, or moving them, discards the index.
+        do_update_message_flags(hamlet, "remove", "read", [first_message_id])
+        self.assertEqual(first_unread(england), first_message_id)
+        self.login("cordelia")
+        result = self.client_patch(f"/json/messages/{third_message_id}", {"topic": "first"})
+        self.assert_json_success(result)
+        self.assertEqual(
+            first_unread([*england, dict(operator="topic", operand="first")]), first_message_id
+        )
+        self.assertEqual(
+            first_unread([*england, dict(operator="topic", operand="third")]),
+            LARGER_THAN_MAX_MESSAGE_ID,
+        )
+
+        # If none of the first candidates are unread in the narrow, we
+        # check all of the user's unread messages.
+        set_topic_visibility_policy(
+            hamlet, [["England", "first"]], UserTopic.VisibilityPolicy.MUTED
+        )
+        with mock.patch("zerver.lib.narrow.MAX_UNREAD_CANDIDATES", 1):
+            self.assertEqual(first_unread(england), second_message_id)
+
+        # An index built while a change discards it is not used.
+        def build_while_discarding(user_profile: UserProfile) -> UnreadIndex:
+            unread_index = build_unread_index(user_profile)
+            discard_unread_indexes([user_profile.id])
+            return unread_index
+
+        with mock.patch(
+            "zerver.lib.unread_index.build_unread_index", side_effect=build_while_discarding
+        ):
+            get_unread_index(hamlet)
+        with mock.patch(
+            "zerver.lib.unread_index.build_unread_index", wraps=build_unread_index
+        ) as mock_build:
+            get_unread_index(hamlet)
+            get_unread_index(hamlet)
+        mock_build.assert_called_once()
+
+        # Catching up a soft-deactivated user adds UserMessage rows
+        # older than their index's watermark, so discards the index.
+        do_mark_all_as_read(cordelia)
+        do_soft_deactivate_users([cordelia])
+        missed_message_id = self.send_stream_message(hamlet, "England", topic_name="missed")
+        later_message_id = self.send_stream_message(hamlet, "England", topic_name="later")
+        UserMessage.objects.create(user_profile=cordelia, message_id=later_message_id)
+        self.assertEqual(first_unread([], cordelia), later_message_id)
+        reactivate_user_if_soft_deactivated(cordelia)
+        self.assertEqual(first_unread([], cordelia), missed_message_id)
+
     def test_parse_anchor_value(self) -> None:
         hamlet = self.example_user("hamlet")
         cordelia = self.example_user("cordelia")
@@ -4132,12 +4295,12 @@ WHERE realm_id = 2 AND recipient_id = {scotland_recipient} AND (search_tsvector
         sql_template = """\
 SELECT anon_1.message_id, anon_1.flags, anon_1.subject, anon_1.rendered_content, anon_1.content_matches, anon_1.topic_matches \n\
 FROM (SELECT message_id, flags, subject, rendered_content, array((SELECT ARRAY[sum(length(anon_3) - 11) OVER (ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING) + 11, strpos(anon_3, '</ts-match>') - 1] AS anon_2 \n\
-FROM unnest(string_to_array(ts_headline('zulip.english_us_search', rendered_content, plainto_tsquery('zulip.english_us_search', '"jumping" quickly'), 'HighlightAll = TRUE, StartSel = <ts-match>, StopSel = </ts-match>'), '<ts-match>')) AS anon_3\n\
+FROM unnest(string_to_array(ts_headline('zulip.english_us_search', rendered_content, plainto_tsquery('zulip.english_us_search', '"jumping" quickly') && phraseto_tsquery('zulip.english_us_search', 'jumping'), 'HighlightAll = TRUE, StartSel = <ts-match>, StopSel = </ts-match>'), '<ts-match>')) AS anon_3\n\
  LIMIT ALL OFFSET 1)) AS content_matches, array((SELECT ARRAY[sum(length(anon_5) - 11) OVER (ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING) + 11, strpos(anon_5, '</ts-match>') - 1] AS anon_4 \n\
-FROM unnest(string_to_array(ts_headline('zulip.english_us_search', escape_html(subject), plainto_tsquery('zulip.english_us_search', '"jumping" quickly'), 'HighlightAll = TRUE, StartSel = <ts-match>, StopSel = </ts-match>'), '<ts-match>')) AS anon_5\n\
+FROM unnest(string_to_array(ts_headline('zulip.english_us_search', escape_html(subject), plainto_tsquery('zulip.english_us_search', '"jumping" quickly') && phraseto_tsquery('zulip.english_us_search', 'jumping'), 'HighlightAll = TRUE, StartSel = <ts-match>, StopSel = </ts-match>'), '<ts-match>')) AS anon_5\n\
  LIMIT ALL OFFSET 1)) AS topic_matches \n\
 FROM zerver_usermessage JOIN zerver_message ON zerver_usermessage.message_id = zerver_message.id \n\
-WHERE user_profile_id = {hamlet_id} AND (content ILIKE '%jumping%' OR subject ILIKE '%jumping%') AND (search_tsvector @@ plainto_tsquery('zulip.english_us_search', '"jumping" quickly')) ORDER BY message_id ASC \n\
+WHERE user_profile_id = {hamlet_id} AND (search_tsvector @@ (plainto_tsquery('zulip.english_us_search', '"jumping" quickly') && phraseto_tsquery('zulip.english_us_search', 'jumping'))) ORDER BY message_id ASC \n\
  LIMIT 10) AS anon_1 ORDER BY message_id ASC\
 """
         sql = sql_template.format(**query_ids)
@@ -4209,6 +4372,112 @@ WHERE user_profile_id = {hamlet_id} AND (content ILIKE '%jumping%' OR subject IL
             '@<span class="highlight">Othello</span>, the Moor of Venice</span>?</p>',
         )
 
+    def test_get_messages_bulk(self) -> None:
+        hamlet = self.example_user("hamlet")
+        self.login_user(hamlet)
+        verona_ids = [
+            self.send_stream_message(self.example_user("cordelia"), "Verona", f"message {i}")
+            for i in range(5)
+        ]
+        user_message_ids = list(
+            UserMessage.objects.filter(user_profile=hamlet)
+            .order_by("message_id")
+            .values_list("message_id", flat=True)
+        )
+
+        def get_bulk(params: Dict[str, Any]) -> List[Dict[str, Any]]:
+            # The view fetches further batches while the response is
+            # read, so we read it with the smaller batch size in place.
+            with mock.patch("zerver.views.message_fetch.BULK_FETCH_BATCH_SIZE", 2):
+                result = self.client_get("/json/messages/bulk", params)
+                self.assertEqual(result.status_code, 200)
+                self.assertEqual(result["Content-Type"], "application/x-ndjson")
+                content = b"".join(result.streaming_content)
+            return [orjson.loads(line) for line in content.splitlines()]
+
+        *messages, trailer = get_bulk({})
+        self.assertEqual([message["id"] for message in messages], user_message_ids)
+        self.assertNotIn("flags", messages[0])
+        self.assertEqual(
+            trailer,
+            dict(result="success", msg="", found_newest=True, last_message_id=user_message_ids[-1]),
+        )
+
+        # Resuming after a message, with a limit, in a narrow which
+        # includes history, with flags.
+        narrow = [dict(operator="stream", operand="Verona")]
+        *messages, trailer = get_bulk(
+            dict(
+                narrow=orjson.dumps(narrow).decode(),
+                after_id=verona_ids[0],
+                num_messages=3,
+                include_flags="true",
+            )
+        )
+        self.assertEqual([message["id"] for message in messages], verona_ids[1:4])
+        self.assertEqual(messages[0]["flags"], [])
+        self.assertEqual(
+            trailer,
+            dict(result="success", msg="", found_newest=False, last_message_id=verona_ids[3]),
+        )
+
+        *messages, trailer = get_bulk(
+            dict(narrow=orjson.dumps(narrow).decode(), after_id=verona_ids[3])
+        )
+        self.assertEqual([message["id"] for message in messages], verona_ids[4:])
+        self.assertEqual(
+            trailer,
+            dict(result="success", msg="", found_newest=True, last_message_id=verona_ids[4]),
+        )
+
+        # Each request is limited in time, after which clients resume.
+        with mock.patch("zerver.views.message_fetch.BULK_FETCH_MAX_SECONDS", 0):
+            *messages, trailer = get_bulk({})
+        self.assertEqual([message["id"] for message in messages], user_message_ids[:2])
+        self.assertEqual(
+            trailer,
+            dict(result="success", msg="", found_newest=False, last_message_id=user_message_ids[1]),
+        )
+
+        result = self.client_get("/json/messages/bulk", dict(num_messages=0))
+        self.assert_json_error(result, "Invalid num_messages")
+        result = self.client_get("/json/messages/bulk", dict(num_messages=50001))
+        self.assert_json_error(result, "Too many messages requested (maximum 50000).")
+
+        # Errors in the narrow are reported before streaming starts.
+        narrow = [dict(operator="stream", operand="nonexistent")]
+        result = self.client_get("/json/messages/bulk", dict(narrow=orjson.dumps(narrow).decode()))
+        self.assert_json_error_contains(result, "Invalid narrow operator: unknown stream")
+
+    def test_explain_slow_narrow_queries(self) -> None:
+        self.login("hamlet")
+        narrow = [
+            dict(operator="stream", operand="Verona"),
+            dict(operator="is", operand="starred", negated=True),
+        ]
+        params: Dict[str, Union[str, int]] = dict(
+            narrow=orjson.dumps(narrow).decode(), anchor="newest", num_before=10
+        )
+
+        with self.assertLogs("zulip.slow_queries", level="INFO") as logs, self.settings(
+            NARROW_EXPLAIN_SAMPLE_RATE=1.0, NARROW_EXPLAIN_MIN_DURATION=0.0
+        ):
+            self.get_and_check_messages(params)
+        self.assert_length(logs.output, 1)
+        self.assertIn(
+            "Narrow query [stream,is:starred] (include_history=False) took", logs.output[0]
+        )
+        self.assertIn("actual time=", logs.output[0])
+
+        # Queries faster than NARROW_EXPLAIN_MIN_DURATION, or not
+        # sampled, are not explained.
+        with mock.patch("zerver.lib.narrow.slow_query_logger.info") as mock_info:
+            with self.settings(NARROW_EXPLAIN_SAMPLE_RATE=1.0, NARROW_EXPLAIN_MIN_DURATION=60.0):
+                self.get_and_check_messages(params)
+            with self.settings(NARROW_EXPLAIN_MIN_DURATION=0.0):
+                self.get_and_check_messages(params)
+        mock_info.assert_not_called()
+
 
 class MessageHasKeywordsTest(ZulipTestCase):
     """Test for keywords like has_link, has_image, has_attachment."""
@@ -1487,6 +1487,45 @@ class StreamMessagesTest(ZulipTestCase):
         self.assertEqual(old_non_subscriber_messages, new_non_subscriber_messages)
         self.assertEqual(new_subscriber_messages, [elt + 1 for elt in old_subscriber_messages])
 
+    def test_bulk_insert_usermessages_with_copy(self) -> None:
+        sender = self.example_user("iago")
+        hamlet = self.example_user("hamlet")
+        subscribers = self.users_subscribed_to_stream("Verona", sender.realm)
+        self.assertIn(hamlet, subscribers)
+
+        # Force even a small batch of UserMessage rows through COPY.
+        with mock.patch(
+            "zerver.lib.user_message.BULK_INSERT_UMS_COPY_THRESHOLD", 1
+        ), self.assertLogs(level="DEBUG") as logs:
+            message_id = self.send_stream_message(
+                sender, "Verona", content="@**King Hamlet** hello"
+            )
+
+        user_messages = UserMessage.objects.filter(message_id=message_id)
+        self.assertTrue(
+            any(
+                f"bulk_insert_ums: COPY of {len(user_messages)} rows took" in line
+                for line in logs.output
+            )
+        )
+        self.assertEqual(
+            {um.user_profile_id for um in user_messages},
+            {user.id for user in subscribers if user.bot_type != UserProfile.OUTGOING_WEBHOOK_BOT},
+        )
+        self.assertEqual(sorted(user_messages.get(user_profile=hamlet).flags_list()), ["mentioned"])
+        self.assertEqual(sorted(user_messages.get(user_profile=sender).flags_list()), ["read"])
+
+    def test_send_message_stage_timings(self) -> None:
+        sender = self.example_user("iago")
+        with self.assertLogs("zulip.send_message", level="DEBUG") as logs:
+            self.send_stream_message(sender, "Verona", content="hello")
+        self.assert_length(logs.output, 1)
+        self.assertRegex(
+            logs.output[0],
+            r"^DEBUG:zulip.send_message:Sent 1 messages "
+            r"\(write: [\d.]+ms, notify: [\d.]+ms, enqueue: [\d.]+ms\)$",
+        )
+
     def test_performance(self) -> None:
         """
         This test is part of the automated test suite, but
@@ -1711,6 +1750,22 @@ class StreamMessagesTest(ZulipTestCase):
         user_ids = {u["id"] for u in users}
         return user_ids
 
+    def test_stream_wildcard_mention_flags_in_event(self) -> None:
+        hamlet = self.example_user("hamlet")
+        stream_name = "Test stream"
+        for name in ["hamlet", "cordelia", "iago", "othello"]:
+            self.subscribe(self.example_user(name), stream_name)
+
+        with self.capture_send_event_calls(expected_num_events=1) as events:
+            self.send_stream_message(hamlet, stream_name, content="@**all** hello")
+        # Recipients with the same flags must each get their own
+        # flags, with wildcard_mentioned added exactly once.
+        for user in events[0]["users"]:
+            if user["id"] == hamlet.id:
+                continue
+            self.assertIn("stream_wildcard_mentioned", user["flags"])
+            self.assertEqual(user["flags"].count("wildcard_mentioned"), 1)
+
     def test_unsub_mention(self) -> None:
         cordelia = self.example_user("cordelia")
         hamlet = self.example_user("hamlet")
@@ -245,6 +245,9 @@ class OpenAPIArgumentsTest(ZulipTestCase):
         # users/me/subscriptions/properties; probably should just be a
         # section of the same page.
         "/users/me/subscriptions/{stream_id}",
+        # Streams newline-delimited JSON, which isn't representable as
+        # a regular JSON response in zulip.yaml.
+        "/messages/bulk",
         #### Mobile-app only endpoints; important for mobile developers.
         # Mobile interface for development environment login
         "/dev_list_users",
@@ -0,0 +1,140 @@
+import os
+import tempfile
+from typing import Any, Dict, Iterator, List
+from unittest import mock
+
+import orjson
+from django.db import connection
+from typing_extensions import override
+
+from zerver.actions.message_delete import do_delete_messages
+from zerver.lib.retention import restore_all_data_from_archive
+from zerver.lib.search_index import get_search_index, search_terms
+from zerver.lib.test_classes import ZulipTestCase
+from zerver.models import Message, get_realm
+
+
+class SearchIndexTest(ZulipTestCase):
+    @override
+    def setUp(self) -> None:
+        super().setUp()
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        settings_override = self.settings(
+            SEARCH_INDEX_BACKEND="sqlite",
+            SEARCH_INDEX_PATH=os.path.join(tmpdir.name, "messages.sqlite3"),
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def send_indexed_messages(self, messages: List[Dict[str, str]]) -> Iterator[int]:
+        # Sending queues the search_index worker to run once the
+        # message is committed, which in tests runs it synchronously.
+        for message in messages:
+            with self.captureOnCommitCallbacks(execute=True):
+                yield self.send_stream_message(
+                    self.example_user("cordelia"),
+                    "Verona",
+                    content=message["content"],
+                    topic_name=message["topic"],
+                )
+
+    def test_search_terms(self) -> None:
+        self.assertEqual(
+            search_terms('lunch "conference room" ... muffin!'),
+            [("lunch", False), ("conference room", True), ("muffin!", False)],
+        )
+        self.assertEqual(search_terms('"" -- ?'), [])
+
+    def test_search_index(self) -> None:
+        breakfast_id, lunch_id, meeting_id = self.send_indexed_messages(
+            [
+                dict(topic="breakfast", content="there are muffins in the conference room"),
+                dict(topic="lunch plans", content="I am **hungry**!"),
+                dict(topic="meetings", content="discuss lunch in the room after the conference"),
+            ]
+        )
+        realm = get_realm("zulip")
+        search_index = get_search_index()
+        assert search_index is not None
+
+        self.assertEqual(search_index.search(realm.id, "lunch", 10), [meeting_id, lunch_id])
+        self.assertEqual(search_index.search(realm.id, "hungry", 10), [lunch_id])
+        # Words match by their stems, as in PostgreSQL, and are ANDed
+        # together; stop words are ignored.
+        self.assertEqual(search_index.search(realm.id, "muffin rooms", 10), [breakfast_id])
+        self.assertEqual(search_index.search(realm.id, "muff", 10), [])
+        self.assertEqual(
+            search_index.search(realm.id, "conferences room", 10), [meeting_id, breakfast_id]
+        )
+        self.assertEqual(search_index.search(realm.id, "lunch the", 10), [meeting_id, lunch_id])
+        self.assertEqual(search_index.search(realm.id, '"conference room"', 10), [breakfast_id])
+        self.assertEqual(search_index.search(realm.id, "conference room", 1), [meeting_id])
+        # Operands with no words cannot be answered by the index.
+        self.assertIsNone(search_index.search(realm.id, "!!", 10))
+        # Other realms do not see these messages.
+        self.assertEqual(search_index.search(get_realm("lear").id, "lunch", 10), [])
+
+        self.login("cordelia")
+        with self.captureOnCommitCallbacks(execute=True):
+            result = self.client_patch(f"/json/messages/{lunch_id}", {"content": "I am full!"})
+        self.assert_json_success(result)
+        self.assertEqual(search_index.search(realm.id, "hungry", 10), [])
+        self.assertEqual(search_index.search(realm.id, "full", 10), [lunch_id])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            do_delete_messages(realm, Message.objects.filter(id=breakfast_id))
+        self.assertEqual(search_index.search(realm.id, "muffins", 10), [])
+
+        # Messages restored from the archive are indexed again.
+        with self.captureOnCommitCallbacks(execute=True):
+            restore_all_data_from_archive()
+        self.assertEqual(search_index.search(realm.id, "muffins", 10), [breakfast_id])
+
+    def test_narrow_search(self) -> None:
+        self.login("cordelia")
+        (lunch_id, meeting_id) = self.send_indexed_messages(
+            [
+                dict(topic="lunch plans", content="I am hungry!"),
+                dict(topic="meetings", content="discuss lunch after lunch"),
+            ]
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """
+            UPDATE zerver_message SET
+            search_tsvector = to_tsvector('zulip.english_us_search',
+            subject || rendered_content)
+            """
+            )
+
+        def search(operand: str) -> List[Dict[str, Any]]:
+            narrow = [dict(operator="search", operand=operand)]
+            result = self.client_get(
+                "/json/messages",
+                dict(
+                    narrow=orjson.dumps(narrow).decode(),
+                    anchor=lunch_id,
+                    num_before=0,
+                    num_after=10,
+                ),
+            )
+            return self.assert_json_success(result)["messages"]
+
+        messages = search("lunch")
+        self.assertEqual([message["id"] for message in messages], [lunch_id, meeting_id])
+        self.assertEqual(messages[0]["match_subject"], '<span class="highlight">lunch</span> plans')
+        self.assertEqual(
+            messages[1]["match_content"],
+            '<p>discuss <span class="highlight">lunch</span> after'
+            ' <span class="highlight">lunch</span></p>',
+        )
+
+        # Searches matching too many messages fall back to PostgreSQL,
+        # which must match the same messages.
+        for max_candidates in [10, 1]:
+            with mock.patch("zerver.lib.narrow.SEARCH_INDEX_MAX_CANDIDATES", max_candidates):
+                self.assertEqual(search("lunc"), [])
+                self.assertEqual(
+                    [message["id"] for message in search("lunches")], [lunch_id, meeting_id]
+                )
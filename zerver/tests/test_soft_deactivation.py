@@ -16,6 +16,7 @@ from zerver.lib.soft_deactivation import (
     reactivate_user_if_soft_deactivated,
 )
 from zerver.lib.stream_subscription import get_subscriptions_for_send_message
+from zerver.lib.stream_topic import StreamTopicTarget
 from zerver.lib.test_classes import ZulipTestCase
 from zerver.lib.test_helpers import get_subscription, get_user_messages, make_client
 from zerver.models import (
@@ -574,7 +575,10 @@ class SoftDeactivationMessageTest(ZulipTestCase):
         self.subscribe(cordelia, stream_name)
         self.subscribe(sender, stream_name)
 
-        stream_id = get_stream(stream_name, cordelia.realm).id
+        stream = get_stream(stream_name, cordelia.realm)
+        assert stream.recipient_id is not None
+        recipient_id = stream.recipient_id
+        stream_topic = StreamTopicTarget(stream_id=stream.id, topic_name=topic_name)
 
         def send_stream_message(content: str) -> None:
             self.send_stream_message(sender, stream_name, content, topic_name)
@@ -617,11 +621,11 @@ class SoftDeactivationMessageTest(ZulipTestCase):
                 len(
                     get_subscriptions_for_send_message(
                         realm_id=realm_id,
-                        stream_id=stream_id,
-                        topic_name=topic_name,
+                        recipient_id=recipient_id,
                         possible_stream_wildcard_mention=possible_stream_wildcard_mention,
                         topic_participant_user_ids=topic_participant_user_ids,
                         possibly_mentioned_user_ids=possibly_mentioned_user_ids,
+                        user_id_to_visibility_policy=stream_topic.user_id_to_visibility_policy_dict(),
                     )
                 ),
                 expected_count,
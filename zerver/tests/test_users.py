@@ -17,6 +17,7 @@ from zerver.actions.invites import do_create_multiuse_invite_link, do_invite_use
 from zerver.actions.message_send import RecipientInfoResult, get_recipient_info
 from zerver.actions.muted_users import do_mute_user
 from zerver.actions.realm_settings import do_set_realm_property
+from zerver.actions.streams import do_change_subscription_property, do_deactivate_stream
 from zerver.actions.user_settings import bulk_regenerate_api_keys, do_change_user_setting
 from zerver.actions.user_topics import do_set_user_topic_visibility_policy
 from zerver.actions.users import (
@@ -29,6 +30,12 @@ from zerver.actions.users import (
 )
 from zerver.lib.avatar import avatar_url, get_avatar_field, get_gravatar_url
 from zerver.lib.bulk_create import create_users
+from zerver.lib.cache import (
+    cache_get,
+    cache_set,
+    realm_subscriber_settings_version_cache_key,
+    stream_subscriber_settings_cache_key,
+)
 from zerver.lib.create_user import copy_default_settings
 from zerver.lib.events import do_events_register
 from zerver.lib.exceptions import JsonableError
@@ -37,6 +44,11 @@ from zerver.lib.send_email import (
     deliver_scheduled_emails,
     send_future_email,
 )
+from zerver.lib.soft_deactivation import do_soft_deactivate_users
+from zerver.lib.stream_subscription import (
+    SubscriberNotificationSettings,
+    get_stream_subscriber_settings,
+)
 from zerver.lib.stream_topic import StreamTopicTarget
 from zerver.lib.test_classes import ZulipTestCase
 from zerver.lib.test_helpers import (
@@ -56,6 +68,7 @@ from zerver.lib.users import (
 )
 from zerver.lib.utils import assert_is_not_none
 from zerver.models import (
+    AlertWord,
     CustomProfileField,
     InvalidFakeEmailDomainError,
     Message,
@@ -70,6 +83,7 @@ from zerver.models import (
     SystemGroups,
     UserGroupMembership,
     UserHotspot,
+    UserMessage,
     UserProfile,
     UserTopic,
     check_valid_user_ids,
@@ -2256,6 +2270,148 @@ class RecipientInfoTest(ZulipTestCase):
                 stream_topic=stream_topic,
             )
 
+    def test_stream_subscriber_settings_cache(self) -> None:
+        hamlet = self.example_user("hamlet")
+        cordelia = self.example_user("cordelia")
+        realm = hamlet.realm
+
+        stream = self.subscribe(hamlet, "Test stream")
+        self.subscribe(cordelia, "Test stream")
+        other_stream = self.subscribe(hamlet, "Other stream")
+        assert stream.recipient_id is not None
+        assert other_stream.recipient_id is not None
+
+        def subscriber_settings(
+            recipient_id: int = stream.recipient_id,
+        ) -> Dict[int, SubscriberNotificationSettings]:
+            rows = get_stream_subscriber_settings(realm.id, recipient_id)
+            assert rows is not None
+            return {row.user_profile_id: row for row in rows}
+
+        with self.assert_database_query_count(2):
+            self.assertEqual(set(subscriber_settings()), {hamlet.id, cordelia.id})
+            self.assertEqual(set(subscriber_settings(other_stream.recipient_id)), {hamlet.id})
+        with self.assert_database_query_count(0, keep_cache_warm=True):
+            self.assertEqual(set(subscriber_settings()), {hamlet.id, cordelia.id})
+
+        # Changing a subscription only invalidates that stream's entry.
+        sub = get_subscription("Test stream", hamlet)
+        self.assertIsNone(sub.push_notifications)
+        do_change_subscription_property(
+            hamlet, sub, stream, "push_notifications", True, acting_user=None
+        )
+        with self.assert_database_query_count(1, keep_cache_warm=True):
+            self.assertTrue(subscriber_settings()[hamlet.id].push_notifications)
+            self.assertIsNone(
+                subscriber_settings(other_stream.recipient_id)[hamlet.id].push_notifications
+            )
+
+        # Changing a user's settings invalidates every stream in the realm.
+        self.assertFalse(hamlet.enable_stream_email_notifications)
+        do_change_user_setting(hamlet, "enable_stream_email_notifications", True, acting_user=None)
+        with self.assert_database_query_count(2, keep_cache_warm=True):
+            self.assertTrue(subscriber_settings()[hamlet.id].user_profile_email_notifications)
+            self.assertTrue(
+                subscriber_settings(other_stream.recipient_id)[
+                    hamlet.id
+                ].user_profile_email_notifications
+            )
+
+        # Settings not included in the cache don't invalidate it.
+        do_change_user_setting(hamlet, "enable_sounds", False, acting_user=None)
+        with self.assert_database_query_count(0, keep_cache_warm=True):
+            subscriber_settings()
+
+        self.unsubscribe(cordelia, "Test stream")
+        with self.assert_database_query_count(1, keep_cache_warm=True):
+            self.assertEqual(set(subscriber_settings()), {hamlet.id})
+
+        do_deactivate_user(hamlet, acting_user=None)
+        with self.assert_database_query_count(1, keep_cache_warm=True):
+            self.assertEqual(subscriber_settings(), {})
+
+        do_deactivate_stream(other_stream, acting_user=None)
+        with self.assert_database_query_count(1, keep_cache_warm=True):
+            self.assertEqual(subscriber_settings(other_stream.recipient_id), {})
+
+    def test_stream_subscriber_settings_cache_invalidated_on_commit(self) -> None:
+        hamlet = self.example_user("hamlet")
+        cordelia = self.example_user("cordelia")
+        realm = hamlet.realm
+        stream = self.subscribe(hamlet, "Test stream")
+        assert stream.recipient_id is not None
+        old_settings = get_stream_subscriber_settings(realm.id, stream.recipient_id)
+        assert old_settings is not None
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.subscribe(cordelia, "Test stream")
+            # A message sent by another process before the subscription
+            # commits caches the old subscribers under the current
+            # version.
+            version = cache_get(realm_subscriber_settings_version_cache_key(realm.id))[0]
+            cache_set(
+                stream_subscriber_settings_cache_key(stream.recipient_id),
+                (version, old_settings),
+                timeout=3600,
+            )
+
+        subscriber_settings = get_stream_subscriber_settings(realm.id, stream.recipient_id)
+        assert subscriber_settings is not None
+        self.assertEqual(
+            {row.user_profile_id for row in subscriber_settings}, {hamlet.id, cordelia.id}
+        )
+
+    def test_stream_subscriber_settings_cache_send_messages(self) -> None:
+        hamlet = self.example_user("hamlet")
+        cordelia = self.example_user("cordelia")
+        self.subscribe(cordelia, "Denmark")
+
+        # The second message uses the cached settings.
+        for content in ["first", "second"]:
+            message_id = self.send_stream_message(hamlet, "Denmark", content)
+            self.assertTrue(
+                UserMessage.objects.filter(user_profile=cordelia, message_id=message_id).exists()
+            )
+
+    def test_stream_subscriber_settings_not_cached_for_large_streams(self) -> None:
+        hamlet = self.example_user("hamlet")
+        cordelia = self.example_user("cordelia")
+        stream = self.subscribe(hamlet, "Test stream")
+        self.subscribe(cordelia, "Test stream")
+        assert stream.recipient_id is not None
+
+        with mock.patch(
+            "zerver.lib.stream_subscription.STREAM_SUBSCRIBER_SETTINGS_CACHE_MAX_SIZE", 1
+        ):
+            with self.assert_database_query_count(1):
+                self.assertIsNone(
+                    get_stream_subscriber_settings(hamlet.realm_id, stream.recipient_id)
+                )
+            # We remember that the stream is too large to cache.
+            with self.assert_database_query_count(0, keep_cache_warm=True):
+                self.assertIsNone(
+                    get_stream_subscriber_settings(hamlet.realm_id, stream.recipient_id)
+                )
+
+            # Long-term idle users are then filtered out in the database.
+            AlertWord.objects.filter(user_profile=cordelia).delete()
+            do_soft_deactivate_users([cordelia])
+            info = get_recipient_info(
+                realm_id=hamlet.realm_id,
+                recipient=stream.recipient,
+                sender_id=hamlet.id,
+                stream_topic=StreamTopicTarget(stream_id=stream.id, topic_name="test topic"),
+            )
+            self.assertEqual(info.active_user_ids, {hamlet.id})
+            self.assertEqual(info.long_term_idle_user_ids, set())
+
+            message_id = self.send_stream_message(
+                hamlet, "Test stream", "@**Cordelia, Lear's daughter**"
+            )
+            self.assertTrue(
+                UserMessage.objects.filter(user_profile=cordelia, message_id=message_id).exists()
+            )
+
 
 class BulkUsersTest(ZulipTestCase):
     def test_client_gravatar_option(self) -> None:
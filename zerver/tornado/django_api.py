@@ -17,6 +17,7 @@ from zerver.lib.queue import queue_json_publish
 from zerver.models import Client, Realm, UserProfile
 from zerver.tornado.sharding import (
     get_realm_tornado_ports,
+    get_sharding_config_version,
     get_tornado_url,
     get_user_id_tornado_port,
     get_user_tornado_port,
@@ -187,7 +188,14 @@ def send_event(
     for port, port_users in port_user_map.items():
         queue_json_publish(
             notify_tornado_queue_name(port),
-            dict(event=event, users=port_users),
+            dict(
+                event=event,
+                users=port_users,
+                # Lets Tornado notice a sharding configuration change
+                # that we have seen first; see route_notification_users.
+                realm_id=realm.id,
+                sharding_config_version=get_sharding_config_version(),
+            ),
             partial(send_notification_http, port),
         )
 
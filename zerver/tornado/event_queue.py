@@ -1,14 +1,15 @@
 # See https://zulip.readthedocs.io/en/latest/subsystems/events-system.html for
 # high-level documentation on how this system works.
 import copy
+import itertools
 import logging
 import os
 import random
 import time
 import traceback
 import uuid
-from collections import deque
-from contextlib import suppress
+from collections import defaultdict, deque
+from contextlib import contextmanager, suppress
 from functools import lru_cache
 from typing import (
     AbstractSet,
@@ -18,6 +19,7 @@ from typing import (
     Deque,
     Dict,
     Iterable,
+    Iterator,
     List,
     Mapping,
     MutableMapping,
@@ -30,7 +32,6 @@ from typing import (
     cast,
 )
 
-import orjson
 import tornado.ioloop
 from django.conf import settings
 from django.utils.translation import gettext as _
@@ -45,7 +46,7 @@ from zerver.lib.narrow_helpers import narrow_dataclasses_from_tuples
 from zerver.lib.notification_data import UserMessageNotificationsData
 from zerver.lib.queue import queue_json_publish, retry_event
 from zerver.middleware import async_request_timer_restart
-from zerver.models import CustomProfileField
+from zerver.models import CustomProfileField, get_realm_by_id
 from zerver.tornado.descriptors import clear_descriptor_by_handler_id, set_descriptor_by_handler_id
 from zerver.tornado.exceptions import BadEventQueueIdError
 from zerver.tornado.handlers import (
@@ -54,6 +55,17 @@ from zerver.tornado.handlers import (
     get_handler_by_id,
     handler_stats_string,
 )
+from zerver.tornado.queue_snapshot import read_queue_snapshot, write_queue_snapshot
+from zerver.tornado.sharding import (
+    SHARDING_CONFIG_CHECK_INTERVAL_SECS,
+    get_previous_realm_tornado_ports,
+    get_realm_tornado_ports,
+    get_sharding_config_loaded_time,
+    get_sharding_config_version,
+    get_user_id_tornado_port,
+    maybe_reload_sharding_config,
+    notify_tornado_queue_name,
+)
 
 # The idle timeout used to be a week, but we found that in that
 # situation, queues from dead browser sessions would grow quite large
@@ -122,6 +134,12 @@ class ClientDescriptor:
         self._timeout_handle: Any = None  # TODO: should be return type of ioloop.call_later
         self.narrow = narrow
         self.narrow_predicate = build_narrow_predicate(modern_narrow)
+        # If the narrow only accepts messages sent to a single stream,
+        # the (lowercased) name of that stream; used to index the
+        # client in realm_clients_by_stream.
+        self.narrow_stream_name: Optional[str] = next(
+            (term.operand.lower() for term in modern_narrow if term.operator == "stream"), None
+        )
         self.bulk_message_deletion = bulk_message_deletion
         self.stream_typing_notifications = stream_typing_notifications
         self.user_settings_object = user_settings_object
@@ -202,6 +220,11 @@ class ClientDescriptor:
             async_request_timer_restart(handler._request)
 
         self.event_queue.push(event)
+        if clients_pending_finish is not None and self.current_handler_id is not None:
+            # We're processing a batch of notices; the handler will be
+            # finished once, with all of the batch's events, at the end.
+            clients_pending_finish[self.event_queue.id] = self
+            return
         self.finish_current_handler()
 
     def finish_current_handler(self) -> bool:
@@ -305,13 +328,84 @@ class ClientDescriptor:
         do_gc_event_queues({self.event_queue.id}, {self.user_profile_id}, {self.realm_id})
 
 
-def compute_full_event_type(event: Mapping[str, Any]) -> str:
-    if event["type"] == "update_message_flags":
+def compute_compaction_key(event: Mapping[str, Any]) -> Optional[str]:
+    """Returns the key under which an event can be merged with other
+    pending events for the same queue, or None if the event cannot be
+    compacted.  Two events with the same key can always be represented
+    by a single event that is delivered at the position of the later
+    one; see EventQueue.push for details."""
+    event_type = event["type"]
+    if event_type == "restart":
+        return "restart"
+    if event_type == "update_message_flags":
         if event["all"]:
-            # Put the "all" case in its own category
-            return "all_flags/{}/{}".format(event["flag"], event["operation"])
+            return None
         return "flags/{}/{}".format(event["operation"], event["flag"])
-    return event["type"]
+    if event_type == "typing":
+        sender_id = event["sender"]["user_id"]
+        if "stream_id" in event:
+            return "typing/stream/{}/{}/{}".format(sender_id, event["stream_id"], event["topic"])
+        recipient_ids = sorted(recipient["user_id"] for recipient in event["recipients"])
+        return "typing/direct/{}/{}".format(sender_id, ",".join(map(str, recipient_ids)))
+    if event_type == "presence":
+        return "presence/{}".format(event["user_id"])
+    return None
+
+
+def merge_compacted_event(
+    key: str, virtual_event: Dict[str, Any], event: Mapping[str, Any]
+) -> None:
+    if "timestamp" in event:
+        virtual_event["timestamp"] = event["timestamp"]
+
+    if key == "restart":
+        virtual_event["server_generation"] = event["server_generation"]
+    elif key.startswith("flags/"):
+        virtual_event["messages"] += event["messages"]
+        if "message_details" in event:
+            # flags/remove/read events carry the details clients
+            # need to re-add the messages to their unread data.
+            virtual_event.setdefault("message_details", {}).update(event["message_details"])
+    elif key.startswith("typing/"):
+        # Only the latest state of a typing indicator matters.
+        virtual_event["op"] = event["op"]
+    elif key.startswith("presence/"):
+        virtual_event["server_timestamp"] = event["server_timestamp"]
+        virtual_event["presence"].update(event["presence"])
+
+
+# Counters for how effective EventQueue compaction is, keyed by
+# event type; reported in the periodic garbage collection log line.
+compaction_pushed_counts: Dict[str, int] = defaultdict(int)
+compaction_merged_counts: Dict[str, int] = defaultdict(int)
+
+
+def compaction_stats_string() -> str:
+    pushed = sum(compaction_pushed_counts.values())
+    merged = sum(compaction_merged_counts.values())
+    if pushed == 0:
+        return "no compactable events"
+    by_type = ", ".join(
+        f"{event_type} {compaction_merged_counts[event_type]}/{count}"
+        for event_type, count in sorted(compaction_pushed_counts.items())
+    )
+    return f"compacted {merged}/{pushed} events ({100 * merged / pushed:.1f}%: {by_type})"
+
+
+def materialize_event(
+    event_id: int, payload: Mapping[str, Any], include_internal_data: bool = False
+) -> Dict[str, Any]:
+    """Builds the event dictionary for a (event_id, payload) entry in an
+    EventQueue.  The returned dictionary is always freshly allocated,
+    so callers may add or remove top-level keys; nested values are
+    shared with the stored payload and must not be mutated.
+    """
+    event = {**payload, "id": event_id}
+    if not include_internal_data and event["type"] == "message":
+        # The internal_data data structures are not intended to be
+        # exposed to API clients.
+        event.pop("internal_data", None)
+    return event
 
 
 class EventQueue:
@@ -319,7 +413,13 @@ class EventQueue:
         # When extending this list of properties, one must be sure to
         # update to_dict and from_dict.
 
-        self.queue: Deque[Dict[str, Any]] = deque()
+        # Each entry is an (event_id, payload) pair.  The payload is
+        # the event dictionary as passed to push(), which is shared
+        # between all the queues that received the event; the id is
+        # only added when the event is read via contents().  Python's
+        # reference counting frees the payload once every queue
+        # holding it has pruned it.
+        self.queue: Deque[Tuple[int, Mapping[str, Any]]] = deque()
         self.next_event_id: int = 0
         # will only be None for migration from old versions
         self.newest_pruned_id: Optional[int] = -1
@@ -333,7 +433,10 @@ class EventQueue:
         d = dict(
             id=self.id,
             next_event_id=self.next_event_id,
-            queue=list(self.queue),
+            queue=[
+                materialize_event(event_id, payload, include_internal_data=True)
+                for (event_id, payload) in self.queue
+            ],
             virtual_events=self.virtual_events,
         )
         if self.newest_pruned_id is not None:
@@ -345,74 +448,99 @@ class EventQueue:
         ret = cls(d["id"])
         ret.next_event_id = d["next_event_id"]
         ret.newest_pruned_id = d.get("newest_pruned_id", None)
-        ret.queue = deque(d["queue"])
+        # The stale "id" key left in each payload is harmless, since
+        # materialize_event overrides it.
+        ret.queue = deque((event["id"], event) for event in d["queue"])
         ret.virtual_events = d.get("virtual_events", {})
         return ret
 
     def push(self, orig_event: Mapping[str, Any]) -> None:
-        # By default, we make a shallow copy of the event dictionary
-        # to push into the target event queue; this allows the calling
-        # code to send the same "event" object to multiple queues.
-        # This behavior is important because the event_queue system is
-        # about to mutate the event dictionary, minimally to add the
-        # event_id attribute.
-        event = dict(orig_event)
-        event["id"] = self.next_event_id
+        # The event dictionary is stored by reference rather than
+        # copied; this allows the calling code to send the same
+        # "event" object to many queues without allocating a copy for
+        # each one.  As a result, callers must not mutate an event
+        # after pushing it.
+        if orig_event["type"] == "update_message_flags":
+            self.flush_conflicting_flag_events(orig_event)
+
+        event_id = self.next_event_id
         self.next_event_id += 1
-        full_event_type = compute_full_event_type(event)
-        if full_event_type == "restart" or (
-            full_event_type.startswith("flags/")
-            and not full_event_type.startswith("flags/remove/read")
-        ):
-            # virtual_events are an optimization that allows certain
-            # simple events, such as update_message_flags events that
-            # simply contain a list of message IDs to operate on, to
-            # be compressed together. This is primarily useful for
-            # flags/add/read, where normal Zulip usage will result in
-            # many small flags/add/read events as users scroll.
-            #
-            # We need to exclude flags/remove/read, because it has an
-            # extra message_details field that cannot be compressed.
-            #
-            # BUG: This compression algorithm is incorrect in the
-            # presence of mark-as-unread, since it does not respect
-            # the ordering of "mark as read" and "mark as unread"
-            # updates for a given message.
-            if full_event_type not in self.virtual_events:
-                self.virtual_events[full_event_type] = copy.deepcopy(event)
-                return
-
-            # Update the virtual event with the values from the event
-            virtual_event = self.virtual_events[full_event_type]
-            virtual_event["id"] = event["id"]
-            if "timestamp" in event:
-                virtual_event["timestamp"] = event["timestamp"]
-
-            if full_event_type == "restart":
-                virtual_event["server_generation"] = event["server_generation"]
-            elif full_event_type.startswith("flags/"):
-                virtual_event["messages"] += event["messages"]
-        else:
-            self.queue.append(event)
+        key = compute_compaction_key(orig_event)
+        if key is None:
+            self.queue.append((event_id, orig_event))
+            return
+
+        # virtual_events are an optimization that allows certain
+        # simple events, such as update_message_flags events that
+        # simply contain a list of message IDs to operate on, or
+        # repeated typing and presence updates, to be compressed
+        # together.  This is primarily useful for flags/add/read,
+        # where normal Zulip usage will result in many small
+        # flags/add/read events as users scroll, and for clients
+        # that poll slowly.
+        #
+        # A virtual event always takes the id of the latest event
+        # merged into it, so compaction only ever moves events later
+        # in the queue.  Events that must not be reordered relative
+        # to a pending virtual event (e.g. marking a message as
+        # unread after marking it as read) flush it into the queue
+        # first; see flush_conflicting_flag_events.
+        event_type = orig_event["type"]
+        compaction_pushed_counts[event_type] += 1
+        if key not in self.virtual_events:
+            # Virtual events are mutated in place below, so they
+            # get a private copy.
+            virtual_event = copy.deepcopy(dict(orig_event))
+            virtual_event["id"] = event_id
+            self.virtual_events[key] = virtual_event
+            return
+
+        compaction_merged_counts[event_type] += 1
+        virtual_event = self.virtual_events[key]
+        virtual_event["id"] = event_id
+        merge_compacted_event(key, virtual_event, orig_event)
+
+    def flush_virtual_event(self, key: str) -> None:
+        # Moves a pending virtual event into the queue, giving it a
+        # fresh id so that it stays ordered before any event pushed
+        # after this point.
+        virtual_event = self.virtual_events.pop(key)
+        virtual_event["id"] = self.next_event_id
+        self.next_event_id += 1
+        self.queue.append((virtual_event["id"], virtual_event))
+
+    def flush_conflicting_flag_events(self, event: Mapping[str, Any]) -> None:
+        # An update to a flag must be delivered after every earlier
+        # pending update of the other kind to that same flag, or
+        # (for example) "mark as unread" following "mark as read"
+        # could be applied in the wrong order.
+        flag = event["flag"]
+        own_key = compute_compaction_key(event)
+        for key in list(self.virtual_events):
+            if key == own_key or not key.startswith("flags/"):
+                continue
+            if key.rsplit("/", 1)[1] == flag:
+                self.flush_virtual_event(key)
 
     # Note that pop ignores virtual events.  This is fine in our
     # current usage since virtual events should always be resolved to
     # a real event before being given to users.
     def pop(self) -> Dict[str, Any]:
-        return self.queue.popleft()
+        event_id, payload = self.queue.popleft()
+        return materialize_event(event_id, payload, include_internal_data=True)
 
     def empty(self) -> bool:
         return len(self.queue) == 0 and len(self.virtual_events) == 0
 
     # See the comment on pop; that applies here as well
     def prune(self, through_id: int) -> None:
-        while len(self.queue) != 0 and self.queue[0]["id"] <= through_id:
-            self.newest_pruned_id = self.queue[0]["id"]
-            self.pop()
+        while len(self.queue) != 0 and self.queue[0][0] <= through_id:
+            self.newest_pruned_id, _ = self.queue.popleft()
 
     def contents(self, include_internal_data: bool = False) -> List[Dict[str, Any]]:
         contents: List[Dict[str, Any]] = []
-        virtual_id_map: Dict[str, Dict[str, Any]] = {}
+        queue: Deque[Tuple[int, Mapping[str, Any]]] = deque()
+        virtual_id_map: Dict[int, Dict[str, Any]] = {}
         for event_type in self.virtual_events:
             virtual_id_map[self.virtual_events[event_type]["id"]] = self.virtual_events[event_type]
         virtual_ids = sorted(virtual_id_map.keys())
@@ -420,40 +548,40 @@ class EventQueue:
         # Merge the virtual events into their final place in the queue
         index = 0
         length = len(virtual_ids)
-        for event in self.queue:
-            while index < length and virtual_ids[index] < event["id"]:
-                contents.append(virtual_id_map[virtual_ids[index]])
+        for event_id, payload in self.queue:
+            while index < length and virtual_ids[index] < event_id:
+                virtual_id = virtual_ids[index]
+                queue.append((virtual_id, virtual_id_map[virtual_id]))
+                contents.append(
+                    materialize_event(virtual_id, virtual_id_map[virtual_id], include_internal_data)
+                )
                 index += 1
-            contents.append(event)
+            queue.append((event_id, payload))
+            contents.append(materialize_event(event_id, payload, include_internal_data))
         while index < length:
-            contents.append(virtual_id_map[virtual_ids[index]])
+            virtual_id = virtual_ids[index]
+            queue.append((virtual_id, virtual_id_map[virtual_id]))
+            contents.append(
+                materialize_event(virtual_id, virtual_id_map[virtual_id], include_internal_data)
+            )
             index += 1
 
         self.virtual_events = {}
-        self.queue = deque(contents)
-
-        if include_internal_data:
-            return contents
-        return prune_internal_data(contents)
-
-
-def prune_internal_data(events: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-    """Prunes the internal_data data structures, which are not intended to
-    be exposed to API clients.
-    """
-    events = copy.deepcopy(events)
-    for event in events:
-        if event["type"] == "message" and "internal_data" in event:
-            del event["internal_data"]
-    return events
+        self.queue = queue
+        return contents
 
 
 # maps queue ids to client descriptors
 clients: Dict[str, ClientDescriptor] = {}
 # maps user id to list of client descriptors
 user_clients: Dict[int, List[ClientDescriptor]] = {}
-# maps realm id to list of client descriptors with all_public_streams=True
+# maps realm id to list of client descriptors that may accept any
+# message sent to a public stream: those with all_public_streams=True,
+# and those with a narrow that is not limited to a single stream
 realm_clients_all_streams: Dict[int, List[ClientDescriptor]] = {}
+# maps realm id and lowercased stream name to list of client
+# descriptors whose narrow only accepts messages sent to that stream
+realm_clients_by_stream: Dict[int, Dict[str, List[ClientDescriptor]]] = {}
 
 # list of registered gc hooks.
 # each one will be called with a user profile id, queue, and bool
@@ -463,12 +591,43 @@ realm_clients_all_streams: Dict[int, List[ClientDescriptor]] = {}
 gc_hooks: List[Callable[[int, ClientDescriptor, bool], None]] = []
 
 
+# While a batch of notices from the notify_tornado queue is being
+# processed, maps queue ids to the connected clients that received
+# events in the batch; see finish_handlers_after_batch.
+clients_pending_finish: Optional[Dict[str, ClientDescriptor]] = None
+
+
+@contextmanager
+def finish_handlers_after_batch() -> Iterator[None]:
+    """Within this context, ClientDescriptor.add_event defers finishing
+    the long-polling request for a client until the context exits, so
+    that a burst of events for the same client is returned by a single
+    response rather than waking up the client once per event."""
+    global clients_pending_finish
+    if clients_pending_finish is not None:
+        # Already inside a batch.
+        yield
+        return
+
+    clients_pending_finish = {}
+    try:
+        yield
+    finally:
+        pending_clients = clients_pending_finish
+        clients_pending_finish = None
+        for client in pending_clients.values():
+            client.finish_current_handler()
+
+
 def clear_client_event_queues_for_testing() -> None:
     assert settings.TEST_SUITE
     clients.clear()
     user_clients.clear()
     realm_clients_all_streams.clear()
+    realm_clients_by_stream.clear()
     gc_hooks.clear()
+    migrated_user_ports.clear()
+    held_user_events.clear()
 
 
 def add_client_gc_hook(hook: Callable[[int, ClientDescriptor, bool], None]) -> None:
@@ -498,9 +657,19 @@ def get_client_descriptors_for_realm_all_streams(realm_id: int) -> List[ClientDe
     return realm_clients_all_streams.get(realm_id, [])
 
 
+def get_client_descriptors_for_realm_stream(
+    realm_id: int, stream_name: str
+) -> List[ClientDescriptor]:
+    return realm_clients_by_stream.get(realm_id, {}).get(stream_name.lower(), [])
+
+
 def add_to_client_dicts(client: ClientDescriptor) -> None:
     user_clients.setdefault(client.user_profile_id, []).append(client)
-    if client.all_public_streams or client.narrow != []:
+    if client.narrow_stream_name is not None:
+        realm_clients_by_stream.setdefault(client.realm_id, {}).setdefault(
+            client.narrow_stream_name, []
+        ).append(client)
+    elif client.all_public_streams or client.narrow != []:
         realm_clients_all_streams.setdefault(client.realm_id, []).append(client)
 
 
@@ -513,11 +682,11 @@ def allocate_client_descriptor(new_queue_data: MutableMapping[str, Any]) -> Clie
     return client
 
 
-def do_gc_event_queues(
+def remove_from_client_dicts(
     to_remove: AbstractSet[str], affected_users: AbstractSet[int], affected_realms: AbstractSet[int]
 ) -> None:
     def filter_client_dict(
-        client_dict: MutableMapping[int, List[ClientDescriptor]], key: int
+        client_dict: MutableMapping[Any, List[ClientDescriptor]], key: Any
     ) -> None:
         if key not in client_dict:
             return
@@ -533,6 +702,18 @@ def do_gc_event_queues(
 
     for realm_id in affected_realms:
         filter_client_dict(realm_clients_all_streams, realm_id)
+        stream_dict = realm_clients_by_stream.get(realm_id)
+        if stream_dict is not None:
+            for stream_name in list(stream_dict):
+                filter_client_dict(stream_dict, stream_name)
+            if len(stream_dict) == 0:
+                del realm_clients_by_stream[realm_id]
+
+
+def do_gc_event_queues(
+    to_remove: AbstractSet[str], affected_users: AbstractSet[int], affected_realms: AbstractSet[int]
+) -> None:
+    remove_from_client_dicts(to_remove, affected_users, affected_realms)
 
     for id in to_remove:
         for cb in gc_hooks:
@@ -563,13 +744,14 @@ def gc_event_queues(port: int) -> None:
     if settings.PRODUCTION:
         logging.info(
             "Tornado %d removed %d expired event queues owned by %d users in %.3fs."
-            "  Now %d active queues, %s",
+            "  Now %d active queues, %s, %s",
             port,
             len(to_remove),
             len(affected_users),
             time.time() - start,
             len(clients),
             handler_stats_string(),
+            compaction_stats_string(),
         )
 
 
@@ -588,34 +770,38 @@ def dump_event_queues(port: int) -> None:
     start = time.time()
 
     with open(persistent_queue_filename(port), "wb") as stored_queues:
-        stored_queues.write(
-            orjson.dumps([(qid, client.to_dict()) for (qid, client) in clients.items()])
+        size = write_queue_snapshot(
+            stored_queues,
+            ((qid, client.to_dict()) for (qid, client) in clients.items()),
+            compress=settings.TORNADO_QUEUE_SNAPSHOT_COMPRESSION,
         )
 
     if len(clients) > 0 or settings.PRODUCTION:
         logging.info(
-            "Tornado %d dumped %d event queues in %.3fs", port, len(clients), time.time() - start
+            "Tornado %d dumped %d event queues (%d bytes) in %.3fs",
+            port,
+            len(clients),
+            size,
+            time.time() - start,
         )
 
 
 def load_event_queues(port: int) -> None:
-    global clients
     start = time.time()
+    size = 0
 
     try:
         with open(persistent_queue_filename(port), "rb") as stored_queues:
-            data = orjson.loads(stored_queues.read())
+            size = os.fstat(stored_queues.fileno()).st_size
+            # Queues are deserialized one at a time as they are read
+            # from the snapshot; if the snapshot is damaged partway
+            # through, we keep the queues we managed to load.
+            for qid, client_dict in read_queue_snapshot(stored_queues):
+                clients[qid] = ClientDescriptor.from_dict(client_dict)
     except FileNotFoundError:
         pass
-    except orjson.JSONDecodeError:
+    except Exception:
         logging.exception("Tornado %d could not deserialize event queues", port, stack_info=True)
-    else:
-        try:
-            clients = {qid: ClientDescriptor.from_dict(client) for (qid, client) in data}
-        except Exception:
-            logging.exception(
-                "Tornado %d could not deserialize event queues", port, stack_info=True
-            )
 
     for client in clients.values():
         # Put code for migrations due to event queue data format changes here
@@ -624,7 +810,11 @@ def load_event_queues(port: int) -> None:
 
     if len(clients) > 0 or settings.PRODUCTION:
         logging.info(
-            "Tornado %d loaded %d event queues in %.3fs", port, len(clients), time.time() - start
+            "Tornado %d loaded %d event queues (%d bytes) in %.3fs",
+            port,
+            len(clients),
+            size,
+            time.time() - start,
         )
 
 
@@ -643,10 +833,229 @@ def send_restart_events(immediate: bool = False) -> None:
             client.add_event(event)
 
 
+# Maximum number of event queues sent to another Tornado process in
+# a single migrate_event_queues notice.
+MIGRATE_EVENT_QUEUES_BATCH_SIZE = 100
+
+# How long after the sharding configuration changes we forward events
+# for the users whose queues we handed off, and hold events for users
+# whose queues may still be on their way to us.  Django processes may
+# route events with a configuration up to
+# SHARDING_CONFIG_CHECK_INTERVAL_SECS out of date, and the process
+# handing off a queue may notice the change that much later than us.
+EVENT_QUEUE_MIGRATION_GRACE_PERIOD_SECS = 3 * SHARDING_CONFIG_CHECK_INTERVAL_SECS
+
+# The port of this Tornado process; set by setup_event_queue.
+tornado_port: Optional[int] = None
+
+# The version of the sharding configuration that this process last
+# checked its event queues against.
+rebalanced_sharding_config_version: Optional[float] = None
+
+# maps the ids of users whose event queues we handed off to another
+# Tornado process to that process's port, and the time until which we
+# forward their events there
+migrated_user_ports: Dict[int, Tuple[int, float]] = {}
+# maps the ids of users whose event queues may still be on their way
+# to us to the time until which we hold their events, and the events,
+# each with the user's entry in the notice's `users`
+held_user_events: Dict[
+    int, Tuple[float, List[Tuple[Mapping[str, Any], Union[int, Mapping[str, Any]]]]]
+] = {}
+
+
+def migrate_misplaced_event_queues(port: int) -> None:
+    """Hands off the event queues of users who, per the current sharding
+    configuration, belong to a different Tornado process.
+
+    Each queue is serialized with ClientDescriptor.to_dict, the format
+    used for persisting queues across restarts, and sent to its new
+    process via that process's notify_tornado queue.  Any connected
+    client is first sent its pending events, so that it reconnects,
+    and is routed to the new process by get_events.
+    """
+    global rebalanced_sharding_config_version
+    rebalanced_sharding_config_version = get_sharding_config_version()
+    if settings.TORNADO_PROCESSES == 1:
+        return
+
+    start = time.time()
+    realm_ports: Dict[int, List[int]] = {}
+    to_migrate: Dict[int, Dict[int, List[ClientDescriptor]]] = defaultdict(
+        lambda: defaultdict(list)
+    )
+    for client in clients.values():
+        if client.realm_id not in realm_ports:
+            realm_ports[client.realm_id] = get_realm_tornado_ports(get_realm_by_id(client.realm_id))
+        user_port = get_user_id_tornado_port(realm_ports[client.realm_id], client.user_profile_id)
+        if user_port != port:
+            to_migrate[user_port][client.user_profile_id].append(client)
+
+    if not to_migrate:
+        return
+
+    def send_batch(target_port: int, batch: List[ClientDescriptor]) -> None:
+        queue_json_publish(
+            notify_tornado_queue_name(target_port),
+            dict(
+                event=dict(
+                    type="migrate_event_queues",
+                    queues=[[client.event_queue.id, client.to_dict()] for client in batch],
+                ),
+                users=sorted({client.user_profile_id for client in batch}),
+            ),
+        )
+
+    to_remove: Set[str] = set()
+    affected_users: Set[int] = set()
+    affected_realms: Set[int] = set()
+    forward_until = time.time() + EVENT_QUEUE_MIGRATION_GRACE_PERIOD_SECS
+    for target_port, migrating_user_clients in to_migrate.items():
+        # All of a user's queues are sent in the same notice, so the
+        # receiving process can release the events it held for the
+        # user once it has them.
+        batch: List[ClientDescriptor] = []
+        for user_id, migrating_clients in migrating_user_clients.items():
+            for client in migrating_clients:
+                client.finish_current_handler()
+                to_remove.add(client.event_queue.id)
+                affected_realms.add(client.realm_id)
+            affected_users.add(user_id)
+            # Django processes which have not yet noticed the change
+            # still send this user's events to us.
+            migrated_user_ports[user_id] = (target_port, forward_until)
+            batch.extend(migrating_clients)
+            if len(batch) >= MIGRATE_EVENT_QUEUES_BATCH_SIZE:
+                send_batch(target_port, batch)
+                batch = []
+        if batch:
+            send_batch(target_port, batch)
+
+    # The queues live on in their new process, so unlike in
+    # do_gc_event_queues, we do not run the gc_hooks.
+    remove_from_client_dicts(to_remove, affected_users, affected_realms)
+    for queue_id in to_remove:
+        del clients[queue_id]
+
+    logging.info(
+        "Tornado %d migrated %d event queues to ports %s in %.3fs",
+        port,
+        len(to_remove),
+        sorted(to_migrate),
+        time.time() - start,
+    )
+
+
+def maybe_rebalance_event_queues(port: int, force: bool = False) -> None:
+    maybe_reload_sharding_config(force=force)
+    if get_sharding_config_version() != rebalanced_sharding_config_version:
+        migrate_misplaced_event_queues(port)
+    expire_event_queue_migrations()
+
+
+def receive_migrated_event_queues(queues: List[List[Any]]) -> None:
+    user_ids: Set[int] = set()
+    for queue_id, client_dict in queues:
+        client = ClientDescriptor.from_dict(client_dict)
+        clients[queue_id] = client
+        add_to_client_dicts(client)
+        user_ids.add(client.user_profile_id)
+    logging.info("Received %d event queues migrated from another Tornado process", len(queues))
+
+    for user_id in sorted(user_ids):
+        # The user's queues are back with us, if we had handed them off.
+        migrated_user_ports.pop(user_id, None)
+        if user_id in held_user_events:
+            release_held_events(user_id)
+
+
+def release_held_events(user_id: int) -> None:
+    for event, user in held_user_events.pop(user_id)[1]:
+        if event["type"] == "message":
+            # process_notification dispatched the message when it was
+            # held, which delivered it to our clients for all of the
+            # stream's messages; only the user's clients still need it.
+            event = {key: value for key, value in event.items() if key != "stream_name"}
+        dispatch_notification(event, [user])
+
+
+def expire_event_queue_migrations() -> None:
+    now = time.time()
+    for user_id in list(migrated_user_ports):
+        if migrated_user_ports[user_id][1] <= now:
+            del migrated_user_ports[user_id]
+    for user_id in list(held_user_events):
+        if held_user_events[user_id][0] <= now:
+            # The user had no queues on their way to us after all.
+            release_held_events(user_id)
+
+
+def route_notification_users(
+    notice: Mapping[str, Any]
+) -> Union[List[int], List[Mapping[str, Any]]]:
+    """Handles the users in a notice whose event queues are moving
+    between Tornado processes because the sharding configuration
+    changed, returning the users whose events we should process now.
+
+    Events for users whose queues we handed off are forwarded to
+    their new process for EVENT_QUEUE_MIGRATION_GRACE_PERIOD_SECS.
+    Events for users without queues here, who belonged to another
+    process before the configuration last changed, are held until
+    their queues arrive from it, or the grace period ends.
+    """
+    users: Union[List[int], List[Mapping[str, Any]]] = notice["users"]
+    if tornado_port is None:
+        return users
+
+    notice_version = notice.get("sharding_config_version")
+    if notice_version is not None and notice_version > get_sharding_config_version():
+        # The sender has seen a configuration change that we have
+        # not; pick it up now, so we hold the events of users whose
+        # queues are about to be handed to us.
+        maybe_rebalance_event_queues(tornado_port, force=True)
+
+    now = time.time()
+    hold_until = get_sharding_config_loaded_time() + EVENT_QUEUE_MIGRATION_GRACE_PERIOD_SECS
+    previous_ports: Optional[List[int]] = None
+    if "realm_id" in notice and now < hold_until:
+        previous_ports = get_previous_realm_tornado_ports(get_realm_by_id(notice["realm_id"]))
+    if previous_ports is None and not migrated_user_ports and not held_user_events:
+        return users
+
+    event: Mapping[str, Any] = notice["event"]
+    local_users: List[Any] = []
+    forwarded_users: Dict[int, List[Any]] = defaultdict(list)
+    for user in users:
+        user_id = user if isinstance(user, int) else user["id"]
+        if user_id in migrated_user_ports and migrated_user_ports[user_id][1] > now:
+            forwarded_users[migrated_user_ports[user_id][0]].append(user)
+        elif user_id in held_user_events:
+            held_user_events[user_id][1].append((event, user))
+        elif (
+            previous_ports is not None
+            and user_id not in user_clients
+            and get_user_id_tornado_port(previous_ports, user_id) != tornado_port
+        ):
+            held_user_events[user_id] = (hold_until, [(event, user)])
+        else:
+            local_users.append(user)
+
+    for port, port_users in forwarded_users.items():
+        queue_json_publish(notify_tornado_queue_name(port), {**notice, "users": port_users})
+    return local_users
+
+
 async def setup_event_queue(server: tornado.httpserver.HTTPServer, port: int) -> None:
+    global tornado_port
+    if settings.TORNADO_PROCESSES > 1:
+        tornado_port = port
+
     if not settings.TEST_SUITE:
         load_event_queues(port)
         autoreload.add_reload_hook(lambda: dump_event_queues(port))
+        # The sharding configuration may have changed while we were
+        # not running.
+        migrate_misplaced_event_queues(port)
 
     with suppress(OSError):
         os.rename(persistent_queue_filename(port), persistent_queue_filename(port, last=True))
@@ -655,6 +1064,14 @@ async def setup_event_queue(server: tornado.httpserver.HTTPServer, port: int) ->
     pc = tornado.ioloop.PeriodicCallback(lambda: gc_event_queues(port), EVENT_QUEUE_GC_FREQ_MSECS)
     pc.start()
 
+    # Pick up changes to the sharding configuration without a restart
+    if settings.TORNADO_PROCESSES > 1:
+        rebalance_pc = tornado.ioloop.PeriodicCallback(
+            lambda: maybe_rebalance_event_queues(port),
+            SHARDING_CONFIG_CHECK_INTERVAL_SECS * 1000,
+        )
+        rebalance_pc.start()
+
     send_restart_events(immediate=settings.DEVELOPMENT)
 
 
@@ -958,10 +1375,14 @@ def get_client_info_for_message_event(
         return (sender_queue_id is not None) and client.event_queue.id == sender_queue_id
 
     # If we're on a public stream, look for clients (typically belonging to
-    # bots) that are registered to get events for ALL streams.
+    # bots) that are registered to get events for ALL streams, as well as
+    # clients narrowed to this specific stream.
     if "stream_name" in event_template and not event_template.get("invite_only"):
         realm_id = event_template["realm_id"]
-        for client in get_client_descriptors_for_realm_all_streams(realm_id):
+        for client in itertools.chain(
+            get_client_descriptors_for_realm_all_streams(realm_id),
+            get_client_descriptors_for_realm_stream(realm_id, event_template["stream_name"]),
+        ):
             send_to_clients[client.event_queue.id] = dict(
                 client=client,
                 flags=[],
@@ -1504,9 +1925,28 @@ def reformat_legacy_send_message_event(
 
 def process_notification(notice: Mapping[str, Any]) -> None:
     event: Mapping[str, Any] = notice["event"]
-    users: Union[List[int], List[Mapping[str, Any]]] = notice["users"]
     start_time = time.time()
 
+    users: Union[List[int], List[Mapping[str, Any]]] = notice["users"]
+    routed = False
+    if users and event["type"] != "migrate_event_queues":
+        users = route_notification_users(notice)
+        routed = not users
+    # Even if the message's recipients were all forwarded or held, our
+    # clients for all of the stream's messages still need it.
+    if not routed or event["type"] == "message":
+        dispatch_notification(event, users)
+    logging.debug(
+        "Tornado: Event %s for %s users took %sms",
+        event["type"],
+        len(users),
+        int(1000 * (time.time() - start_time)),
+    )
+
+
+def dispatch_notification(
+    event: Mapping[str, Any], users: Union[List[int], List[Mapping[str, Any]]]
+) -> None:
     if event["type"] == "message":
         if len(users) > 0 and isinstance(users[0], dict) and "stream_push_notify" in users[0]:
             # TODO/compatibility: Remove this whole block once one can no
@@ -1534,6 +1974,10 @@ def process_notification(notice: Mapping[str, Any]) -> None:
         process_presence_event(event, cast(List[int], users))
     elif event["type"] == "custom_profile_fields":
         process_custom_profile_fields_event(event, cast(List[int], users))
+    elif event["type"] == "migrate_event_queues":
+        # Sent by migrate_misplaced_event_queues in another Tornado
+        # process when the sharding configuration changes.
+        receive_migrated_event_queues(event["queues"])
     elif event["type"] == "cleanup_queue":
         # cleanup_event_queue may generate this event to forward cleanup
         # requests to the right shard.
@@ -1548,12 +1992,6 @@ def process_notification(notice: Mapping[str, Any]) -> None:
             client.cleanup()
     else:
         process_event(event, cast(List[int], users))
-    logging.debug(
-        "Tornado: Event %s for %s users took %sms",
-        event["type"],
-        len(users),
-        int(1000 * (time.time() - start_time)),
-    )
 
 
 def get_wrapped_process_notification(queue_name: str) -> Callable[[List[Dict[str, Any]]], None]:
@@ -1565,10 +2003,14 @@ def get_wrapped_process_notification(queue_name: str) -> Callable[[List[Dict[str
         )
 
     def wrapped_process_notification(notices: List[Dict[str, Any]]) -> None:
-        for notice in notices:
-            try:
-                process_notification(notice)
-            except Exception:
-                retry_event(queue_name, notice, failure_processor)
+        # Notices are processed in order, since clients rely on
+        # receiving events in the order they were sent; but clients
+        # are only woken up once for the whole batch.
+        with finish_handlers_after_batch():
+            for notice in notices:
+                try:
+                    process_notification(notice)
+                except Exception:
+                    retry_event(queue_name, notice, failure_processor)
 
     return wrapped_process_notification
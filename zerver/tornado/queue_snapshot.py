@@ -0,0 +1,130 @@
+# Streaming on-disk format for persisting Tornado event queues across
+# restarts.  See dump_event_queues and load_event_queues in
+# zerver/tornado/event_queue.py for the callers.
+#
+# The file starts with a fixed header (magic, format version, flags),
+# followed by a sequence of length-prefixed records, each of which is
+# the orjson encoding of a single (queue_id, ClientDescriptor.to_dict())
+# pair.  A zero-length record marks the end of the snapshot, so that a
+# file truncated by a crash mid-dump can be detected.  When the
+# compression flag is set, everything after the header is a single
+# zlib stream.
+#
+# Records are written one at a time as they are serialized, and read
+# back lazily, so neither dumping nor loading ever needs to hold the
+# full encoded snapshot in memory.
+import struct
+import zlib
+from typing import IO, Any, Dict, Iterable, Iterator, Tuple
+
+import orjson
+
+SNAPSHOT_MAGIC = b"ZEQS"
+SNAPSHOT_VERSION = 1
+
+SNAPSHOT_FLAG_ZLIB = 0x01
+
+SNAPSHOT_HEADER = struct.Struct(">4sBB")
+RECORD_HEADER = struct.Struct(">I")
+
+READ_CHUNK_SIZE = 256 * 1024
+
+
+class QueueSnapshotError(Exception):
+    pass
+
+
+class _SnapshotWriter:
+    def __init__(self, f: IO[bytes], compress: bool) -> None:
+        self.f = f
+        self.compressor = zlib.compressobj(level=1) if compress else None
+        self.bytes_written = 0
+
+    def write(self, data: bytes) -> None:
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+            if not data:
+                return
+        self.f.write(data)
+        self.bytes_written += len(data)
+
+    def close(self) -> None:
+        if self.compressor is not None:
+            data = self.compressor.flush()
+            self.f.write(data)
+            self.bytes_written += len(data)
+
+
+def write_queue_snapshot(
+    f: IO[bytes], records: Iterable[Tuple[str, Dict[str, Any]]], compress: bool = False
+) -> int:
+    """Writes the (queue_id, client_dict) pairs in records to f,
+    serializing one queue at a time.  Returns the number of bytes
+    written."""
+    flags = SNAPSHOT_FLAG_ZLIB if compress else 0
+    f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, flags))
+
+    writer = _SnapshotWriter(f, compress)
+    for queue_id, client_dict in records:
+        data = orjson.dumps((queue_id, client_dict))
+        writer.write(RECORD_HEADER.pack(len(data)))
+        writer.write(data)
+    writer.write(RECORD_HEADER.pack(0))
+    writer.close()
+    return SNAPSHOT_HEADER.size + writer.bytes_written
+
+
+def _iter_decompressed_chunks(f: IO[bytes], compressed: bool) -> Iterator[bytes]:
+    decompressor = zlib.decompressobj() if compressed else None
+    while True:
+        chunk = f.read(READ_CHUNK_SIZE)
+        if not chunk:
+            break
+        if decompressor is not None:
+            chunk = decompressor.decompress(chunk)
+        yield chunk
+    if decompressor is not None:
+        yield decompressor.flush()
+
+
+def _iter_records(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    buf = bytearray()
+    for chunk in chunks:
+        buf += chunk
+        offset = 0
+        while len(buf) - offset >= RECORD_HEADER.size:
+            (length,) = RECORD_HEADER.unpack_from(buf, offset)
+            if length == 0:
+                return
+            end = offset + RECORD_HEADER.size + length
+            if end > len(buf):
+                break
+            yield bytes(buf[offset + RECORD_HEADER.size : end])
+            offset = end
+        del buf[:offset]
+    raise QueueSnapshotError("Event queue snapshot is truncated")
+
+
+def read_queue_snapshot(f: IO[bytes]) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """Lazily yields the (queue_id, client_dict) pairs stored in f.
+
+    Files written by older servers, which stored all queues as a
+    single JSON array, are also supported; those are necessarily
+    parsed in one piece."""
+    header = f.read(SNAPSHOT_HEADER.size)
+    if len(header) < SNAPSHOT_HEADER.size or not header.startswith(SNAPSHOT_MAGIC):
+        # TODO/compatibility: Legacy JSON format, used by servers
+        # older than 8.0.  Remove this once one can no longer directly
+        # upgrade from 7.x to main.
+        for queue_id, client_dict in orjson.loads(header + f.read()):
+            yield queue_id, client_dict
+        return
+
+    _, version, flags = SNAPSHOT_HEADER.unpack(header)
+    if version != SNAPSHOT_VERSION:
+        raise QueueSnapshotError(f"Unsupported event queue snapshot version {version}")
+
+    chunks = _iter_decompressed_chunks(f, compressed=bool(flags & SNAPSHOT_FLAG_ZLIB))
+    for record in _iter_records(chunks):
+        queue_id, client_dict = orjson.loads(record)
+        yield queue_id, client_dict
@@ -1,40 +1,146 @@
+import bisect
+import hashlib
 import json
 import os
 import re
-from typing import Dict, List, Pattern, Tuple, Union
+import time
+from functools import lru_cache
+from typing import Dict, List, Pattern, Sequence, Tuple, Union
 
 from django.conf import settings
 
 from zerver.models import Realm, UserProfile
 
+SHARDING_CONFIG_PATH = "/etc/zulip/sharding.json"
+# How often each process checks whether sharding.json has changed.
+SHARDING_CONFIG_CHECK_INTERVAL_SECS = 10
+# The number of points each Tornado port gets on the consistent-hashing
+# ring used to assign a realm's users to that realm's ports.
+VIRTUAL_NODES_PER_PORT = 128
+
 shard_map: Dict[str, Union[int, List[int]]] = {}
 shard_regexes: List[Tuple[Pattern[str], Union[int, List[int]]]] = []
-if os.path.exists("/etc/zulip/sharding.json"):
-    with open("/etc/zulip/sharding.json") as f:
+shard_config_mtime: float = 0
+shard_config_checked_time: float = 0
+# The configuration in effect before sharding.json last changed, and
+# when this process loaded the change.
+previous_shard_map: Dict[str, Union[int, List[int]]] = {}
+previous_shard_regexes: List[Tuple[Pattern[str], Union[int, List[int]]]] = []
+shard_config_loaded_time: float = 0
+
+
+def load_sharding_config() -> None:
+    global shard_map, shard_regexes, shard_config_mtime
+    global previous_shard_map, previous_shard_regexes, shard_config_loaded_time
+    try:
+        mtime = os.stat(SHARDING_CONFIG_PATH).st_mtime
+    except FileNotFoundError:
+        return
+    with open(SHARDING_CONFIG_PATH) as f:
         data = json.loads(f.read())
-        shard_map = data.get(
-            "shard_map",
-            data,  # backwards compatibility
-        )
-        shard_regexes = [
-            (re.compile(regex, re.I), port) for regex, port in data.get("shard_regexes", [])
-        ]
+    new_shard_map = data.get(
+        "shard_map",
+        data,  # backwards compatibility
+    )
+    new_shard_regexes = [
+        (re.compile(regex, re.I), port) for regex, port in data.get("shard_regexes", [])
+    ]
+    if shard_config_mtime:
+        previous_shard_map, previous_shard_regexes = shard_map, shard_regexes
+    else:
+        # On startup, there is no earlier configuration to move from.
+        previous_shard_map, previous_shard_regexes = new_shard_map, new_shard_regexes
+    shard_map, shard_regexes = new_shard_map, new_shard_regexes
+    shard_config_mtime = mtime
+    shard_config_loaded_time = time.time()
 
 
-def get_realm_tornado_ports(realm: Realm) -> List[int]:
-    if realm.host in shard_map:
-        ports = shard_map[realm.host]
+def maybe_reload_sharding_config(force: bool = False) -> bool:
+    """Reloads sharding.json if it has changed on disk since it was last
+    loaded, checking at most every SHARDING_CONFIG_CHECK_INTERVAL_SECS
+    unless `force` is passed.  Returns whether the configuration was
+    reloaded."""
+    global shard_config_checked_time
+    now = time.time()
+    if not force and now - shard_config_checked_time < SHARDING_CONFIG_CHECK_INTERVAL_SECS:
+        return False
+    shard_config_checked_time = now
+
+    try:
+        mtime = os.stat(SHARDING_CONFIG_PATH).st_mtime
+    except FileNotFoundError:
+        return False
+    if mtime == shard_config_mtime:
+        return False
+    load_sharding_config()
+    return True
+
+
+def get_sharding_config_version() -> float:
+    return shard_config_mtime
+
+
+def get_sharding_config_loaded_time() -> float:
+    return shard_config_loaded_time
+
+
+load_sharding_config()
+
+
+def find_realm_tornado_ports(
+    host: str,
+    host_map: Dict[str, Union[int, List[int]]],
+    host_regexes: List[Tuple[Pattern[str], Union[int, List[int]]]],
+) -> List[int]:
+    if host in host_map:
+        ports = host_map[host]
         return [ports] if isinstance(ports, int) else ports
 
-    for regex, ports in shard_regexes:
-        if regex.match(realm.host):
+    for regex, ports in host_regexes:
+        if regex.match(host):
             return [ports] if isinstance(ports, int) else ports
 
     return [settings.TORNADO_PORTS[0]]
 
 
-def get_user_id_tornado_port(realm_ports: List[int], user_id: int) -> int:
-    return realm_ports[user_id % len(realm_ports)]
+def get_realm_tornado_ports(realm: Realm) -> List[int]:
+    maybe_reload_sharding_config()
+    return find_realm_tornado_ports(realm.host, shard_map, shard_regexes)
+
+
+def get_previous_realm_tornado_ports(realm: Realm) -> List[int]:
+    """Returns the realm's ports under the sharding configuration in
+    effect before sharding.json last changed."""
+    return find_realm_tornado_ports(realm.host, previous_shard_map, previous_shard_regexes)
+
+
+def consistent_hash(key: str) -> int:
+    return int.from_bytes(hashlib.sha256(key.encode()).digest()[:8], "big")
+
+
+@lru_cache(maxsize=None)
+def get_hash_ring(realm_ports: Tuple[int, ...]) -> Tuple[List[int], List[int]]:
+    """Returns the sorted points of the consistent-hashing ring for a set
+    of ports, and the port owning each point.
+
+    With a consistent-hashing ring, adding a port to a realm only moves
+    the users whose hash lands on the new port's points, rather than
+    reassigning nearly every user as `user_id % len(realm_ports)` would.
+    """
+    points = sorted(
+        (consistent_hash(f"{port}-{vnode}"), port)
+        for port in realm_ports
+        for vnode in range(VIRTUAL_NODES_PER_PORT)
+    )
+    return [point for point, port in points], [port for point, port in points]
+
+
+def get_user_id_tornado_port(realm_ports: Sequence[int], user_id: int) -> int:
+    if len(realm_ports) == 1:
+        return realm_ports[0]
+    ring_points, ring_ports = get_hash_ring(tuple(sorted(realm_ports)))
+    index = bisect.bisect(ring_points, consistent_hash(str(user_id))) % len(ring_points)
+    return ring_ports[index]
 
 
 def get_user_tornado_port(user: UserProfile) -> int:
@@ -1,7 +1,9 @@
-from typing import Dict, Iterable, List, Optional, Tuple, Union
+import time
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
+import orjson
 from django.contrib.auth.models import AnonymousUser
-from django.http import HttpRequest, HttpResponse
+from django.http import HttpRequest, HttpResponse, HttpResponseBase, StreamingHttpResponse
 from django.utils.html import escape as escape_html
 from django.utils.translation import gettext as _
 from sqlalchemy.sql import and_, column, join, literal, literal_column, select, table
@@ -11,11 +13,13 @@ from zerver.context_processors import get_valid_realm_from_request
 from zerver.lib.exceptions import JsonableError, MissingAuthenticationError
 from zerver.lib.message import get_first_visible_message_id, messages_for_ids
 from zerver.lib.narrow import (
+    FetchedMessages,
     OptionalNarrowListT,
     add_narrow_conditions,
     fetch_messages,
     is_spectator_compatible,
     is_web_public_narrow,
+    narrow_log_string,
     narrow_parameter,
     parse_anchor_value,
 )
@@ -24,10 +28,21 @@ from zerver.lib.response import json_success
 from zerver.lib.sqlalchemy_utils import get_sqlalchemy_connection
 from zerver.lib.topic import DB_TOPIC_NAME, MATCH_TOPIC, topic_column_sa
 from zerver.lib.validator import check_bool, check_int, check_list, to_non_negative_int
-from zerver.models import UserMessage, UserProfile
+from zerver.models import Realm, UserMessage, UserProfile
 
 MAX_MESSAGES_PER_FETCH = 5000
 
+# How many messages get_messages_bulk_backend fetches and renders at
+# a time; this bounds its memory use.
+BULK_FETCH_BATCH_SIZE = 1000
+
+# Limits on a single request to get_messages_bulk_backend, which holds
+# a uWSGI worker for as long as it streams.  Clients resume from the
+# last_message_id in the trailer.  The time limit must be well below
+# uWSGI's harakiri timeout.
+MAX_MESSAGES_PER_BULK_FETCH = 50000
+BULK_FETCH_MAX_SECONDS = 20
+
 
 def highlight_string(text: str, locs: Iterable[Tuple[int, int]]) -> str:
     highlight_start = '<span class="highlight">'
@@ -78,6 +93,67 @@ def get_search_fields(
     }
 
 
+def get_message_list_from_query_info(
+    query_info: FetchedMessages,
+    *,
+    user_profile: Optional[UserProfile],
+    realm: Realm,
+    is_web_public_query: bool,
+    include_flags: bool,
+    apply_markdown: bool,
+    client_gravatar: bool,
+) -> List[Dict[str, Any]]:
+    include_history = query_info.include_history
+    is_search = query_info.is_search
+    rows = query_info.rows
+    message_ids = [row[0] for row in rows]
+
+    # The following is a little messy, but ensures that the code paths
+    # are similar regardless of the value of include_history.  The
+    # 'user_message_flags' dictionary maps each message to the user's
+    # flags for that message, which we will attach to the rendered
+    # message dict before returning it.  We attempt to bulk-fetch
+    # rendered message dicts from remote cache using 'message_ids'.
+    user_message_flags: Optional[Dict[int, List[str]]] = None
+    if not include_flags:
+        # Skip looking up flags entirely; in the include_history
+        # case, that saves a query on UserMessage.
+        pass
+    elif is_web_public_query:
+        # For spectators, we treat all historical messages as read.
+        user_message_flags = {message_id: ["read"] for message_id in message_ids}
+    elif include_history:
+        assert user_profile is not None
+
+        # TODO: This could be done with an outer join instead of two queries
+        um_rows = UserMessage.objects.filter(user_profile=user_profile, message_id__in=message_ids)
+        user_message_flags = {um.message_id: um.flags_list() for um in um_rows}
+
+        for message_id in message_ids:
+            if message_id not in user_message_flags:
+                user_message_flags[message_id] = ["read", "historical"]
+    else:
+        user_message_flags = {row[0]: UserMessage.flags_list_for_flags(row[1]) for row in rows}
+
+    search_fields: Dict[int, Dict[str, str]] = {}
+    if is_search:
+        for row in rows:
+            message_id = row[0]
+            (topic_name, rendered_content, content_matches, topic_matches) = row[-4:]
+            search_fields[message_id] = get_search_fields(
+                rendered_content, topic_name, content_matches, topic_matches
+            )
+
+    return messages_for_ids(
+        message_ids=message_ids,
+        user_message_flags=user_message_flags,
+        search_fields=search_fields,
+        apply_markdown=apply_markdown,
+        client_gravatar=client_gravatar,
+        allow_edit_history=realm.allow_edit_history,
+    )
+
+
 @has_request_variables
 def get_messages_backend(
     request: HttpRequest,
@@ -144,15 +220,9 @@ def get_messages_backend(
 
     if narrow is not None:
         # Add some metadata to our logging data for narrows
-        verbose_operators = []
-        for term in narrow:
-            if term["operator"] == "is":
-                verbose_operators.append("is:" + term["operand"])
-            else:
-                verbose_operators.append(term["operator"])
         log_data = RequestNotes.get_notes(request).log_data
         assert log_data is not None
-        log_data["extra"] = "[{}]".format(",".join(verbose_operators))
+        log_data["extra"] = narrow_log_string(narrow)
 
     query_info = fetch_messages(
         narrow=narrow,
@@ -165,60 +235,14 @@ def get_messages_backend(
         num_after=num_after,
     )
 
-    anchor = query_info.anchor
-    include_history = query_info.include_history
-    is_search = query_info.is_search
-    rows = query_info.rows
-
-    # The following is a little messy, but ensures that the code paths
-    # are similar regardless of the value of include_history.  The
-    # 'user_messages' dictionary maps each message to the user's
-    # UserMessage object for that message, which we will attach to the
-    # rendered message dict before returning it.  We attempt to
-    # bulk-fetch rendered message dicts from remote cache using the
-    # 'messages' list.
-    message_ids: List[int] = []
-    user_message_flags: Dict[int, List[str]] = {}
-    if is_web_public_query:
-        # For spectators, we treat all historical messages as read.
-        for row in rows:
-            message_id = row[0]
-            message_ids.append(message_id)
-            user_message_flags[message_id] = ["read"]
-    elif include_history:
-        assert user_profile is not None
-        message_ids = [row[0] for row in rows]
-
-        # TODO: This could be done with an outer join instead of two queries
-        um_rows = UserMessage.objects.filter(user_profile=user_profile, message_id__in=message_ids)
-        user_message_flags = {um.message_id: um.flags_list() for um in um_rows}
-
-        for message_id in message_ids:
-            if message_id not in user_message_flags:
-                user_message_flags[message_id] = ["read", "historical"]
-    else:
-        for row in rows:
-            message_id = row[0]
-            flags = row[1]
-            user_message_flags[message_id] = UserMessage.flags_list_for_flags(flags)
-            message_ids.append(message_id)
-
-    search_fields: Dict[int, Dict[str, str]] = {}
-    if is_search:
-        for row in rows:
-            message_id = row[0]
-            (topic_name, rendered_content, content_matches, topic_matches) = row[-4:]
-            search_fields[message_id] = get_search_fields(
-                rendered_content, topic_name, content_matches, topic_matches
-            )
-
-    message_list = messages_for_ids(
-        message_ids=message_ids,
-        user_message_flags=user_message_flags,
-        search_fields=search_fields,
+    message_list = get_message_list_from_query_info(
+        query_info,
+        user_profile=user_profile,
+        realm=realm,
+        is_web_public_query=is_web_public_query,
+        include_flags=True,
         apply_markdown=apply_markdown,
         client_gravatar=client_gravatar,
-        allow_edit_history=realm.allow_edit_history,
     )
 
     ret = dict(
@@ -229,11 +253,98 @@ def get_messages_backend(
         found_oldest=query_info.found_oldest,
         found_newest=query_info.found_newest,
         history_limited=query_info.history_limited,
-        anchor=anchor,
+        anchor=query_info.anchor,
     )
     return json_success(request, data=ret)
 
 
+@has_request_variables
+def get_messages_bulk_backend(
+    request: HttpRequest,
+    user_profile: UserProfile,
+    narrow: OptionalNarrowListT = REQ("narrow", converter=narrow_parameter, default=None),
+    after_id: int = REQ(converter=to_non_negative_int, default=0),
+    num_messages: int = REQ(converter=to_non_negative_int, default=MAX_MESSAGES_PER_BULK_FETCH),
+    include_flags: bool = REQ(json_validator=check_bool, default=False),
+    client_gravatar: bool = REQ(json_validator=check_bool, default=True),
+    apply_markdown: bool = REQ(json_validator=check_bool, default=True),
+) -> HttpResponseBase:
+    """Streams every message in the narrow with an ID greater than
+    `after_id`, oldest first, as newline-delimited JSON, for clients
+    archiving a realm's history.
+
+    Messages are fetched in batches of BULK_FETCH_BATCH_SIZE, each
+    starting after the last message of the previous batch, and each
+    batch is written out before the next is fetched, so the server's
+    memory use does not grow with the number of messages.
+
+    Each request stops after `num_messages` messages, at most
+    MAX_MESSAGES_PER_BULK_FETCH, or once it has taken
+    BULK_FETCH_MAX_SECONDS.  The last line is a trailer with the ID to
+    pass as `after_id` to resume."""
+    if num_messages == 0:
+        raise JsonableError(_("Invalid num_messages"))
+    if num_messages > MAX_MESSAGES_PER_BULK_FETCH:
+        raise JsonableError(
+            _("Too many messages requested (maximum {max_messages}).").format(
+                max_messages=MAX_MESSAGES_PER_BULK_FETCH,
+            )
+        )
+    realm = user_profile.realm
+    deadline = time.monotonic() + BULK_FETCH_MAX_SECONDS
+
+    def fetch_batch(anchor: int, remaining: int) -> FetchedMessages:
+        return fetch_messages(
+            narrow=narrow,
+            user_profile=user_profile,
+            realm=realm,
+            is_web_public_query=False,
+            anchor=anchor,
+            include_anchor=False,
+            num_before=0,
+            num_after=min(BULK_FETCH_BATCH_SIZE, remaining),
+        )
+
+    # We fetch the first batch before we start streaming, so that
+    # errors in the narrow are still reported as regular errors.
+    query_info = fetch_batch(after_id, num_messages)
+
+    def stream_messages(query_info: FetchedMessages) -> Iterator[bytes]:
+        last_message_id = after_id
+        remaining = num_messages
+        while True:
+            message_list = get_message_list_from_query_info(
+                query_info,
+                user_profile=user_profile,
+                realm=realm,
+                is_web_public_query=False,
+                include_flags=include_flags,
+                apply_markdown=apply_markdown,
+                client_gravatar=client_gravatar,
+            )
+            for message in message_list:
+                yield orjson.dumps(message, option=orjson.OPT_APPEND_NEWLINE)
+
+            if query_info.rows:
+                last_message_id = query_info.rows[-1][0]
+            remaining -= len(query_info.rows)
+            if query_info.found_newest or remaining == 0 or time.monotonic() > deadline:
+                break
+            query_info = fetch_batch(last_message_id, remaining)
+
+        yield orjson.dumps(
+            dict(
+                result="success",
+                msg="",
+                found_newest=query_info.found_newest,
+                last_message_id=last_message_id,
+            ),
+            option=orjson.OPT_APPEND_NEWLINE,
+        )
+
+    return StreamingHttpResponse(stream_messages(query_info), content_type="application/x-ndjson")
+
+
 @has_request_variables
 def messages_in_narrow_backend(
     request: HttpRequest,
@@ -14,6 +14,7 @@ import time
 import urllib
 from abc import ABC, abstractmethod
 from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from email.message import EmailMessage
 from functools import wraps
 from types import FrameType
@@ -79,6 +80,7 @@ from zerver.lib.push_notifications import (
 from zerver.lib.pysa import mark_sanitized
 from zerver.lib.queue import SimpleQueueClient, retry_event
 from zerver.lib.remote_server import PushNotificationBouncerRetryLaterError
+from zerver.lib.search_index import get_search_index, update_search_index
 from zerver.lib.send_email import (
     EmailNotDeliveredError,
     FromAddress,
@@ -896,15 +898,26 @@ class FetchLinksEmbedData(QueueProcessingWorker):
     # Update stats file after every consume call.
     CONSUME_ITERATIONS_BEFORE_UPDATE_STATS_NUM = 1
 
+    # The links in a message are fetched in parallel, so that a
+    # message waits only for its slowest link.  url_preview limits
+    # how many of these go to any one host at once.
+    MAX_CONCURRENT_FETCHES = 8
+
+    def __init__(self, threaded: bool = False, disable_timeout: bool = False) -> None:
+        super().__init__(threaded, disable_timeout)
+        self.executor = ThreadPoolExecutor(max_workers=self.MAX_CONCURRENT_FETCHES)
+
+    def fetch_embed_data(self, url: str) -> Optional[UrlEmbedData]:
+        start_time = time.time()
+        embed_data = url_preview.get_link_embed_data(url)
+        logging.info("Time spent on get_link_embed_data for %s: %s", url, time.time() - start_time)
+        return embed_data
+
     @override
     def consume(self, event: Mapping[str, Any]) -> None:
-        url_embed_data: Dict[str, Optional[UrlEmbedData]] = {}
-        for url in event["urls"]:
-            start_time = time.time()
-            url_embed_data[url] = url_preview.get_link_embed_data(url)
-            logging.info(
-                "Time spent on get_link_embed_data for %s: %s", url, time.time() - start_time
-            )
+        url_embed_data: Dict[str, Optional[UrlEmbedData]] = dict(
+            zip(event["urls"], self.executor.map(self.fetch_embed_data, event["urls"]))
+        )
 
         with transaction.atomic():
             try:
@@ -947,6 +960,23 @@ class FetchLinksEmbedData(QueueProcessingWorker):
         raise InterruptConsumeError
 
 
+@assign_queue("search_index")
+class SearchIndexWorker(LoopQueueProcessingWorker):
+    """Keeps the SEARCH_INDEX_BACKEND, if any, up to date as messages
+    are sent and edited."""
+
+    batch_size = 1000
+
+    @override
+    def consume_batch(self, events: List[Dict[str, Any]]) -> None:
+        search_index = get_search_index()
+        if search_index is None:
+            return
+        update_search_index(
+            search_index, (message_id for event in events for message_id in event["message_ids"])
+        )
+
+
 @assign_queue("outgoing_webhooks")
 class OutgoingWebhookWorker(QueueProcessingWorker):
     @override
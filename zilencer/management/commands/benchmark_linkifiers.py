@@ -0,0 +1,59 @@
+from timeit import timeit
+from typing import Any, List
+
+from django.core.management.base import BaseCommand, CommandParser
+from typing_extensions import override
+
+from zerver.lib.markdown import ZulipMarkdown, md_engines, render_with_md_engine
+from zerver.lib.types import LinkifierDict
+
+CONTENT = """\
+The deploy for PROJ0-1234 is blocked on PROJ3-77; see the notes at
+https://example.com/deploy/notes and the discussion in PROJ1-42.
+
+* **Owner**: the release team
+* Follow-up: `tools/deploy --check`, PROJ2-555
+"""
+
+
+class Command(BaseCommand):
+    help = """Times rendering a message in realms with increasing numbers of linkifiers.
+
+With the linkifier prefilter, the time per render should stay nearly
+flat as the number of linkifiers grows."""
+
+    @override
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument(
+            "--counts",
+            help="Numbers of linkifiers to time",
+            default=[1, 10, 100, 300, 1000],
+            nargs="+",
+            type=int,
+        )
+        parser.add_argument("--reps", help="Renders to time per count", default=200, type=int)
+
+    @override
+    def handle(self, *args: Any, **options: Any) -> None:
+        # A linkifiers_key that no realm uses.
+        linkifiers_key = -1000
+        for count in options["counts"]:
+            linkifiers: List[LinkifierDict] = [
+                LinkifierDict(
+                    pattern=f"PROJ{i}-(?P<id>[0-9]+)",
+                    url_template=f"https://tracker.example.com/proj{i}/{{id}}",
+                    id=i,
+                )
+                for i in range(count)
+            ]
+            md_engines[(linkifiers_key, False)] = ZulipMarkdown(
+                linkifiers=linkifiers, linkifiers_key=linkifiers_key, email_gateway=False
+            )
+            duration = timeit(
+                lambda: render_with_md_engine(
+                    CONTENT, (linkifiers_key, False), None, None, None, False, False, None
+                ),
+                number=options["reps"],
+            )
+            print(f"{count:>6} linkifiers: {duration / options['reps'] * 1000:.3f}ms per render")
+        del md_engines[(linkifiers_key, False)]
@@ -0,0 +1,111 @@
+import random
+from timeit import timeit
+from typing import Any, List, Set
+
+from django.core.management.base import BaseCommand, CommandParser
+from django.db import connection, transaction
+from psycopg2.extras import execute_values
+from typing_extensions import override
+
+# The query for phrase searches before and after they used
+# phraseto_tsquery, as built by NarrowBuilder._by_search_tsearch.
+ILIKE_QUERY = """
+SELECT id FROM benchmark_messages
+WHERE (content ILIKE %(like)s OR subject ILIKE %(like)s)
+AND search_tsvector @@ plainto_tsquery('zulip.english_us_search', %(operand)s)
+"""
+PHRASE_QUERY = """
+SELECT id FROM benchmark_messages
+WHERE search_tsvector @@ (
+    plainto_tsquery('zulip.english_us_search', %(operand)s)
+    && phraseto_tsquery('zulip.english_us_search', %(phrase)s)
+)
+"""
+
+
+class Command(BaseCommand):
+    help = """Times phrase searches over a generated corpus, with ILIKE and with phraseto_tsquery.
+
+The corpus is a temporary table of messages built from a vocabulary
+with a Zipfian distribution, so that the words of many phrases are
+common but the phrases themselves are rare.  For each phrase, this
+prints the number of messages each query found, and its time."""
+
+    @override
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument("--messages", help="Messages in the corpus", default=100000, type=int)
+        parser.add_argument("--phrases", help="Phrases to search for", default=10, type=int)
+        parser.add_argument("--reps", help="Searches to time per phrase", default=5, type=int)
+
+    @override
+    def handle(self, *args: Any, **options: Any) -> None:
+        rng = random.Random(42)
+        vocabulary = [f"word{i}" for i in range(5000)]
+        weights = [1 / (i + 1) for i in range(len(vocabulary))]
+        messages = [
+            (
+                " ".join(rng.choices(vocabulary, weights, k=3)),
+                " ".join(rng.choices(vocabulary, weights, k=rng.randint(5, 60))),
+            )
+            for _ in range(options["messages"])
+        ]
+
+        # Everything happens in a transaction which we roll back, so
+        # the corpus never outlives the command.
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(
+                """
+                CREATE TEMPORARY TABLE benchmark_messages (
+                    id serial PRIMARY KEY, subject text, content text, search_tsvector tsvector
+                )
+                """
+            )
+            execute_values(
+                cursor.cursor,
+                "INSERT INTO benchmark_messages (subject, content) VALUES %s",
+                messages,
+            )
+            cursor.execute(
+                """
+                UPDATE benchmark_messages SET search_tsvector =
+                to_tsvector('zulip.english_us_search', subject || ' ' || content)
+                """
+            )
+            cursor.execute(
+                "CREATE INDEX ON benchmark_messages USING gin (search_tsvector)"
+                " WITH (fastupdate = off)"
+            )
+            cursor.execute("ANALYZE benchmark_messages")
+
+            def run(query: str, phrase: str) -> List[int]:
+                params = {
+                    "operand": f'"{phrase}"',
+                    "phrase": phrase,
+                    "like": "%" + connection.ops.prep_for_like_query(phrase) + "%",
+                }
+                cursor.execute(query, params)
+                return [row[0] for row in cursor.fetchall()]
+
+            # Phrases of two or three adjacent words from the corpus.
+            for _ in range(options["phrases"]):
+                words = rng.choice(messages)[1].split()
+                start = rng.randrange(max(len(words) - 2, 1))
+                phrase = " ".join(words[start : start + rng.randint(2, 3)])
+
+                results: List[Set[int]] = []
+                for query in [ILIKE_QUERY, PHRASE_QUERY]:
+                    results.append(set(run(query, phrase)))
+                    duration = timeit(
+                        lambda query=query, phrase=phrase: run(query, phrase),
+                        number=options["reps"],
+                    )
+                    print(
+                        f"{phrase!r:>30} {'ILIKE' if query == ILIKE_QUERY else 'phrase':>6}:"
+                        f" {len(results[-1]):>6} messages,"
+                        f" {duration / options['reps'] * 1000:.3f}ms per search"
+                    )
+                if results[0] != results[1]:
+                    # ILIKE matches substrings of words, such as
+                    # "word1 word2" in "word1 word23".
+                    print(f"{'':>30} {len(results[0] - results[1])} only matched by ILIKE")
+            transaction.set_rollback(True)
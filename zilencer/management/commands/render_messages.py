@@ -1,22 +1,47 @@
 import os
-from typing import Any, Iterator
+from collections import defaultdict
+from typing import Any, Dict, Iterator, List
 
 import orjson
-from django.core.management.base import BaseCommand, CommandParser
+from django.core.management.base import BaseCommand, CommandError, CommandParser
 from django.db.models import QuerySet
 from typing_extensions import override
 
-from zerver.lib.message import render_markdown
+from zerver.lib.markdown import MessageRenderingResult
+from zerver.lib.message import render_markdown_batch
 from zerver.models import Message
 
 
-def queryset_iterator(queryset: QuerySet[Message], chunksize: int = 5000) -> Iterator[Message]:
+def queryset_batches(queryset: QuerySet[Message], chunksize: int = 5000) -> Iterator[List[Message]]:
     queryset = queryset.order_by("id")
-    while queryset.exists():
-        for row in queryset[:chunksize]:
-            msg_id = row.id
-            yield row
-        queryset = queryset.filter(id__gt=msg_id)
+    while True:
+        batch = list(queryset[:chunksize])
+        if not batch:
+            return
+        yield batch
+        queryset = queryset.filter(id__gt=batch[-1].id)
+
+
+def original_content(message: Message) -> str:
+    # In order to ensure that the output of this tool is consistent
+    # across the time, even if messages are edited, we always render
+    # the original content version, extracting it from the edit
+    # history if necessary.
+    if message.edit_history:
+        history = orjson.loads(message.edit_history)
+        history = sorted(history, key=lambda i: i["timestamp"])
+        for entry in history:
+            if "prev_content" in entry:
+                return entry["prev_content"]
+    return message.content
+
+
+def serialize_sets(obj: object) -> List[Any]:
+    # The rendering results' sets are written sorted, so the output
+    # can be compared between runs.
+    if isinstance(obj, set):
+        return sorted(obj)
+    raise TypeError
 
 
 class Command(BaseCommand):
@@ -42,26 +67,32 @@ class Command(BaseCommand):
 
         with open(options["destination"], "wb") as result:
             messages = Message.objects.filter(id__gt=latest - amount, id__lte=latest).order_by("id")
-            for message in queryset_iterator(messages):
-                content = message.content
-                # In order to ensure that the output of this tool is
-                # consistent across the time, even if messages are
-                # edited, we always render the original content
-                # version, extracting it from the edit history if
-                # necessary.
-                if message.edit_history:
-                    history = orjson.loads(message.edit_history)
-                    history = sorted(history, key=lambda i: i["timestamp"])
-                    for entry in history:
-                        if "prev_content" in entry:
-                            content = entry["prev_content"]
-                            break
-                result.write(
-                    orjson.dumps(
-                        {
-                            "id": message.id,
-                            "content": render_markdown(message, content),
-                        },
-                        option=orjson.OPT_APPEND_NEWLINE,
+            for batch in queryset_batches(messages.select_related("realm", "sender")):
+                # The data used for rendering is fetched once per realm
+                # in each batch, rather than once per message.
+                messages_by_realm: Dict[int, List[Message]] = defaultdict(list)
+                for message in batch:
+                    messages_by_realm[message.realm_id].append(message)
+                rendered: Dict[int, MessageRenderingResult] = {}
+                for realm_messages in messages_by_realm.values():
+                    rendering_results = render_markdown_batch(
+                        realm_messages[0].realm,
+                        realm_messages,
+                        [original_content(message) for message in realm_messages],
+                    )
+                    for message, rendering_result in zip(realm_messages, rendering_results):
+                        if rendering_result is None:
+                            raise CommandError(f"Failed to render message {message.id}")
+                        rendered[message.id] = rendering_result
+
+                for message in batch:
+                    result.write(
+                        orjson.dumps(
+                            {
+                                "id": message.id,
+                                "content": rendered[message.id],
+                            },
+                            default=serialize_sets,
+                            option=orjson.OPT_APPEND_NEWLINE,
+                        )
                     )
-                )
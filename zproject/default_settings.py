@@ -195,6 +195,20 @@ THUMBNAIL_IMAGES = False
 
 TORNADO_PORTS: List[int] = []
 USING_TORNADO = True
+# Whether to zlib-compress the event queue snapshots Tornado writes
+# to disk on shutdown; trades some CPU for smaller files.
+TORNADO_QUEUE_SNAPSHOT_COMPRESSION = False
+# Number of worker processes each server process forks to render
+# Markdown in; 0 renders Markdown in-process.  A worker process can
+# be killed if a render runs away, which a thread cannot.
+MARKDOWN_RENDER_PROCESSES = 0
+# CPU seconds a single render may use in a worker process.
+MARKDOWN_RENDER_CPU_LIMIT = 5
+# Number of renders after which a worker process is replaced.
+MARKDOWN_RENDER_MAX_RENDERS_PER_PROCESS = 1000
+# Whether to cache rendered Markdown, keyed by the content and the
+# realm data (linkifiers, emoji, mentioned users, etc.) it depends on.
+MARKDOWN_RENDER_CACHE = True
 
 # ToS/Privacy templates
 POLICIES_DIRECTORY: str = "zerver/policies_absent"
@@ -385,6 +399,23 @@ REALM_MOBILE_REMAP_URIS: Dict[str, str] = {}
 # testing.
 USING_PGROONGA = False
 
+# An index outside PostgreSQL to answer `search:` narrows from, kept
+# up to date by the search_index queue worker; see
+# zerver/lib/search_index.py.  The only backend is "sqlite", a local
+# SQLite FTS5 database at SEARCH_INDEX_PATH; it requires all queue
+# workers and application servers to run on the same host.  Build the
+# index with `manage.py build_search_index` before enabling it.
+SEARCH_INDEX_BACKEND: Optional[str] = None
+SEARCH_INDEX_PATH = "/home/zulip/search-index/messages.sqlite3"
+
+# To find narrows which PostgreSQL handles poorly, this fraction of
+# message fetches whose query took at least NARROW_EXPLAIN_MIN_DURATION
+# seconds are run again under EXPLAIN (ANALYZE, BUFFERS), and the
+# plan is logged to the slow queries log.  Plans include the narrow's
+# operands, such as search terms.
+NARROW_EXPLAIN_SAMPLE_RATE = 0.0
+NARROW_EXPLAIN_MIN_DURATION = 1.0
+
 # How Django should send emails.  Set for most contexts in settings.py, but
 # available for sysadmin override in unusual cases.
 EMAIL_BACKEND: Optional[str] = None
@@ -90,6 +90,11 @@ RATE_LIMITING_AUTHENTICATE = False
 # real app.
 USING_RABBITMQ = False
 
+# Many tests mock parts of the Markdown processor and expect each
+# message they send to be rendered again; tests of the rendering
+# cache enable it explicitly.
+MARKDOWN_RENDER_CACHE = False
+
 CACHES["database"] = {
     "BACKEND": "django.core.cache.backends.dummy.DummyCache",
     "LOCATION": "zulip-database-test-cache",
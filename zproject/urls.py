@@ -71,7 +71,11 @@ from zerver.views.message_edit import (
     json_fetch_raw_message,
     update_message_backend,
 )
-from zerver.views.message_fetch import get_messages_backend, messages_in_narrow_backend
+from zerver.views.message_fetch import (
+    get_messages_backend,
+    get_messages_bulk_backend,
+    messages_in_narrow_backend,
+)
 from zerver.views.message_flags import (
     mark_all_as_read,
     mark_stream_as_read,
@@ -347,6 +351,7 @@ v1_api_and_json_patterns = [
         PATCH=update_message_backend,
         DELETE=delete_message_backend,
     ),
+    rest_path("messages/bulk", GET=get_messages_bulk_backend),
     rest_path("messages/render", POST=render_message_backend),
     rest_path("messages/flags", POST=update_message_flags),
     rest_path("messages/flags/narrow", POST=update_message_flags_for_narrow),